@@ -0,0 +1,163 @@
+"""
+An index of occurrence totals by environment, level and status
+
+The index is built with one pass over a result set (a list of ItemMetrics, an ItemMetricsBatch
+or a Metrics API result) and keeps the occurrence total and row count of each
+(environment, level, status). A question like "how many error and critical occurrences were
+there in production and qa" is then answered from the index keys, of which there are only a few,
+instead of from every item.
+
+Usage:
+
+aggregates = AggregateIndex.from_item_metrics(item_metrics_list)
+error_occs = aggregates.get_total(environments=['production', 'qa'], levels=['error', 'critical'])
+occs_by_env = aggregates.get_totals_by('environment', levels=['error'])
+"""
+
+import response_decoder
+
+
+# The fields of each index key, in key order
+INDEX_FIELDS = ['environment', 'level', 'status']
+
+# The Metrics API response field of each index field
+RESPONSE_FIELDS = {
+    'environment': 'environment',
+    'level': 'item_level',
+    'status': 'item_status'
+}
+
+
+class AggregateIndex:
+    """
+    A class that stores the occurrence total and row count for each (environment, level, status)
+    """
+
+    def __init__(self):
+
+        # (environment, level, status) -> [occurrence total, row count]
+        self.totals = {}
+
+    def __len__(self):
+        return len(self.totals)
+
+    def add(self, environment, level, status, occurrence_count):
+        """
+        Use this method to add the occurrences of one row. A missing occurrence_count is 0
+        """
+
+        key = (environment, level, status)
+        total = self.totals.get(key)
+        if total is None:
+            total = [0, 0]
+            self.totals[key] = total
+
+        total[0] += occurrence_count or 0
+        total[1] += 1
+
+    @staticmethod
+    def from_item_metrics(item_metrics_list):
+        """
+        Returns an AggregateIndex of a list (or any iterable) of ItemMetrics objects
+        """
+
+        aggregates = AggregateIndex()
+        for im in item_metrics_list:
+            aggregates.add(im.environment, im.level, im.status, im.occurrence_count)
+
+        return aggregates
+
+    @staticmethod
+    def from_batch(batch):
+        """
+        Returns an AggregateIndex of an ItemMetricsBatch, without creating an ItemMetrics object for each row
+        """
+
+        aggregates = AggregateIndex()
+        environments = batch.columns['environment']
+        levels = batch.columns['level']
+        statuses = batch.columns['status']
+        for index in range(len(batch)):
+            aggregates.add(environments[index], levels[index], statuses[index],
+                           batch.get_value('occurrence_count', index))
+
+        return aggregates
+
+    @staticmethod
+    def from_result(result):
+        """
+        Returns an AggregateIndex of all the timepoints of a Metrics API result.
+        Fields that are not in the query group_by are None in the index keys
+        """
+
+        fields = [RESPONSE_FIELDS[field] for field in INDEX_FIELDS] + ['occurrence_count']
+
+        aggregates = AggregateIndex()
+        for timepoint in result['timepoints']:
+            for environment, level, status, occurrence_count in response_decoder.decode_metrics_rows(
+                    timepoint['metrics_rows'], fields):
+                aggregates.add(environment, level, status, occurrence_count)
+
+        return aggregates
+
+    def get_total(self, environments=None, levels=None, statuses=None):
+        """
+        Use this method to get the occurrence total of a subset of environments, levels and statuses
+
+        Arguments:
+        environments - A list of environment names e.g. ['production', 'qa']. All environments if not set
+        levels - A list of levels e.g. ['error', 'critical']. All levels if not set
+        statuses - A list of statuses e.g. ['active']. All statuses if not set
+
+        Returns:
+        The number of occurrences
+        """
+
+        return sum(total[0] for key, total in self.get_matching_totals(environments, levels, statuses))
+
+    def get_row_count(self, environments=None, levels=None, statuses=None):
+        """
+        Returns the number of rows (e.g. items in each environment) in a subset, with the same arguments as get_total
+        """
+
+        return sum(total[1] for key, total in self.get_matching_totals(environments, levels, statuses))
+
+    def get_totals_by(self, field, environments=None, levels=None, statuses=None):
+        """
+        Use this method to get the occurrence totals of a subset grouped by one field
+
+        Arguments:
+        field - 'environment', 'level' or 'status'
+        environments, levels, statuses - The subset, the same as get_total
+
+        Returns:
+        A dict of field value to number of occurrences
+        """
+
+        position = INDEX_FIELDS.index(field)
+
+        totals_by_value = {}
+        for key, total in self.get_matching_totals(environments, levels, statuses):
+            totals_by_value[key[position]] = totals_by_value.get(key[position], 0) + total[0]
+
+        return totals_by_value
+
+    def get_values(self, field):
+        """
+        Returns the sorted distinct values of 'environment', 'level' or 'status' in the index
+        """
+
+        position = INDEX_FIELDS.index(field)
+
+        return sorted({key[position] for key in self.totals}, key=lambda value: (value is None, str(value)))
+
+    def get_matching_totals(self, environments=None, levels=None, statuses=None):
+        #
+        # A generator of (key, total) for the keys in the subset
+        #
+
+        filters = [None if values is None else set(values) for values in [environments, levels, statuses]]
+
+        for key, total in self.totals.items():
+            if all(values is None or key_value in values for key_value, values in zip(key, filters)):
+                yield key, total
@@ -0,0 +1,194 @@
+"""
+A small HTTP client for the Rollbar API
+
+The client wraps a requests Session so keep-alive connections are reused between calls.
+Thousands of API calls in one run only open as many connections as the pool size.
+
+Usage:
+
+client = ApiClient(pool_size=16, timeout=30)
+resp = client.get('/api/1/projects', account_read_token)
+
+Responses with HTTP 429 or 5xx and connection errors are retried with backoff, and the number
+of requests in flight adapts to the Rollbar rate limits (see throttle.py)
+
+The functions in metrics_base use the shared client from get_default_client()
+when a client is not passed in explicitly
+
+The API base URL can be changed with the ROLLBAR_API_BASE_URL environment variable
+e.g. to run the scripts against a local fake_rollbar_api.py server
+export ROLLBAR_API_BASE_URL=http://127.0.0.1:8000
+"""
+
+import logging
+import os
+import threading
+import time
+
+import instrumentation
+from throttle import RetryPolicy, Throttle
+
+
+DEFAULT_BASE_URL = 'https://api.rollbar.com'
+
+# The environment variable that overrides DEFAULT_BASE_URL
+BASE_URL_ENV_VAR = 'ROLLBAR_API_BASE_URL'
+
+# The maximum number of connections kept open to the API host.
+# This should be at least as large as the number of threads making requests
+DEFAULT_POOL_SIZE = 16
+
+# Seconds to wait for the server to connect and to send a response
+DEFAULT_TIMEOUT = 60
+
+
+class ApiClient:
+    """
+    A class that makes requests to the Rollbar API over a pool of keep-alive connections
+    """
+
+    def __init__(self, base_url=None, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, headers=None, retry_policy=None, throttle=None):
+
+        # requests is imported when the first client is created, so scripts start quickly
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        if base_url is None:
+            base_url = get_base_url()
+
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+        # Requests in flight are limited to the pool size so no thread waits for a connection
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.throttle = throttle if throttle is not None else Throttle(max_limit=pool_size)
+
+        self.session = requests.Session()
+        self.session.headers.update({'accept': 'application/json'})
+        if headers is not None:
+            self.session.headers.update(headers)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_url(self, path):
+        return self.base_url + path
+
+    def request(self, method, path, access_token, json=None, timeout=None, stream=False):
+        """
+        Use this method to make a request to the Rollbar API
+
+        Arguments:
+        method - The HTTP method e.g. 'GET', 'POST'
+        path - The API path e.g. '/api/1/projects'
+        access_token - The Rollbar access token sent in the X-Rollbar-Access-Token header
+        json - An optional object sent as the JSON request body
+        timeout - Seconds to wait for a response. Defaults to the client timeout
+        stream - If True the response body is not read until resp.raw or resp.iter_content is used.
+                 The response should be closed (or used in a with statement) to release the connection
+
+        Returns:
+        A requests Response object. If all retries fail, the last response is returned
+        or the last connection error is raised
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        import requests
+
+        headers = {'X-Rollbar-Access-Token': access_token}
+
+        attempt = 0
+        while True:
+            start_time = self.throttle.acquire(access_token)
+            try:
+                with instrumentation.stage('http', detail='{} {}'.format(method, path)) as event:
+                    resp = self.session.request(method, self.get_url(path), json=json,
+                                                headers=headers, timeout=timeout, stream=stream)
+                    event.status = resp.status_code
+                    event.byte_count = get_response_size(resp, stream)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                self.throttle.release(start_time, key=access_token)
+                if not self.retry_policy.should_retry(attempt):
+                    raise
+
+                delay = self.retry_policy.get_delay(attempt)
+                logging.info('{} {} error={} retry in {:.2f}s'.format(method, path, type(ex).__name__, delay))
+            else:
+                self.throttle.release(start_time, resp.status_code, resp.headers, access_token)
+                if not self.retry_policy.should_retry(attempt, resp.status_code):
+                    return resp
+
+                delay = self.retry_policy.get_delay(attempt, resp.status_code, resp.headers)
+                logging.info('{} {} status={} retry in {:.2f}s'.format(method, path, resp.status_code, delay))
+                resp.close()
+
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, path, access_token, timeout=None):
+        return self.request('GET', path, access_token, timeout=timeout)
+
+    def post(self, path, access_token, json=None, timeout=None, stream=False):
+        return self.request('POST', path, access_token, json=json, timeout=timeout, stream=stream)
+
+    def close(self):
+        self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_base_url():
+    """
+    Returns the Rollbar API base URL from ROLLBAR_API_BASE_URL, or DEFAULT_BASE_URL if it is not set
+    """
+
+    return os.environ.get(BASE_URL_ENV_VAR) or DEFAULT_BASE_URL
+
+
+def get_response_size(resp, stream):
+    #
+    # The body of a streamed response has not been read yet, so its size is taken from the headers
+    #
+
+    if not stream:
+        return len(resp.content)
+
+    content_length = resp.headers.get('Content-Length')
+    return int(content_length) if content_length is not None else None
+
+
+def get_default_client():
+    """
+    Returns the ApiClient shared by every call that does not pass a client explicitly
+    """
+
+    global _default_client
+
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ApiClient()
+
+        return _default_client
+
+
+def set_default_client(client):
+    """
+    Use this method to replace the shared ApiClient e.g. to change the pool size or base URL
+    """
+
+    global _default_client
+
+    with _default_client_lock:
+        _default_client = client
@@ -0,0 +1,591 @@
+"""
+Asyncio versions of the metrics_base functions for getting projects, tokens and metrics
+
+A single event loop can keep hundreds of Metrics API queries in flight across projects.
+The functions have the same names and arguments as the functions in metrics_base,
+except that an AsyncApiClient must be passed in.
+
+Usage:
+
+async with AsyncApiClient(max_in_flight=100) as client:
+    projects = await get_project_objects(account_read_token, ['read'], client)
+    results = await asyncio.gather(*[get_item_metrics(p, start, end, client=client) for p in projects])
+
+Requires the aiohttp package
+pip3 install aiohttp
+"""
+
+import asyncio
+import logging
+
+import aiohttp
+
+import instrumentation
+import metrics_base as mb
+import query_shards
+import response_decoder
+from api_client import DEFAULT_TIMEOUT, get_base_url
+from metrics_base import ItemMetrics
+from metrics_base import Project
+from throttle import AsyncThrottle, RetryPolicy
+
+
+# The maximum number of requests in flight at the same time
+DEFAULT_MAX_IN_FLIGHT = 100
+
+
+class AsyncApiResponse:
+    """
+    A small class to store the parts of a Rollbar API response used by the scripts
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+class AsyncApiClient:
+    """
+    A class that makes requests to the Rollbar API from an asyncio event loop.
+    Create the client with 'async with' so the connection pool is closed when done
+    """
+
+    def __init__(self, base_url=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 timeout=DEFAULT_TIMEOUT, retry_policy=None, throttle=None):
+
+        if base_url is None:
+            base_url = get_base_url()
+
+        self.base_url = base_url.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.session = None
+
+        # max_in_flight is the upper bound, the throttle lowers it when the API returns 429
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.throttle = throttle if throttle is not None else AsyncThrottle(max_limit=max_in_flight)
+
+    async def __aenter__(self):
+        self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def open(self):
+        # The connector limit bounds the number of requests in flight
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             headers={'accept': 'application/json'})
+
+    async def request(self, method, path, access_token, json=None, timeout=None):
+        """
+        Use this method to make a request to the Rollbar API
+
+        Arguments:
+        method - The HTTP method e.g. 'GET', 'POST'
+        path - The API path e.g. '/api/1/projects'
+        access_token - The Rollbar access token sent in the X-Rollbar-Access-Token header
+        json - An optional object sent as the JSON request body
+        timeout - Seconds to wait for a response. Defaults to the client timeout
+
+        Returns:
+        An AsyncApiResponse object. If all retries fail, the last response is returned
+        or the last connection error is raised
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        headers = {'X-Rollbar-Access-Token': access_token}
+
+        attempt = 0
+        while True:
+            start_time = await self.throttle.acquire(access_token)
+            try:
+                with instrumentation.stage('http', detail='{} {}'.format(method, path)) as event:
+                    async with self.session.request(method, self.base_url + path, json=json, headers=headers,
+                                                    timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                        content = await resp.read()
+                        api_resp = AsyncApiResponse(resp.status, resp.headers, content)
+
+                    event.status = api_resp.status_code
+                    event.byte_count = len(content)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                await self.throttle.release(start_time, key=access_token)
+                if not self.retry_policy.should_retry(attempt):
+                    raise
+
+                delay = self.retry_policy.get_delay(attempt)
+                logging.info('{} {} error={} retry in {:.2f}s'.format(method, path, type(ex).__name__, delay))
+            else:
+                await self.throttle.release(start_time, api_resp.status_code, api_resp.headers, access_token)
+                if not self.retry_policy.should_retry(attempt, api_resp.status_code):
+                    return api_resp
+
+                delay = self.retry_policy.get_delay(attempt, api_resp.status_code, api_resp.headers)
+                logging.info('{} {} status={} retry in {:.2f}s'.format(method, path, api_resp.status_code, delay))
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, path, access_token, timeout=None):
+        return await self.request('GET', path, access_token, timeout=timeout)
+
+    async def post(self, path, access_token, json=None, timeout=None):
+        return await self.request('POST', path, access_token, json=json, timeout=timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+async def get_item_metrics(proj: Project, start_time_unix, end_time_unix, add_assigned_users=False,
+                           client=None, item_cache=None, shard_seconds=None, query_cache=None, granularity=None,
+                           query_planner=None):
+    """
+    Use this method to get Item metrics for a project for a given time window
+
+    Arguments:
+    proj - A Project object
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
+    add_assigned_users - If True the assigned_user_id is added to each Item metric
+    client - An AsyncApiClient
+    item_cache - An optional ItemCache that is checked before calling the get item API
+    shard_seconds - If set the time window is split into shards of this length that are queried concurrently.
+                    Note: ip_address_count is an upper bound when the window is split
+    query_cache - An optional QueryCache that is checked before calling the Metrics API
+    granularity - If set e.g. 'hour' or 'day', there is an Item metric for each item and hour (or day)
+    query_planner - An optional query_planner.QueryPlanner that splits the query into smaller queries if it
+                    fails because it is too large
+
+    Returns:
+    A list of Item metrics
+    """
+
+    query_data = mb.get_item_metrics_query(start_time_unix, end_time_unix, granularity)
+
+    result = await get_occ_metrics_result(proj, query_data, client, shard_seconds, query_cache, query_planner)
+
+    if result is None:
+        return []
+
+    metrics_list = mb.get_metrics_from_response(proj, result, start_time_unix, end_time_unix)
+
+    logging.info('Number of items in response=%s', len(metrics_list))
+
+    if add_assigned_users is False:
+        return metrics_list
+
+    # Add assigned_user_id - by calling Rollbar get_item API once for each item
+    await add_extra_info_to_metrics_list(proj, metrics_list, client, item_cache)
+
+    return metrics_list
+
+
+async def get_item_metrics_batch(proj: Project, start_time_unix, end_time_unix, client=None, shard_seconds=None,
+                                 query_cache=None, granularity=None, query_planner=None):
+    """
+    Use this method to get Item metrics for a project as an ItemMetricsBatch
+
+    Arguments:
+    proj - A Project object
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
+    client - An AsyncApiClient
+    shard_seconds - If set the time window is split into shards of this length that are queried concurrently
+    query_cache - An optional QueryCache that is checked before calling the Metrics API
+    granularity - If set e.g. 'hour' or 'day', there is a row for each item and hour (or day)
+    query_planner - An optional query_planner.QueryPlanner that splits the query if it is too large
+
+    Returns:
+    An ItemMetricsBatch
+    """
+
+    query_data = mb.get_item_metrics_query(start_time_unix, end_time_unix, granularity)
+
+    result = await get_occ_metrics_result(proj, query_data, client, shard_seconds, query_cache, query_planner)
+
+    if result is None:
+        return mb.ItemMetricsBatch()
+
+    batch = mb.get_metrics_batch_from_response(proj, result, start_time_unix, end_time_unix)
+
+    logging.info('Number of items in response=%s', len(batch))
+
+    return batch
+
+
+async def get_item_metrics_series(proj: Project, start_time_unix, end_time_unix, granularity='hour', client=None,
+                                  shard_seconds=None, query_cache=None, query_planner=None):
+    """
+    The same as metrics_base.get_item_metrics_series with an AsyncApiClient
+
+    Returns:
+    A time_series.MetricsSeries with a row for each (item_id, environment)
+    """
+
+    query_data = mb.get_item_metrics_query(start_time_unix, end_time_unix, granularity)
+
+    result = await get_occ_metrics_result(proj, query_data, client, shard_seconds, query_cache, query_planner)
+
+    return mb.get_series_from_response(proj, result, start_time_unix, end_time_unix, granularity)
+
+
+async def get_all_enabled_projects(account_read_token, client=None):
+    """
+    Arguments:
+    account_read_token: An Account level acces token with Read scope
+    client: An AsyncApiClient
+
+    Returns:
+    A list with the project ids for all enabled projects in an account
+    """
+
+    proj_list = []
+    with instrumentation.stage('discovery') as event:
+        try:
+            resp = await client.get('/api/1/projects', account_read_token)
+            log = '/api/1/projects status={}'.format(resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
+
+            dct = response_decoder.loads(resp.content)['result']
+            proj_list = mb.get_enabled_projects_from_result(dct)
+            event.row_count = len(proj_list)
+
+        except Exception as ex:
+            logging.error('Error making request to Rollbar Metrics API', exc_info=ex)
+
+    return proj_list
+
+
+async def get_all_projects(account_read_token, client=None):
+    """
+    Use this method to get the list of Projects in an account
+
+    Arguments:
+    account_read_token - An Account level access token with Read scope
+    client - An AsyncApiClient
+
+    Returns:
+    List of Project object with id and name properties populated (Doesnt set the token property)
+    """
+
+    return await get_all_enabled_projects(account_read_token, client)
+
+
+async def get_project_access_tokens(proj: Project, account_read_token, client=None):
+    """
+    Use this method to get the access tokens for a single project
+
+    Arguments:
+    proj - A Project object (with the id and name properties set)
+    account_read_token - An account level access token with Read scope
+    client - An AsyncApiClient
+
+    Returns:
+    A dict with the access_tokens API response, or None if the request failed without a response
+    or the response could not be decoded
+    """
+
+    path = '/api/1/project/{}/access_tokens'.format(proj.id)
+
+    with instrumentation.stage('token_lookup', proj.name, path) as event:
+        try:
+            resp = await client.get(path, account_read_token)
+            log = '{} /api/1/project/{}/access_tokens status={}'.format(proj.name, proj.id, resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
+
+            return response_decoder.loads(resp.content)
+
+        except Exception as ex:
+            event.error = True
+            msg = 'Error getting the access tokens for project={}'.format(proj.name)
+            logging.error(msg, exc_info=ex)
+            return None
+
+
+async def get_all_project_access_tokens(proj_list, account_read_token, client=None):
+    """
+    Use this method to get the access tokens for many projects concurrently
+
+    Arguments:
+    proj_list - List of project objects (with the id and name properties set)
+    account_read_token - An account level access token with Read scope
+    client - An AsyncApiClient
+
+    Returns:
+    A list of access_tokens API response dicts in the same order as proj_list.
+    The response of a project whose request failed is None, so one failed project does not stop the others
+    """
+
+    return await asyncio.gather(*[get_project_access_tokens(proj, account_read_token, client)
+                                  for proj in proj_list])
+
+
+async def get_project_objects_with_token(proj_list, account_read_token, allowed_token_names, client=None):
+    """
+    Use this method to get Project objects with a read token for each project in proj_list
+
+    Arguments:
+    proj_list - List of partially initialized project objects
+    account_read_token - An account level access token with Read scope
+    allowed_token_names - List of alllowed token names. The allowed tokens must have Read scope ONLY
+    client - An AsyncApiClient
+
+    Returns:
+    proj_list: List of project objects with valid read token property (in the same order as proj_list)
+    """
+
+    resp_dicts = await get_all_project_access_tokens(proj_list, account_read_token, client)
+
+    return mb.get_project_objects_from_token_responses(proj_list, resp_dicts, allowed_token_names)
+
+
+async def get_project_objects(account_read_token, allowed_token_names, client=None, registry=None):
+    """
+    Use this method to get a list of Project objects
+
+    Arguments:
+    account_read_token - An account level access token with Read scope
+    allowed_token_names - Only a token with a name from the allowed list of names will be chosen
+                          Note: The token will be accepted if it has Read scope ONLY
+    client - An AsyncApiClient
+    registry - An optional ProjectRegistry. If the registry is fresh no API calls are made
+
+    Returns:
+    List of Project objects with id, name, and read_access_token
+    """
+
+    if registry is not None:
+        proj_list = registry.get_projects(account_read_token, allowed_token_names)
+        if proj_list is not None:
+            logging.info('Using %s projects from the project registry', len(proj_list))
+            return proj_list
+
+    p_list = await get_all_enabled_projects(account_read_token, client)
+    resp_dicts = await get_all_project_access_tokens(p_list, account_read_token, client)
+    proj_list = mb.get_project_objects_from_token_responses(p_list, resp_dicts, allowed_token_names)
+
+    # A project list with failed lookups is not stored, so the next run looks the projects up again
+    if registry is not None and len(p_list) > 0 and all(mb.is_token_lookup_ok(r) for r in resp_dicts):
+        registry.set_projects(account_read_token, allowed_token_names, proj_list)
+
+    return proj_list
+
+
+async def add_read_token_to_projects(proj_list, account_read_token, allowed_project_token_names, client=None,
+                                     registry=None):
+    #
+    # For each project object in proj_list add the token property
+    # If a ProjectRegistry is passed in, only projects without a fresh registry token are looked up
+    #
+
+    lookup_list = mb.add_read_tokens_from_registry(proj_list, account_read_token, allowed_project_token_names,
+                                                   registry)
+
+    resp_dicts = await get_all_project_access_tokens(lookup_list, account_read_token, client)
+
+    mb.add_read_tokens_from_responses(lookup_list, resp_dicts, allowed_project_token_names)
+    mb.save_read_tokens_to_registry(lookup_list, resp_dicts, account_read_token, allowed_project_token_names,
+                                    registry)
+
+
+async def make_occ_metrics_api_call(proj: Project, query_data, client=None, query_cache=None):
+    """
+    Use this method to return the data for the query passed as an argument
+
+    Arguments:
+    proj - A Project object (Requires name and token properties to be set)
+    query_data - A JSON object which defines the Metrics API query
+    client - An AsyncApiClient
+    query_cache - An optional QueryCache. Cached results are returned without calling the API,
+                  and identical queries in flight at the same time make one API call
+
+    Returns:
+    A dict with the Metrics API data
+    """
+
+    if query_cache is not None:
+        return await query_cache.get_or_fetch_async(proj, query_data,
+                                                    lambda: make_occ_metrics_api_call(proj, query_data, client))
+
+    status_code, result = await call_occ_metrics_api(proj, query_data, client)
+
+    return result
+
+
+async def call_occ_metrics_api(proj: Project, query_data, client=None):
+    """
+    The same as metrics_base.call_occ_metrics_api with an AsyncApiClient
+
+    Returns:
+    A tuple of (status_code, result). status_code is None if the request failed without a response
+    (e.g. a timeout) and result is None unless status_code is 200
+    """
+
+    with instrumentation.stage('metrics_query', proj.name, '/api/1/metrics/occurrences') as event:
+        try:
+
+            # POST request
+            resp = await client.post('/api/1/metrics/occurrences', proj.token, json=query_data)
+            log = '/api/1/metrics/occurrences proj={} status={}'.format(proj.name, resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
+
+            if resp.status_code == 200:
+                result = response_decoder.loads(resp.content)['result']
+                return resp.status_code, result
+            else:
+                msg = 'Rollbar Metrics API query failed project={} status={}'.format(proj.name, resp.status_code)
+                logging.error(msg)
+                return resp.status_code, None
+
+        except Exception as ex:
+            event.error = True
+            msg = 'Error making request to Rollbar Metrics API project={}'.format(proj.name)
+            logging.error(msg, exc_info=ex)
+            return None, None
+
+
+async def get_occ_metrics_result(proj: Project, query_data, client=None, shard_seconds=None, query_cache=None,
+                                 query_planner=None):
+    #
+    # Run a query in one call, in time window shards, or with a query planner
+    #
+
+    if shard_seconds is not None:
+        return await make_sharded_occ_metrics_api_call(proj, query_data, shard_seconds, client, query_cache,
+                                                       query_planner)
+
+    if query_planner is not None:
+        return await query_planner.run_async(proj, query_data, client, query_cache)
+
+    return await make_occ_metrics_api_call(proj, query_data, client, query_cache)
+
+
+async def make_sharded_occ_metrics_api_call(proj: Project, query_data, shard_seconds, client=None,
+                                            query_cache=None, query_planner=None):
+    """
+    Use this method to split the time window of a query into shards, query the shards concurrently
+    and merge the results. See query_shards for how the metrics rows are merged
+
+    Arguments:
+    proj - A Project object (Requires name and token properties to be set)
+    query_data - A JSON object which defines the Metrics API query
+    shard_seconds - The length of each time window shard e.g. 24 * 60 * 60 for one shard per day
+    client - An AsyncApiClient
+    query_cache - An optional QueryCache for the shard queries. The shards are aligned to multiples of
+                  shard_seconds so the closed shards of the last run are cache hits
+    query_planner - An optional query_planner.QueryPlanner that splits each shard query if it is too large
+
+    Returns:
+    A dict with the merged Metrics API data, or None if the query for any shard failed
+    """
+
+    shards = query_shards.split_time_window(query_data['start_time'], query_data['end_time'], shard_seconds,
+                                            align=query_cache is not None)
+
+    shard_queries = [query_shards.get_shard_query(query_data, start, end) for start, end in shards]
+
+    results = await asyncio.gather(*[get_occ_metrics_result(proj, shard_query, client, query_cache=query_cache,
+                                                            query_planner=query_planner)
+                                     for shard_query in shard_queries])
+
+    if any(result is None for result in results):
+        msg = 'Error getting {} of {} time window shards for project={}'
+        logging.error(msg.format(sum(result is None for result in results), len(results), proj.name))
+        return None
+
+    return query_shards.merge_metrics_results(results, query_data)
+
+
+async def get_item(proj: Project, item_id, client=None):
+    """
+    Use this method to get the details of an Item from the Rollbar get item API
+
+    Arguments:
+    proj - A Project obect (with the token and name properties set)
+    item_id - The id of the Item
+    client - An AsyncApiClient
+
+    Returns:
+    A dict with the Item details, or None if the request failed
+    """
+
+    try:
+
+        # GET request
+        resp = await client.get('/api/1/item/{}'.format(item_id), proj.token)
+
+        log = 'Get Item HTTP response status={}'.format(resp.status_code)
+        logging.info(log)
+
+        if resp.status_code == 200:
+            return response_decoder.loads(resp.content)['result']
+
+        msg = 'Error getting extra info for item id={} project={} status_code={}'
+        msg = msg.format(item_id, proj.name, resp.status_code)
+        logging.error(msg)
+
+    except Exception as ex:
+        msg = 'Error making request to Rollbar Get item API project={}'.format(proj.name)
+        logging.error(msg, exc_info=ex)
+
+    return None
+
+
+async def add_extra_info_to_metrics(proj: Project, item_metrics: ItemMetrics, client=None):
+    """
+    Use this method to add the assigned_user_id to a partially populated ItemMetrics object
+
+    Arguments:
+    proj - A Project obect (with the token and name properties set)
+    item_metrics - A object with som emetrics for an Item already set
+    client - An AsyncApiClient
+    """
+
+    item = await get_item(proj, item_metrics.id, client)
+    if item is not None:
+        mb.set_extra_info_from_item([item_metrics], item)
+
+
+async def add_extra_info_to_metrics_list(proj: Project, metrics_list, client=None, item_cache=None):
+    """
+    Use this method to add the assigned_user_id to every ItemMetrics object in a list.
+    Metrics rows for the same item share one get item request
+
+    Arguments:
+    proj - A Project obect (with the token and name properties set)
+    metrics_list - A list of ItemMetrics objects
+    client - An AsyncApiClient
+    item_cache - An optional ItemCache. Only items that are not cached are requested from the API
+    """
+
+    metrics_by_item_id = mb.group_metrics_by_item_id(metrics_list)
+
+    item_ids = mb.get_uncached_item_ids(proj, metrics_by_item_id, item_cache)
+    with instrumentation.stage('enrichment', proj.name) as event:
+        items = await asyncio.gather(*[get_item(proj, item_id, client) for item_id in item_ids])
+        event.row_count = len(item_ids)
+
+    fetched_items = {}
+    for item_id, item in zip(item_ids, items):
+        if item is not None:
+            mb.set_extra_info_from_item(metrics_by_item_id[item_id], item)
+            fetched_items[item_id] = item
+
+    if item_cache is not None:
+        item_cache.put_many(proj.id, fetched_items)
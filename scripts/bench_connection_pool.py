@@ -0,0 +1,78 @@
+"""
+Use this script to compare one connection per request with the pooled ApiClient
+
+Both runs make the same calls against a local fake Rollbar API and print the number of
+TCP connections opened and the wall time
+
+Usage:
+python3 bench_connection_pool.py [number_of_projects]
+"""
+
+import sys
+import time
+
+import requests
+
+import metrics_base as mb
+from api_client import ApiClient
+from fake_rollbar_api import FakeRollbarApi
+
+
+ALLOWED_PROJECT_TOKEN_NAMES = ['read', 'metrics_api_token']
+
+QUERY_DATA = {
+    'start_time': 1662033600,
+    'end_time': 1662033600 + 24 * 60 * 60,
+    'group_by': ['environment', 'item_level']
+}
+
+
+def run_without_pool(server):
+    #
+    # A new connection for every request, as with module-level requests.get/post
+    #
+
+    headers = {'X-Rollbar-Access-Token': 'account-token'}
+    resp = requests.get(server.base_url + '/api/1/projects', headers=headers)
+
+    for proj in resp.json()['result']:
+        url = '{}/api/1/project/{}/access_tokens'.format(server.base_url, proj['id'])
+        token = requests.get(url, headers=headers).json()['result'][0]['access_token']
+
+        url = server.base_url + '/api/1/metrics/occurrences'
+        requests.post(url, json=QUERY_DATA, headers={'X-Rollbar-Access-Token': token})
+
+
+def run_with_pool(server):
+
+    with ApiClient(base_url=server.base_url) as client:
+        projects = mb.get_project_objects('account-token', ALLOWED_PROJECT_TOKEN_NAMES, client=client)
+
+        for proj in projects:
+            mb.make_occ_metrics_api_call(proj, QUERY_DATA, client)
+
+
+def measure(name, func, server):
+
+    server.reset_counters()
+
+    start = time.perf_counter()
+    func(server)
+    elapsed = time.perf_counter() - start
+
+    print('{:<12} requests={:<6} connections={:<6} wall_time={:.3f}s'.format(
+        name, server.request_count, server.connection_count, elapsed))
+
+
+if __name__ == "__main__":
+
+    project_count = 200
+    if len(sys.argv) > 1:
+        project_count = int(sys.argv[1])
+
+    server = FakeRollbarApi(project_count=project_count).start()
+    try:
+        measure('no pool', run_without_pool, server)
+        measure('ApiClient', run_with_pool, server)
+    finally:
+        server.stop()
@@ -0,0 +1,108 @@
+"""
+Use this script to compare the old field by field decoding of Metrics API rows with response_decoder
+
+A synthetic response with Item level rows is decoded both ways and the wall time of each
+step is printed. orjson is used for the new decoding when it is installed (pip3 install orjson)
+
+Usage:
+python3 bench_decode.py [number_of_rows]
+"""
+
+import json
+import sys
+import time
+
+import metrics_base as mb
+import response_decoder
+
+
+def get_response_content(row_count):
+
+    metric_rows = []
+    for row in range(row_count):
+        metric_rows.append([
+            {'field': 'item_id', 'value': 1000 + row},
+            {'field': 'item_counter', 'value': row},
+            {'field': 'item_title', 'value': 'Error number {}'.format(row)},
+            {'field': 'environment', 'value': 'production'},
+            {'field': 'item_level', 'value': 'error'},
+            {'field': 'item_status', 'value': 'active'},
+            {'field': 'occurrence_count', 'value': row % 97},
+            {'field': 'ip_address_count', 'value': row % 13},
+        ])
+
+    response = {'err': 0, 'result': {'timepoints': [{'metrics_rows': metric_rows}]}}
+
+    return json.dumps(response).encode('utf-8')
+
+
+def decode_old(content):
+    #
+    # The decoding used before response_decoder: json.loads of the text and a comparison per field
+    #
+
+    result = json.loads(content.decode('utf-8'))['result']
+
+    item_metrics_list = []
+    for row_group in result['timepoints'][0]['metrics_rows']:
+        im = mb.ItemMetrics()
+        im.start_time_unix = 0
+        im.end_time_unix = 0
+        for row in row_group:
+            if row['field'] == 'item_id':
+                im.id = row['value']
+            if row['field'] == 'item_title':
+                im.title = row['value']
+            if row['field'] == 'item_counter':
+                im.counter = row['value']
+            if row['field'] == 'environment':
+                im.environment = row['value']
+            if row['field'] == 'item_level':
+                im.level = row['value']
+            if row['field'] == 'item_status':
+                im.status = row['value']
+            if row['field'] == 'occurrence_count':
+                im.occurrence_count = row['value']
+            if row['field'] == 'ip_address_count':
+                im.ip_address_count = row['value']
+
+        item_metrics_list.append(im)
+
+    return item_metrics_list
+
+
+def decode_new(content):
+
+    result = response_decoder.loads(content)['result']
+    proj = mb.Project()
+
+    return mb.get_metrics_from_response(proj, result, 0, 0)
+
+
+def measure(name, func, content):
+
+    start = time.perf_counter()
+    item_metrics_list = func(content)
+    elapsed = time.perf_counter() - start
+
+    print('{:<10} rows={:<8} wall_time={:.3f}s'.format(name, len(item_metrics_list), elapsed))
+
+    return item_metrics_list
+
+
+if __name__ == "__main__":
+
+    row_count = 200000
+    if len(sys.argv) > 1:
+        row_count = int(sys.argv[1])
+
+    content = get_response_content(row_count)
+    print('response size={} bytes orjson={}'.format(len(content), response_decoder.get_orjson() is not None))
+
+    old_list = measure('old', decode_old, content)
+    new_list = measure('new', decode_new, content)
+
+    for old_im, new_im in zip(old_list, new_list):
+        if old_im.get_csv_row() != new_im.get_csv_row():
+            print('Decoded rows differ: {} {}'.format(old_im.get_csv_row(), new_im.get_csv_row()))
+            break
@@ -0,0 +1,132 @@
+"""
+Use this script to check that the scripts start quickly
+
+Each script module is imported in a new Python process and this is printed for each one:
+
+import_time - The median time to import the module, measured with python -X importtime
+help_time - The median wall time of python3 SCRIPT --help
+heavy_modules - Heavy dependencies that were imported. These should only be imported when they are used
+
+The script exits with status 1 if a module takes longer than the target to import or imports
+a heavy dependency, so it can be run in CI or before a release.
+
+The tokens are not set, because the scripts must not need them until they run.
+
+Usage:
+python3 bench_import.py
+python3 bench_import.py --target-ms 100 --repeat 7
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+SCRIPT_MODULES = ['get_occurrences_by_env', 'get_occurrence_reports', 'get_common_item_metrics',
+                  'get_account_item_metrics', 'get_muted_items', 'projects_dashboard', 'query_metrics_store',
+                  'collector', 'metrics_exporter']
+
+# The scripts that take --help
+HELP_SCRIPTS = ['get_occurrences_by_env', 'get_occurrence_reports', 'get_common_item_metrics', 'projects_dashboard',
+                'query_metrics_store', 'collector', 'metrics_exporter']
+
+# These modules must not be imported by importing a script
+HEAVY_MODULES = ['requests', 'urllib3', 'aiohttp', 'asyncio', 'pandas', 'numpy', 'tabulate', 'pyarrow',
+                 'orjson', 'ijson', 'http.client']
+
+DEFAULT_TARGET_MS = 100
+DEFAULT_REPEAT = 5
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+TOKEN_ENV_VARS = ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS', 'ROLLBAR_PROJECT_READ_ACCESS_TOKEN']
+
+
+def get_env():
+    #
+    # The scripts run without tokens, so reading a token at import fails
+    #
+
+    env = dict(os.environ)
+    for name in TOKEN_ENV_VARS:
+        env.pop(name, None)
+
+    return env
+
+
+def get_import_time_ms(module):
+    #
+    # The last line of -X importtime output is the cumulative time of the module in microseconds
+    #
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          cwd=SCRIPTS_DIR, env=get_env(), capture_output=True, text=True, check=True)
+
+    for line in reversed(proc.stderr.splitlines()):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+
+    raise ValueError('No import time for {}'.format(module))
+
+
+def get_heavy_modules(module):
+
+    code = 'import sys, {}; print(",".join(m for m in {!r} if m in sys.modules))'.format(module, HEAVY_MODULES)
+    proc = subprocess.run([sys.executable, '-c', code], cwd=SCRIPTS_DIR, env=get_env(),
+                          capture_output=True, text=True, check=True)
+
+    output = proc.stdout.strip()
+    return output.split(',') if output else []
+
+
+def get_help_time_ms(module):
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, module + '.py', '--help'], cwd=SCRIPTS_DIR, env=get_env(),
+                   capture_output=True, check=True)
+
+    return (time.perf_counter() - start) * 1000
+
+
+def run_benchmarks(target_ms, repeat):
+
+    print('{:<26} {:>12} {:>12}  {}'.format('script', 'import_time', 'help_time', 'heavy_modules'))
+
+    failed = False
+    for module in SCRIPT_MODULES:
+        import_ms = statistics.median(get_import_time_ms(module) for _ in range(repeat))
+
+        help_ms = None
+        if module in HELP_SCRIPTS:
+            help_ms = statistics.median(get_help_time_ms(module) for _ in range(repeat))
+
+        heavy_modules = get_heavy_modules(module)
+
+        help_str = '-' if help_ms is None else '{:.1f}ms'.format(help_ms)
+        print('{:<26} {:>10.1f}ms {:>12}  {}'.format(module, import_ms, help_str, ','.join(heavy_modules)))
+
+        if import_ms > target_ms or len(heavy_modules) > 0:
+            failed = True
+
+    if failed:
+        print('FAILED: a script took longer than {}ms to import or imported a heavy module'.format(target_ms))
+    else:
+        print('OK: all scripts imported in less than {}ms'.format(target_ms))
+
+    return not failed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check the import time of the scripts')
+    parser.add_argument('--target-ms', type=float, default=DEFAULT_TARGET_MS,
+                        help='The maximum median import time of each script in milliseconds')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='The number of times each script is run')
+    args = parser.parse_args()
+
+    if not run_benchmarks(args.target_ms, args.repeat):
+        sys.exit(1)
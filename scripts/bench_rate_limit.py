@@ -0,0 +1,82 @@
+"""
+Use this script to check retries and adaptive throttling against a rate limited fake Rollbar API
+
+The same Metrics API queries are run without retries and with the default ApiClient retries and
+throttling. For each run the number of queries that returned data, the number of 429 responses
+and the wall time are printed
+
+Usage:
+python3 bench_rate_limit.py [rate_limit] [latency_seconds]
+"""
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics_base as mb
+from api_client import ApiClient
+from fake_rollbar_api import FakeRollbarApi
+from throttle import RetryPolicy
+
+
+PROJECT_COUNT = 4
+QUERIES_PER_PROJECT = 50
+RATE_LIMIT_WINDOW = 1
+WORKERS = 32
+
+QUERY_DATA = {
+    'start_time': 1662033600,
+    'end_time': 1662033600 + 24 * 60 * 60,
+    'group_by': ['environment', 'item_level']
+}
+
+
+def run_queries(projects, client):
+
+    proj_list = projects * QUERIES_PER_PROJECT
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        return list(executor.map(lambda proj: mb.make_occ_metrics_api_call(proj, QUERY_DATA, client), proj_list))
+
+
+def measure(name, server, projects, client):
+
+    server.reset_counters()
+
+    start = time.perf_counter()
+    results = run_queries(projects, client)
+    elapsed = time.perf_counter() - start
+
+    ok_count = sum(result is not None for result in results)
+    print('{:<10} ok={}/{} requests={} rate_limited={} wall_time={:.3f}s'.format(
+        name, ok_count, len(results), server.request_count, server.rate_limited_count, elapsed))
+
+
+if __name__ == "__main__":
+
+    rate_limit = 20
+    if len(sys.argv) > 1:
+        rate_limit = int(sys.argv[1])
+
+    latency = 0.02
+    if len(sys.argv) > 2:
+        latency = float(sys.argv[2])
+
+    server = FakeRollbarApi(project_count=PROJECT_COUNT).start()
+    try:
+        with ApiClient(base_url=server.base_url) as client:
+            projects = mb.get_project_objects('account-token', ['read'], client=client)
+
+        server.rate_limit = rate_limit
+        server.rate_limit_window = RATE_LIMIT_WINDOW
+        server.latency = latency
+
+        with ApiClient(base_url=server.base_url, retry_policy=RetryPolicy(max_retries=0)) as client:
+            measure('no retry', server, projects, client)
+
+        with ApiClient(base_url=server.base_url) as client:
+            measure('throttled', server, projects, client)
+            aimd = client.throttle.aimd
+            print('throttle limit={:.1f} min_limit={:.1f}'.format(aimd.limit, aimd.min_seen_limit))
+    finally:
+        server.stop()
@@ -0,0 +1,144 @@
+"""
+Use this script to measure the scripts end to end against a local fake Rollbar API
+
+The fake API (fake_rollbar_api.py) runs in a separate process and the scripts are pointed at it
+with ROLLBAR_API_BASE_URL. Each script runs in a temporary directory (so the CSV files, caches and
+project registry of a real run are not touched) and this is printed for each script:
+
+wall_time - Seconds for the run
+calls - API calls received by the fake API
+bytes - Response bytes sent by the fake API
+peak_memory - Peak memory of the script measured with tracemalloc (in a second run, as tracemalloc
+              slows the script down)
+
+Usage:
+python3 bench_scripts.py
+python3 bench_scripts.py --projects 50 --rows 500 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+import api_client
+from fake_rollbar_api import FakeRollbarApi
+
+
+def serve_fake_api(server_args, base_url_queue):
+
+    server = FakeRollbarApi(**server_args)
+    base_url_queue.put(server.base_url)
+    server.serve_forever()
+
+
+def get_scenarios():
+    #
+    # project_registry sets its default file from the home directory when it is imported,
+    # so the scripts are imported after HOME is set to a temporary directory
+    #
+
+    get_occurrences_by_env = importlib.import_module('get_occurrences_by_env')
+    get_common_item_metrics = importlib.import_module('get_common_item_metrics')
+    projects_dashboard = importlib.import_module('projects_dashboard')
+
+    return [
+        ('get_occurrences_by_env',
+         lambda: get_occurrences_by_env.process_all(refresh_projects=True, use_query_cache=False)),
+        ('get_common_item_metrics',
+         lambda: get_common_item_metrics.process_single_project(use_query_cache=False)),
+        ('projects_dashboard',
+         lambda: projects_dashboard.generate_dashboard(refresh_projects=True)),
+    ]
+
+
+def run_once(func, base_url, trace_memory):
+    #
+    # Run a script in a new temporary directory with a new shared ApiClient
+    #
+
+    requests.post(base_url + '/fake/reset')
+    api_client.set_default_client(api_client.ApiClient())
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            if trace_memory:
+                tracemalloc.start()
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                func()
+            elapsed = time.perf_counter() - start
+
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+
+    stats = requests.get(base_url + '/fake/stats').json()
+
+    return elapsed, peak, stats
+
+
+def run_benchmarks(server_args):
+
+    base_url_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve_fake_api, args=(server_args, base_url_queue), daemon=True)
+    server_process.start()
+
+    home_dir = tempfile.TemporaryDirectory()
+    try:
+        base_url = base_url_queue.get()
+
+        # A new home directory for the project registry file (see get_scenarios). The scripts read
+        # the base URL and the access tokens from the environment when they run
+        os.environ['HOME'] = home_dir.name
+        os.environ[api_client.BASE_URL_ENV_VAR] = base_url
+        os.environ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'] = 'fake-account-token'
+        os.environ['ROLLBAR_PROJECT_READ_ACCESS_TOKEN'] = 'fake-project-token'
+
+        print('{:<26} {:>10} {:>7} {:>12} {:>12} {:>8} {:>8}'.format(
+            'script', 'wall_time', 'calls', 'bytes', 'peak_memory', '429s', '500s'))
+
+        for name, func in get_scenarios():
+            elapsed, _, stats = run_once(func, base_url, trace_memory=False)
+            _, peak, _ = run_once(func, base_url, trace_memory=True)
+
+            print('{:<26} {:>9.3f}s {:>7} {:>12} {:>10.1f}MB {:>8} {:>8}'.format(
+                name, elapsed, stats['request_count'], stats['bytes_sent'], peak / (1024 * 1024),
+                stats['rate_limited_count'], stats['error_count']))
+    finally:
+        server_process.terminate()
+        home_dir.cleanup()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Measure the scripts against a local fake Rollbar API')
+    parser.add_argument('--projects', type=int, default=20, help='The number of projects in the account')
+    parser.add_argument('--rows', type=int, default=200, help='The number of metrics rows in each response')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The fraction of calls that get HTTP 500')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Calls allowed per token in each window')
+    parser.add_argument('--rate-limit-window', type=int, default=1, help='Seconds in each rate limit window')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the injected errors')
+    args = parser.parse_args()
+
+    run_benchmarks({'project_count': args.projects,
+                    'rows_per_response': args.rows,
+                    'latency': args.latency,
+                    'error_rate': args.error_rate,
+                    'rate_limit': args.rate_limit,
+                    'rate_limit_window': args.rate_limit_window,
+                    'seed': args.seed})
@@ -0,0 +1,84 @@
+"""
+Use this script to compare the peak memory of get_item_metrics with and without streaming to a sink
+
+Both runs get the same Item metrics from a local fake Rollbar API and write them to a CSV file.
+The fake API runs in a separate process and the peak memory of this process is measured
+with tracemalloc. Install ijson (pip3 install ijson) for the streaming run
+
+Usage:
+python3 bench_streaming.py [rows_per_response]
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import metrics_base as mb
+import response_decoder
+from api_client import ApiClient
+from fake_rollbar_api import FakeRollbarApi
+from sinks import open_sink
+
+
+START_TIME_UNIX = 1662033600
+END_TIME_UNIX = START_TIME_UNIX + 24 * 60 * 60
+
+
+def run_without_streaming(proj, client, path):
+
+    item_metrics_list = mb.get_item_metrics(proj, START_TIME_UNIX, END_TIME_UNIX, client=client)
+
+    with open_sink(path, mb.ItemMetrics.CSV_COLUMNS) as sink:
+        for im in item_metrics_list:
+            sink.write_row(im.get_csv_row())
+
+
+def run_with_streaming(proj, client, path):
+
+    with open_sink(path, mb.ItemMetrics.CSV_COLUMNS) as sink:
+        mb.get_item_metrics(proj, START_TIME_UNIX, END_TIME_UNIX, client=client, sink=sink)
+
+
+def serve_fake_api(rows_per_response, base_url_queue):
+
+    server = FakeRollbarApi(project_count=1, rows_per_response=rows_per_response)
+    base_url_queue.put(server.base_url)
+    server.serve_forever()
+
+
+def measure(name, func, proj, client, path):
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(proj, client, path)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print('{:<10} output={:<10} peak_memory={:.1f}MB wall_time={:.3f}s'.format(
+        name, os.path.getsize(path), peak / (1024 * 1024), elapsed))
+
+
+if __name__ == "__main__":
+
+    rows_per_response = 100000
+    if len(sys.argv) > 1:
+        rows_per_response = int(sys.argv[1])
+
+    print('ijson={}'.format(response_decoder.get_ijson() is not None))
+
+    base_url_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve_fake_api, args=(rows_per_response, base_url_queue),
+                                             daemon=True)
+    server_process.start()
+    try:
+        with ApiClient(base_url=base_url_queue.get()) as client, tempfile.TemporaryDirectory() as tmp_dir:
+            proj = mb.get_project_objects('account-token', ['read'], client=client)[0]
+
+            measure('no stream', run_without_streaming, proj, client, os.path.join(tmp_dir, 'list.csv'))
+            measure('stream', run_with_streaming, proj, client, os.path.join(tmp_dir, 'stream.csv'))
+    finally:
+        server_process.terminate()
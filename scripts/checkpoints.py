@@ -0,0 +1,85 @@
+"""
+A local store of the last time window collected for each project and query type
+
+Scripts that run every day can use the checkpoints to only query the time since the last
+successful run, and a run that was interrupted continues from the last project it finished.
+
+Usage:
+
+checkpoints = CheckpointStore('rollbar_checkpoints.json')
+start_time = checkpoints.get_end_time(proj.id, 'items_by_env')
+...
+checkpoints.set_end_time(proj.id, 'items_by_env', end_time)
+"""
+
+import json
+import logging
+import os
+
+
+DEFAULT_CHECKPOINT_FILE = 'rollbar_checkpoints.json'
+
+
+class CheckpointStore:
+    """
+    A class that stores the last collected end_time for each project and query type in a JSON file
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT_FILE):
+
+        self.path = path
+        self.checkpoints = self.load()
+
+    def load(self):
+
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception as ex:
+            logging.error('Error reading checkpoint file %s', self.path, exc_info=ex)
+            return {}
+
+    def save(self):
+        #
+        # Write a new file and then replace the old one so an interrupted run never leaves a partial file
+        #
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoints, f, indent=2, sort_keys=True)
+
+        os.replace(tmp_path, self.path)
+
+    def get_end_time(self, project_id, query_type):
+        """
+        Returns the end_time of the last collected window, or None if nothing was collected yet
+        """
+
+        return self.checkpoints.get(get_checkpoint_key(project_id, query_type))
+
+    def set_end_time(self, project_id, query_type, end_time_unix):
+        """
+        Use this method to record that the window up to end_time_unix was collected.
+        The checkpoint is saved straight away
+        """
+
+        self.checkpoints[get_checkpoint_key(project_id, query_type)] = end_time_unix
+        self.save()
+
+    def get_start_time(self, project_id, query_type, default_start_time_unix):
+        """
+        Returns the start of the next window to collect for a project
+        """
+
+        end_time = self.get_end_time(project_id, query_type)
+        if end_time is None or end_time < default_start_time_unix:
+            return default_start_time_unix
+
+        return end_time
+
+
+def get_checkpoint_key(project_id, query_type):
+    return '{}:{}'.format(query_type, project_id)
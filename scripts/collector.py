@@ -0,0 +1,402 @@
+"""
+Use this script to collect occurrence counts by environment and level for all Rollbar Projects
+in an account continuously, instead of once a day from cron
+
+Usage:
+python3 collector.py
+python3 collector.py --interval-minutes 10 --workers 4 --output collected_occurrences.jsonl
+python3 collector.py --once
+
+Each project is polled on its own schedule. The first poll of a project is at a random time in
+the first interval, and every later poll is one interval (plus or minus --jitter) after the last
+one finished, so the Metrics API queries are spread out over the interval instead of all being
+sent at the same minute. At most --workers queries are in flight at the same time.
+
+Each poll only queries the window since the end of the last successful poll of the project.
+The end time of each project is stored in a checkpoint file, so a restarted collector continues
+where it stopped (up to --lookback-minutes back). A failed poll is retried at the next poll
+with the window of both polls.
+
+The project list and read tokens are discovered again every --refresh-projects-minutes, and the
+HTTP connections to the API are kept open between polls.
+
+The rows (the same columns as get_occurrences_by_env.py) are appended to the output file and
+flushed after every poll. The collector stops after the polls in flight finish on Ctrl+C or SIGTERM.
+
+Use --once to poll every project once and exit e.g. to run the collector from cron
+
+Requirements:
+1.
+The following environment variable needs to be set
+ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS - An account level token with Read scope
+Example:
+export ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS=**********
+
+"""
+
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import heapq
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+import instrumentation
+import metrics_base as mb
+from api_client import get_default_client
+from checkpoints import CheckpointStore
+from get_occurrences_by_env import get_items_by_env_query
+from project_registry import open_project_registry
+from sinks import open_sink
+
+
+# The environment variable with the account read token. It is read when the script runs
+ACCOUNT_READ_TOKEN_ENV_VAR = 'ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'
+
+ALLOWED_PROJECT_TOKEN_NAMES = ['metrics_api_token', 'read']
+
+OUTPUT_FILE = 'collected_occurrences_by_env.csv'
+
+CHECKPOINT_FILE = 'collector_checkpoints.json'
+CHECKPOINT_QUERY_TYPE = 'collector_items_by_env'
+
+DEFAULT_INTERVAL_SECONDS = 5 * 60
+
+# Each interval is a random fraction longer or shorter than the interval, up to this fraction
+DEFAULT_JITTER = 0.1
+
+# The maximum number of Metrics API queries in flight at the same time
+DEFAULT_WORKERS = 4
+
+# How far back the first poll of a project looks, and the longest window a poll queries
+DEFAULT_LOOKBACK_SECONDS = 60 * 60
+
+DEFAULT_PROJECT_REFRESH_SECONDS = 60 * 60
+
+# Occurrences of the last minute may not be counted yet, so the window ends this long before now
+DEFAULT_END_DELAY_SECONDS = 60
+
+
+class Collector:
+    """
+    A class that polls each project on its own jittered schedule and writes the new rows to a sink
+
+    Arguments:
+    account_read_token - An account level access token with Read scope
+    sink - A sink from sinks.open_sink, opened with mb.OCCURRENCE_CSV_COLUMNS
+    interval_seconds - The time between the polls of a project
+    jitter - Each interval is up to this fraction longer or shorter, e.g. 0.1 for 10%
+    max_workers - The maximum number of Metrics API queries in flight at the same time
+    lookback_seconds - How far back the first poll of a project looks
+    checkpoints - An optional CheckpointStore with the end time of the last poll of each project
+    client - An optional ApiClient. The shared client is used if this is not set
+    registry - An optional ProjectRegistry used for the first project list
+    project_refresh_seconds - The time between discoveries of the project list and read tokens
+    end_delay_seconds - Each window ends this long before the time of the poll
+    """
+
+    def __init__(self, account_read_token, sink, interval_seconds=DEFAULT_INTERVAL_SECONDS, jitter=DEFAULT_JITTER,
+                 max_workers=DEFAULT_WORKERS, lookback_seconds=DEFAULT_LOOKBACK_SECONDS, checkpoints=None,
+                 client=None, registry=None, project_refresh_seconds=DEFAULT_PROJECT_REFRESH_SECONDS,
+                 end_delay_seconds=DEFAULT_END_DELAY_SECONDS):
+
+        if not 0 <= jitter < 1:
+            raise ValueError('jitter must be at least 0 and less than 1')
+
+        self.account_read_token = account_read_token
+        self.sink = sink
+        self.interval_seconds = interval_seconds
+        self.jitter = jitter
+        self.max_workers = max_workers
+        self.lookback_seconds = lookback_seconds
+        self.checkpoints = checkpoints
+        self.client = client
+        self.registry = registry
+        self.project_refresh_seconds = project_refresh_seconds
+        self.end_delay_seconds = end_delay_seconds
+
+        # project id -> Project
+        self.projects = {}
+
+        # A heap of (next poll time, project id). A project is not in the heap while it is polled
+        self.schedule = []
+        self.in_flight = 0
+
+        # Guards projects, schedule and stats. The condition wakes the scheduler when a poll
+        # finishes or the collector is stopped
+        self.condition = threading.Condition()
+        self.stopped = False
+
+        # Guards the sink and the checkpoints, which are written from the worker threads
+        self.write_lock = threading.Lock()
+
+        self.stats = {'polls': 0, 'failed_polls': 0, 'rows': 0}
+
+    def run(self, once=False):
+        """
+        Use this method to poll the projects until stop is called
+
+        Arguments:
+        once - If True every project is polled once and the method returns
+        """
+
+        if self.client is None:
+            self.client = get_default_client()
+
+        self.refresh_projects(first=True)
+        if once:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(self.poll_project, list(self.projects.values())))
+            self.log_stats()
+            return
+
+        next_refresh_time = time.time() + self.project_refresh_seconds
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                if time.time() >= next_refresh_time:
+                    self.refresh_projects()
+                    self.log_stats()
+                    next_refresh_time = time.time() + self.project_refresh_seconds
+
+                with self.condition:
+                    if self.stopped:
+                        break
+
+                    due_projects = self.pop_due_projects(time.time())
+                    if len(due_projects) == 0:
+                        next_time = next_refresh_time
+                        if len(self.schedule) > 0 and self.in_flight < self.max_workers:
+                            next_time = min(next_time, self.schedule[0][0])
+                        self.condition.wait(max(0, next_time - time.time()))
+                        continue
+
+                for proj in due_projects:
+                    executor.submit(self.poll_and_reschedule, proj)
+
+        self.log_stats()
+
+    def stop(self):
+        """
+        Use this method to stop the collector. Polls in flight are finished and written before run returns
+        """
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def pop_due_projects(self, now):
+        #
+        # Called with the condition held. Returns the projects whose next poll time has passed, up to
+        # the number of free workers. The others stay in the schedule, in order, until a poll finishes
+        #
+
+        due_projects = []
+        while len(self.schedule) > 0 and self.schedule[0][0] <= now and self.in_flight < self.max_workers:
+            next_time, proj_id = heapq.heappop(self.schedule)
+            proj = self.projects.get(proj_id)
+            # Projects that were removed by a refresh are dropped from the schedule here
+            if proj is not None:
+                due_projects.append(proj)
+                self.in_flight += 1
+
+        return due_projects
+
+    def refresh_projects(self, first=False):
+        #
+        # The first list comes from the project registry if it is fresh. Later lists are always
+        # discovered again, so new projects and new tokens are picked up
+        #
+
+        proj_list = mb.rediscover_project_objects(self.account_read_token, ALLOWED_PROJECT_TOKEN_NAMES,
+                                                  len(self.projects), refresh=not first, client=self.client,
+                                                  registry=self.registry)
+        if proj_list is None:
+            return
+
+        projects = {proj.id: proj for proj in proj_list}
+
+        now = time.time()
+        with self.condition:
+            scheduled_ids = {proj_id for next_time, proj_id in self.schedule}
+            polled_ids = set(self.projects) - scheduled_ids
+
+            new_ids = [proj_id for proj_id in projects if proj_id not in self.projects]
+            for proj_id in new_ids:
+                # The first polls are spread over one interval
+                heapq.heappush(self.schedule, (now + random.uniform(0, self.interval_seconds), proj_id))
+
+            removed_count = len(set(self.projects) - set(projects))
+
+            # Projects that are being polled are rescheduled when their poll finishes
+            self.projects = projects
+            self.schedule = [(next_time, proj_id) for next_time, proj_id in self.schedule
+                             if proj_id in projects]
+            heapq.heapify(self.schedule)
+            self.condition.notify_all()
+
+        logging.info('Collecting %s projects (%s new, %s removed, %s being polled)',
+                     len(projects), len(new_ids), removed_count, len(polled_ids & set(projects)))
+
+    def poll_and_reschedule(self, proj):
+
+        try:
+            self.poll_project(proj)
+        finally:
+            next_time = time.time() + self.get_interval()
+            with self.condition:
+                self.in_flight -= 1
+                if proj.id in self.projects:
+                    heapq.heappush(self.schedule, (next_time, proj.id))
+                self.condition.notify_all()
+
+    def poll_project(self, proj):
+        """
+        Use this method to query the window since the last poll of a project and write the rows
+
+        Arguments:
+        proj - A Project object (Requires name and token properties to be set)
+
+        Returns:
+        True if the window was collected (or there was no new window), False if the query failed
+        """
+
+        start_time_unix, end_time_unix = self.get_window(proj)
+        if start_time_unix >= end_time_unix:
+            return True
+
+        query_data = get_items_by_env_query(start_time_unix, end_time_unix)
+        result = mb.make_occ_metrics_api_call(proj, query_data, self.client)
+
+        if result is None:
+            with self.condition:
+                self.stats['polls'] += 1
+                self.stats['failed_polls'] += 1
+            return False
+
+        try:
+            rows = mb.get_occurrence_rows(proj, result,
+                                          datetime.datetime.fromtimestamp(start_time_unix).strftime('%c'),
+                                          datetime.datetime.fromtimestamp(end_time_unix).strftime('%c'))
+
+            with self.write_lock, instrumentation.stage('write', proj.name) as event:
+                self.sink.write_rows(rows)
+                self.sink.flush()
+                event.row_count = len(rows)
+
+                # The checkpoint only moves once the rows are on disk
+                if self.checkpoints is not None:
+                    self.checkpoints.set_end_time(proj.id, CHECKPOINT_QUERY_TYPE, end_time_unix)
+        except Exception as ex:
+            msg = 'Exception writing the collected metrics for {}'.format(proj.name)
+            logging.exception(msg, exc_info=ex)
+            with self.condition:
+                self.stats['polls'] += 1
+                self.stats['failed_polls'] += 1
+            return False
+
+        with self.condition:
+            self.stats['polls'] += 1
+            self.stats['rows'] += len(rows)
+
+        return True
+
+    def get_window(self, proj):
+        #
+        # The window starts at the end of the last successful poll and ends on a whole minute,
+        # end_delay_seconds before now
+        #
+
+        end_time_unix = int(time.time()) - self.end_delay_seconds
+        end_time_unix -= end_time_unix % 60
+
+        default_start_time_unix = end_time_unix - self.lookback_seconds
+        if self.checkpoints is None:
+            return default_start_time_unix, end_time_unix
+
+        with self.write_lock:
+            start_time_unix = self.checkpoints.get_start_time(proj.id, CHECKPOINT_QUERY_TYPE,
+                                                              default_start_time_unix)
+
+        return start_time_unix, end_time_unix
+
+    def get_interval(self):
+        return self.interval_seconds * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of polls, failed polls and rows written so far
+        """
+
+        with self.condition:
+            return dict(self.stats)
+
+    def log_stats(self):
+
+        stats = self.get_stats()
+        logging.info('Collector polls={} failed_polls={} rows={} projects={}'.format(
+            stats['polls'], stats['failed_polls'], stats['rows'], len(self.projects)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Collect occurrence counts by environment for all projects '
+                                                 'continuously')
+    parser.add_argument('--interval-minutes', type=float, default=DEFAULT_INTERVAL_SECONDS / 60,
+                        help='The time between the polls of each project')
+    parser.add_argument('--jitter', type=float, default=DEFAULT_JITTER,
+                        help='Each interval is up to this fraction longer or shorter e.g. 0.1 for 10 percent')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='The maximum number of Metrics API queries in flight at the same time')
+    parser.add_argument('--lookback-minutes', type=float, default=DEFAULT_LOOKBACK_SECONDS / 60,
+                        help='How far back the first poll of a project looks')
+    parser.add_argument('--output', default=OUTPUT_FILE,
+                        help='The file the rows are appended to')
+    parser.add_argument('--output-format', choices=['csv', 'jsonl'], default=None,
+                        help='The format of the output file. It is chosen from the file extension if not set')
+    parser.add_argument('--checkpoints', default=CHECKPOINT_FILE,
+                        help='The file with the end time of the last poll of each project')
+    parser.add_argument('--refresh-projects-minutes', type=float, default=DEFAULT_PROJECT_REFRESH_SECONDS / 60,
+                        help='The time between discoveries of the projects and read tokens')
+    parser.add_argument('--once', action='store_true',
+                        help='Poll every project once and exit')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each stage and the slowest projects when the collector stops')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                    format='%(process)d-%(levelname)s-%(message)s',
+                    handlers=[logging.StreamHandler()]
+                    )
+
+    if args.profile:
+        profiler = instrumentation.start_profiler()
+
+    sink = open_sink(args.output, mb.OCCURRENCE_CSV_COLUMNS, args.output_format, append=True)
+
+    collector = Collector(os.environ[ACCOUNT_READ_TOKEN_ENV_VAR], sink,
+                          interval_seconds=args.interval_minutes * 60,
+                          jitter=args.jitter,
+                          max_workers=args.workers,
+                          lookback_seconds=args.lookback_minutes * 60,
+                          checkpoints=CheckpointStore(args.checkpoints),
+                          registry=open_project_registry(),
+                          project_refresh_seconds=args.refresh_projects_minutes * 60)
+
+    # Ctrl+C and SIGTERM finish the polls in flight instead of leaving a partial window
+    signal.signal(signal.SIGINT, lambda signum, frame: collector.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: collector.stop())
+
+    try:
+        collector.run(args.once)
+    finally:
+        sink.close()
+
+    if args.profile:
+        profiler.stop()
+        profiler.print_summary()
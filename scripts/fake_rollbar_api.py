@@ -0,0 +1,419 @@
+"""
+A local stand-in for the Rollbar API that can be used to measure the scripts without
+calling api.rollbar.com
+
+It implements the endpoints used by metrics_base:
+/api/1/projects
+/api/1/project/{id}/access_tokens
+/api/1/metrics/occurrences
+/api/1/item/{id}
+
+The server counts the TCP connections and requests it receives and the response bytes it sends.
+The counters are also returned by GET /fake/stats and reset by POST /fake/reset, for a server
+running in another process.
+
+With rate_limit set, each access token is allowed rate_limit calls in each rate_limit_window
+seconds. Calls over the limit get HTTP 429, and every response has the X-Rate-Limit-* headers
+that the Rollbar API sends. latency adds a delay (seconds) to every response.
+error_rate is the fraction of API calls that get HTTP 500.
+
+Metrics API queries with a granularity ('hour' or 'day') get a timepoint for each hour or day.
+Rows that do not match the 'eq' filters of a query are left out.
+
+With max_query_rows set, a Metrics API query with more rows than that (over all its timepoints) gets
+HTTP 422, like a query that is too large. With truncate_rows set as well, the rows are cut at
+max_query_rows instead.
+
+Usage:
+python3 fake_rollbar_api.py --port 8000 --projects 50 --rows 200 --latency 0.05 --error-rate 0.01
+
+export ROLLBAR_API_BASE_URL=http://127.0.0.1:8000
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Seconds in each timepoint for the Metrics API granularity values
+GRANULARITY_SECONDS = {'hour': 60 * 60, 'day': 24 * 60 * 60}
+
+
+class FakeRollbarApiHandler(BaseHTTPRequestHandler):
+
+    # HTTP/1.1 keeps the connection open between requests
+    protocol_version = 'HTTP/1.1'
+
+    # Avoid delayed ACK stalls on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.add_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+
+        if self.path == '/fake/stats':
+            self.send_json(200, self.server.get_stats())
+            return
+
+        self.server.add_request()
+
+        if not self.check_rate_limit():
+            return
+
+        if self.path == '/api/1/projects':
+            self.send_result(self.server.get_projects())
+            return
+
+        match = re.match(r'^/api/1/project/(\d+)/access_tokens$', self.path)
+        if match:
+            token_list = self.server.get_access_tokens(int(match.group(1)))
+            if token_list is None:
+                self.send_json(403, {'err': 1, 'message': 'Forbidden'})
+            else:
+                self.send_result(token_list)
+            return
+
+        match = re.match(r'^/api/1/item/(\d+)$', self.path)
+        if match:
+            self.send_result(self.server.get_item(int(match.group(1))))
+            return
+
+        self.send_json(404, {'err': 1, 'message': 'Not found'})
+
+    def do_POST(self):
+
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+
+        if self.path == '/fake/reset':
+            self.server.reset_counters()
+            self.send_json(200, self.server.get_stats())
+            return
+
+        self.server.add_request()
+
+        if not self.check_rate_limit():
+            return
+
+        if self.path == '/api/1/metrics/occurrences':
+            query_data = json.loads(body)
+            result = self.server.get_occurrence_metrics(query_data)
+            if result is None:
+                self.send_json(422, {'err': 1, 'message': 'Query result is too large'})
+                return
+
+            self.send_result(result)
+            return
+
+        self.send_json(404, {'err': 1, 'message': 'Not found'})
+
+    def check_rate_limit(self):
+        #
+        # Add the latency and send a 429 if the access token is over its rate limit,
+        # or a 500 for the injected errors
+        #
+
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        allowed, self.rate_limit_headers = self.server.use_rate_limit(self.headers.get('X-Rollbar-Access-Token'))
+        if not allowed:
+            self.send_json(429, {'err': 1, 'message': 'Rate limit exceeded'})
+            return False
+
+        if self.server.inject_error():
+            self.send_json(500, {'err': 1, 'message': 'Injected error'})
+            return False
+
+        return True
+
+    def send_result(self, result):
+        self.send_json(200, {'err': 0, 'result': result})
+
+    def send_json(self, status_code, dct):
+        body = json.dumps(dct).encode('utf-8')
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in getattr(self, 'rate_limit_headers', {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.add_bytes_sent(len(body))
+
+
+class FakeRollbarApi(ThreadingHTTPServer):
+    """
+    A threaded HTTP server that returns generated Rollbar API responses
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, project_count=10, rows_per_response=20, rate_limit=None,
+                 rate_limit_window=60, latency=0.0, error_rate=0.0, seed=None, max_query_rows=None,
+                 truncate_rows=False):
+
+        super().__init__(('127.0.0.1', port), FakeRollbarApiHandler)
+
+        self.project_count = project_count
+        self.rows_per_response = rows_per_response
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.max_query_rows = max_query_rows
+        self.truncate_rows = truncate_rows
+
+        self.connection_count = 0
+        self.request_count = 0
+        self.rate_limited_count = 0
+        self.error_count = 0
+        self.bytes_sent = 0
+        self.counter_lock = threading.Lock()
+
+        # The start time and number of calls of the current rate limit window of each access token
+        self.rate_limit_windows = {}
+
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_address[1])
+
+    def add_connection(self):
+        with self.counter_lock:
+            self.connection_count += 1
+
+    def add_request(self):
+        with self.counter_lock:
+            self.request_count += 1
+
+    def add_bytes_sent(self, byte_count):
+        with self.counter_lock:
+            self.bytes_sent += byte_count
+
+    def inject_error(self):
+        """
+        Returns True if this call should get an injected HTTP 500
+        """
+
+        if self.error_rate <= 0:
+            return False
+
+        with self.counter_lock:
+            if self.random.random() >= self.error_rate:
+                return False
+
+            self.error_count += 1
+            return True
+
+    def reset_counters(self):
+        with self.counter_lock:
+            self.connection_count = 0
+            self.request_count = 0
+            self.rate_limited_count = 0
+            self.error_count = 0
+            self.bytes_sent = 0
+            self.rate_limit_windows = {}
+
+    def get_stats(self):
+        with self.counter_lock:
+            return {'connection_count': self.connection_count,
+                    'request_count': self.request_count,
+                    'rate_limited_count': self.rate_limited_count,
+                    'error_count': self.error_count,
+                    'bytes_sent': self.bytes_sent}
+
+    def use_rate_limit(self, access_token):
+        """
+        Counts a call for access_token
+
+        Returns:
+        A tuple of (True if the call is allowed, a dict of rate limit headers)
+        """
+
+        if self.rate_limit is None:
+            return True, {}
+
+        with self.counter_lock:
+            now = time.time()
+            window_start, call_count = self.rate_limit_windows.get(access_token, (now, 0))
+            if now >= window_start + self.rate_limit_window:
+                window_start, call_count = now, 0
+
+            allowed = call_count < self.rate_limit
+            if allowed:
+                call_count += 1
+            else:
+                self.rate_limited_count += 1
+
+            self.rate_limit_windows[access_token] = (window_start, call_count)
+
+        reset_time = window_start + self.rate_limit_window
+        headers = {'X-Rate-Limit-Limit': str(self.rate_limit),
+                   'X-Rate-Limit-Remaining': str(self.rate_limit - call_count),
+                   'X-Rate-Limit-Reset': str(math.ceil(reset_time)),
+                   'X-Rate-Limit-Remaining-Seconds': str(math.ceil(reset_time - now))}
+
+        return allowed, headers
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def get_projects(self):
+        return [{'id': proj_id, 'name': 'project-{}'.format(proj_id), 'status': 'enabled'}
+                for proj_id in range(1, self.project_count + 1)]
+
+    def get_access_tokens(self, proj_id):
+        # Returning None sends HTTP 403, like a project the account token can not read
+        return [{'name': 'read', 'scopes': ['read'], 'access_token': 'token-{}'.format(proj_id)}]
+
+    def get_item(self, item_id):
+        return {'id': item_id, 'assigned_user_id': item_id % 7 or None}
+
+    def get_occurrence_metrics(self, query_data):
+        """
+        Returns the result of a Metrics API query, or None if it has more than max_query_rows rows
+        """
+
+        result = self.get_occurrence_timepoints(query_data)
+        if self.max_query_rows is None:
+            return result
+
+        row_count = sum(len(timepoint['metrics_rows']) for timepoint in result['timepoints'])
+        if row_count <= self.max_query_rows:
+            return result
+
+        if not self.truncate_rows:
+            return None
+
+        remaining = self.max_query_rows
+        for timepoint in result['timepoints']:
+            timepoint['metrics_rows'] = timepoint['metrics_rows'][:remaining]
+            remaining -= len(timepoint['metrics_rows'])
+
+        return result
+
+    def get_occurrence_timepoints(self, query_data):
+
+        granularity_seconds = GRANULARITY_SECONDS.get(query_data.get('granularity'))
+        if granularity_seconds is None:
+            metrics_rows = self.get_metrics_rows(query_data, query_data['start_time'], query_data['end_time'])
+            return {'timepoints': [{'timestamp': query_data['start_time'], 'metrics_rows': metrics_rows}]}
+
+        # A timepoint for each hour (or day), starting at the hour (or day) that has the start time
+        timepoints = []
+        timestamp = query_data['start_time'] - query_data['start_time'] % granularity_seconds
+        while timestamp < query_data['end_time']:
+            window_start = max(timestamp, query_data['start_time'])
+            window_end = min(timestamp + granularity_seconds, query_data['end_time'])
+            timepoints.append({'timestamp': timestamp,
+                               'metrics_rows': self.get_metrics_rows(query_data, window_start, window_end)})
+            timestamp += granularity_seconds
+
+        return {'timepoints': timepoints}
+
+    def get_metrics_rows(self, query_data, start_time, end_time):
+
+        # Occurrence counts grow with the length of the time window, so the counts
+        # of consecutive windows add up to the count of the whole window
+        window_minutes = (end_time - start_time) // 60
+
+        filters = [query_filter for query_filter in query_data.get('filters', [])
+                   if query_filter.get('operator', 'eq') == 'eq']
+
+        # Generated rows with the same group_by values are added up into one row, like the API does
+        rows_by_key = {}
+        for row_number in range(self.rows_per_response):
+            if not all(get_fake_value(query_filter['field'], row_number) in query_filter['values']
+                       for query_filter in filters):
+                continue
+
+            key = tuple(get_fake_value(field, row_number) for field in query_data.get('group_by', []))
+            occurrence_count = (row_number + 1) * window_minutes
+
+            row = rows_by_key.get(key)
+            if row is not None:
+                row[len(key)]['value'] += occurrence_count
+                for cell in row[len(key) + 1:]:
+                    cell['value'] = max(cell['value'], row_number % 5)
+                continue
+
+            row = [{'field': field, 'value': value} for field, value in zip(query_data.get('group_by', []), key)]
+            row.append({'field': 'occurrence_count', 'value': occurrence_count})
+            for aggregate in query_data.get('aggregates', []):
+                row.append({'field': aggregate['alias'], 'value': row_number % 5})
+
+            rows_by_key[key] = row
+
+        return list(rows_by_key.values())
+
+
+def get_fake_value(field, row_number):
+    """
+    Returns a value for a group_by field of a generated metrics row
+    """
+
+    if field == 'environment':
+        return ['production', 'staging', 'qa'][row_number % 3]
+
+    if field == 'item_level':
+        return ['critical', 'error', 'warning', 'info', 'debug'][row_number % 5]
+
+    if field == 'item_status':
+        return ['active', 'resolved', 'mute'][row_number % 3]
+
+    # Each item appears in 3 consecutive rows, one for each environment
+    if field == 'item_id':
+        return 1000 + row_number // 3
+
+    if field == 'item_counter':
+        return row_number // 3 + 1
+
+    if field == 'item_title':
+        return 'Error number {}'.format(row_number // 3)
+
+    return '{}-{}'.format(field, row_number)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the Rollbar API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--projects', type=int, default=10, help='The number of projects in the account')
+    parser.add_argument('--rows', type=int, default=20, help='The number of metrics rows in each response')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The fraction of calls that get HTTP 500')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Calls allowed per token in each window')
+    parser.add_argument('--rate-limit-window', type=int, default=60, help='Seconds in each rate limit window')
+    parser.add_argument('--max-query-rows', type=int, default=None,
+                        help='Metrics API queries with more rows than this get HTTP 422')
+    parser.add_argument('--truncate-rows', action='store_true',
+                        help='Cut the rows of queries at --max-query-rows instead of sending HTTP 422')
+    args = parser.parse_args()
+
+    server = FakeRollbarApi(port=args.port, project_count=args.projects, rows_per_response=args.rows,
+                            rate_limit=args.rate_limit, rate_limit_window=args.rate_limit_window,
+                            latency=args.latency, error_rate=args.error_rate, max_query_rows=args.max_query_rows,
+                            truncate_rows=args.truncate_rows)
+    print('Serving fake Rollbar API on {}'.format(server.base_url))
+    server.serve_forever()
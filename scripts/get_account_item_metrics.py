@@ -22,14 +22,14 @@ be a Read (ONLY) scope token with 1 of the following names
 ['read', 'metrics_api_token']
 
 """
-import json
 import logging
-import requests
 import os
 import datetime, time
 
+import metrics_base as mb
 from metrics_base import get_all_projects
 from metrics_base import add_read_token_to_projects
+from sinks import open_sink
 
 
 #
@@ -39,7 +39,9 @@ from metrics_base import add_read_token_to_projects
 # Execute these from a terminal to create an environment variable with you access tokem
 # export ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS=**********
 #
-ACCOUNT_READ_TOKEN = os.environ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS']
+# The token is read when the script runs, not when it is imported
+#
+ACCOUNT_READ_TOKEN_ENV_VAR = 'ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'
 
 #
 # We only look for project_access_tokens with these names
@@ -47,6 +49,8 @@ ACCOUNT_READ_TOKEN = os.environ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS']
 #
 ALLOWED_PROJECT_TOKEN_NAMES = ['read', 'metrics_api_token']
 
+OUTPUT_CSV_FILE = 'results.csv'
+
 
 def write_occurrence_metrics_to_csv(proj_list, start_unixtime, end_unixtime):
     #
@@ -54,93 +58,54 @@ def write_occurrence_metrics_to_csv(proj_list, start_unixtime, end_unixtime):
     # results.csv in the current working directory
     #
 
-    f = open('results.csv', 'w')
-    line = 'Name,Id,Environment,Level,OccurrenceCount,StartTime,EndTime\n'
-    f.write(line)
-    f.close()
-
-    proj: Project
-    for proj in proj_list:
-        result = make_occ_metrics_api_call(start_unixtime, end_unixtime, proj)
-        try:
-            process_result(proj, result, start_unixtime, end_unixtime)
-        except Exception as ex:
-            msg = 'Exception caclulating metrics for {}'.format(proj.name)
-            logging.exception(msg, exc_info=ex)
+    with open_sink(OUTPUT_CSV_FILE, mb.OCCURRENCE_CSV_COLUMNS) as sink:
+        proj: Project
+        for proj in proj_list:
+            result = make_occ_metrics_api_call(start_unixtime, end_unixtime, proj)
+            try:
+                process_result(proj, result, sink, start_unixtime, end_unixtime)
+            except Exception as ex:
+                msg = 'Exception caclulating metrics for {}'.format(proj.name)
+                logging.exception(msg, exc_info=ex)
 
 
-def process_result(proj, result, start_unixtime, end_unixtime):
+def process_result(proj, result, sink, start_unixtime, end_unixtime):
     #
-    # Write ccurrence data to results.csv for this project
+    # Write ccurrence data to the results.csv sink for this project
     #
-    
-    metric_rows = result['timepoints'][0]['metrics_rows']
-    
-    for row_group in metric_rows:
-        env = 'nothing'
-        item_level = 'nothing'
-        occ_count = 'nothing'
-        
-        for row in row_group:
-            if row['field'] == 'environment':
-                env = row['value']
 
-            if row['field'] == 'item_level':
-                item_level = row['value']
-
-            if row['field'] == 'occurrence_count':
-                occ_count = row['value']
-
-        line = '{},{},{},{},{},{},{}\n'
-        line = line.format(proj.name, proj.id, env, item_level,
-                           occ_count, int(start_unixtime), int(end_unixtime))
-
-        f = open('results.csv', 'a')
-        f.writelines([line])
-        f.close()
+    rows = mb.get_occurrence_rows(proj, result, int(start_unixtime), int(end_unixtime))
+    sink.write_rows(rows)
 
 
 def make_occ_metrics_api_call(start_time, end_time, proj):
     """
     Call Rollbar Metrics API. 
     """
-    try:
-        
-        url = 'https://api.rollbar.com/api/1/metrics/occurrences'
-        headers = {'X-Rollbar-Access-Token': proj.token, 'Content-Type': 'application/json'}
-
-        # Filter by environment and item_level
-        data = {
-            # epoch time in seconds
-            'start_time': start_time,
-            'end_time':  end_time,
-            'group_by': ['environment', 'item_level'],
-             'filters': [
-              {
-                'field': 'item_level',
-                'values': ['error', 'critical', 'warning', 'info'],
-                'operator': 'eq'
-              }
-              ]
-            }
-
-        # POST request
-        resp = requests.post(url, json=data, headers=headers)
-        log = '/api/1/metrics/occurrences proj={} status={}'.format(proj.name, resp.status_code)
-        logging.info(log)
-
-        result = json.loads(resp.text)['result']
-        return result
-
-    except Exception as ex:
-        msg = 'Error making request to Rollbar Metrics API project={}'.format(proj.name)
-        logging.error(msg, exc_info=ex)
-
-
-def create_csv_for_all_projects(start_unixtime, end_unixtime):
+
+    # Filter by environment and item_level
+    data = {
+        # epoch time in seconds
+        'start_time': start_time,
+        'end_time':  end_time,
+        'group_by': ['environment', 'item_level'],
+         'filters': [
+          {
+            'field': 'item_level',
+            'values': ['error', 'critical', 'warning', 'info'],
+            'operator': 'eq'
+          }
+          ]
+        }
+
+    # The shared ApiClient honours ROLLBAR_API_BASE_URL and retries rate limited calls
+    return mb.make_occ_metrics_api_call(proj, data)
+
+
+def create_csv_for_all_projects(account_read_token, start_unixtime, end_unixtime):
     
-    proj_list = get_all_projects(ACCOUNT_READ_TOKEN)
-    add_read_token_to_projects(proj_list, ACCOUNT_READ_TOKEN, ALLOWED_PROJECT_TOKEN_NAMES)
+    proj_list = get_all_projects(account_read_token)
+    add_read_token_to_projects(proj_list, account_read_token, ALLOWED_PROJECT_TOKEN_NAMES)
 
     write_occurrence_metrics_to_csv(proj_list, start_unixtime, end_unixtime)
 
@@ -158,7 +123,7 @@ if __name__ == "__main__":
     now_unix = time.mktime(now.timetuple())   
     last_day_unix = time.mktime(last_day.timetuple()) 
 
-    create_csv_for_all_projects(last_day_unix, now_unix)
+    create_csv_for_all_projects(os.environ[ACCOUNT_READ_TOKEN_ENV_VAR], last_day_unix, now_unix)
 
     
 
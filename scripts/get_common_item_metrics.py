@@ -3,6 +3,24 @@ Use this script to get common Item metrics for all single Rollbar Project for th
 
 Usage:
 python3 get_common_item_metrics.py
+python3 get_common_item_metrics.py --shard-days 1
+
+The --shard-days option splits the 60 day window into shards that are queried concurrently.
+Note: ip_address_count is an upper bound when the window is split
+
+Use --store PATH to also append the Item metrics to a local metrics store (see query_metrics_store.py)
+
+Query results are cached in a local query cache, so with --shard-days the shards that ended in
+the past are served from the cache on later runs. Use --no-query-cache to always call the Metrics API
+
+Use --stream for very large projects. The response is parsed one row at a time and each row is
+written straight to the CSV file, so memory use does not grow with the size of the response.
+Assigned users are not added in this mode and it can not be used with --shard-days or --store.
+Install ijson (pip3 install ijson) to get the memory savings
+
+If the Item metrics query fails because it is too large (e.g. a timeout or HTTP 422), it is split by
+level, environment and then time window into smaller queries that are merged (see query_planner.py).
+Use --no-query-planner to turn this off
 
 Output:
 A CSV file with the metrics
@@ -16,10 +34,10 @@ export ROLLBAR_PROJECT_READ_ACCESS_TOKEN=**********
 
 """
 
+import argparse
 import json
 import logging
 import math
-import requests
 import os
 
 import datetime, time
@@ -27,10 +45,17 @@ import datetime, time
 from metrics_base import Project
 from metrics_base import ItemMetrics
 import metrics_base as mb
+import instrumentation
 
 from metrics_base import get_all_projects
 from metrics_base import add_read_token_to_projects
 from metrics_base import get_item_metrics
+from aggregate_index import AggregateIndex
+from item_cache import ItemCache
+from query_cache import QueryCache
+from query_planner import QueryPlanner
+from metrics_store import MetricsStore
+from sinks import open_sink
 
 
 #
@@ -40,35 +65,46 @@ from metrics_base import get_item_metrics
 # Execute this command from a terminal to create an environment variable with your access tokem
 # export ROLLBAR_PROJECT_READ_ACCESS_TOKEN=**********
 #
-PROJECT_READ_TOKEN = os.environ['ROLLBAR_PROJECT_READ_ACCESS_TOKEN']
+# The token is read when the script runs, not when it is imported
+#
+PROJECT_READ_TOKEN_ENV_VAR = 'ROLLBAR_PROJECT_READ_ACCESS_TOKEN'
+
+# Assigned users are cached locally for 1 day so repeated runs skip most get item API calls
+ITEM_CACHE_FILE = 'rollbar_item_cache.sqlite3'
+ITEM_CACHE_TTL_SECONDS = 24 * 60 * 60
 
+OUTPUT_CSV_FILE = 'item_metrics.csv'
 
+QUERY_CACHE_FILE = 'rollbar_query_cache.sqlite3'
 
 
 
 
-def print_metric_aggregates(item_metrics_list, environment_list, level_list):
+
+
+def print_metric_aggregates(aggregates, environment_list, level_list):
     """
     Use this method to print some aggregation of metics data
 
     Arguments:
-    item_metrics_list - A list of ItemMetrics objects
+    aggregates - An AggregateIndex built once from the ItemMetrics list, or a list of ItemMetrics objects
     environment_list -  A list of environment names e.g. staging, production etc.
     level_list - A list of Item Levels  ['debug', 'info'. 'warning', 'error', 'critical'] 
     """
 
-    if len(item_metrics_list) == 0:
+    if not isinstance(aggregates, AggregateIndex):
+        aggregates = AggregateIndex.from_item_metrics(aggregates)
+
+    if len(aggregates) == 0:
         logging.info('The ItemMetrics list is empty')
         return
 
     # Print additional aggregations as needed
-    im: ItemMetrics
-    env_occs = sum(im.occurrence_count for im in item_metrics_list if im.environment in environment_list)
+    env_occs = aggregates.get_total(environments=environment_list)
     msg = 'Environments: {}, Levels: All, Occurrences: {}'.format(environment_list, env_occs)
     print(msg)
 
-    error_occs = sum(im.occurrence_count for im in item_metrics_list \
-                        if im.environment in environment_list and im.level in level_list)
+    error_occs = aggregates.get_total(environments=environment_list, levels=level_list)
 
     msg = 'Environments: {}, Levels: {}, Occurrences: {}'.format(environment_list, level_list, error_occs)
     print(msg)
@@ -79,23 +115,26 @@ def write_metrics_to_csv(item_metrics_list):
 
     im: ItemMetrics
 
-    line_list = []
-    line_list.append(ItemMetrics.get_csv_column_headers())
-    for im in item_metrics_list:
-        print(im)
-        line_list.append(im.get_csv_line())
-
-    output_csv_file = 'item_metrics.csv'
-    f = open(output_csv_file, 'w')
-    f.writelines(line_list)
-    f.close()
+    with open_sink(OUTPUT_CSV_FILE, ItemMetrics.CSV_COLUMNS) as sink:
+        for im in item_metrics_list:
+            print(im)
+            sink.write_row(im.get_csv_row())
 
 
 
-def process_single_project():
+def process_single_project(shard_seconds=None, store_file=None, stream=False, use_query_cache=True,
+                           project_read_token=None, use_query_planner=True):
     """
+    Use this method to write the Item metrics of the last 60 days to the CSV file
+
+    Arguments:
+    project_read_token - The project read token. ROLLBAR_PROJECT_READ_ACCESS_TOKEN is used if this is not set
+    use_query_planner - If True a query that is too large is split into smaller queries (see query_planner.py)
     """
 
+    if project_read_token is None:
+        project_read_token = os.environ[PROJECT_READ_TOKEN_ENV_VAR]
+
     final_time = datetime.datetime.now()
     # Get metrics for last x days
     start_time = final_time - datetime.timedelta(days=60)
@@ -105,28 +144,81 @@ def process_single_project():
     start_time_unix = math.floor(time.mktime(start_time.timetuple()))
 
     proj = Project()
-    proj.token = PROJECT_READ_TOKEN
+    proj.token = project_read_token
+
+    if stream:
+        with open_sink(OUTPUT_CSV_FILE, ItemMetrics.CSV_COLUMNS) as sink:
+            get_item_metrics(proj, start_time_unix, final_time_unix, sink=sink)
+
+        print('Finished')
+        return
+
+    query_cache = QueryCache(QUERY_CACHE_FILE) if use_query_cache else None
+    query_planner = QueryPlanner() if use_query_planner else None
 
-    
-    item_metrics_list = get_item_metrics(proj, start_time_unix, final_time_unix, add_assigned_users=True)
+    with ItemCache(ITEM_CACHE_FILE, ttl_seconds=ITEM_CACHE_TTL_SECONDS) as item_cache:
+        item_metrics_list = get_item_metrics(proj, start_time_unix, final_time_unix, add_assigned_users=True,
+                                             item_cache=item_cache, shard_seconds=shard_seconds,
+                                             query_cache=query_cache, query_planner=query_planner)
+        item_cache.log_stats()
+
+    if query_cache is not None:
+        query_cache.log_stats()
+        query_cache.close()
 
     write_metrics_to_csv(item_metrics_list)
 
+    if store_file is not None:
+        with MetricsStore(store_file) as store:
+            store.append_item_metrics(item_metrics_list)
+
     """
     print('')
     print('Additional metrics aggregations')
     print('')
-    print_metric_aggregates(item_metrics_list, ['production', 'qa'], ['error', 'critical'])
-    print_metric_aggregates(item_metrics_list, ['qa'], ['info'])
-    print_metric_aggregates(item_metrics_list, ['production'], ['info', 'debug'])
+    aggregates = AggregateIndex.from_item_metrics(item_metrics_list)
+    print_metric_aggregates(aggregates, ['production', 'qa'], ['error', 'critical'])
+    print_metric_aggregates(aggregates, ['qa'], ['info'])
+    print_metric_aggregates(aggregates, ['production'], ['info', 'debug'])
     """
 
     print('Finished')
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description='Get Item metrics for a single project')
+    parser.add_argument('--shard-days', type=int, default=None,
+                        help='Split the time window into shards of this many days that are queried concurrently')
+    parser.add_argument('--store', dest='store_file', default=None,
+                        help='Also append the Item metrics to this local metrics store file')
+    parser.add_argument('--stream', action='store_true',
+                        help='Write each Item metric to the CSV file as the response is parsed, without assigned users')
+    parser.add_argument('--no-query-cache', dest='use_query_cache', action='store_false',
+                        help='Always call the Metrics API instead of using cached results for past time windows')
+    parser.add_argument('--no-query-planner', dest='use_query_planner', action='store_false',
+                        help='Do not split the Item metrics query into smaller queries if it is too large')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each stage and the slowest projects at the end of the run')
+    args = parser.parse_args()
+
+    if args.stream and (args.shard_days is not None or args.store_file is not None):
+        parser.error('--stream can not be used with --shard-days or --store')
+
+    shard_seconds = None
+    if args.shard_days is not None:
+        shard_seconds = args.shard_days * 24 * 60 * 60
+
     logging.basicConfig(level=logging.INFO,
                     format='%(process)d-%(levelname)s-%(message)s',
                     handlers=[logging.StreamHandler()]
                     )
-    process_single_project()
+
+    if args.profile:
+        profiler = instrumentation.start_profiler()
+
+    process_single_project(shard_seconds, args.store_file, args.stream, args.use_query_cache,
+                           os.environ[PROJECT_READ_TOKEN_ENV_VAR], args.use_query_planner)
+
+    if args.profile:
+        profiler.stop()
+        profiler.print_summary()
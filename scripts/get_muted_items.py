@@ -20,7 +20,6 @@ export ROLLBAR_PROJECT_READ_ACCESS_TOKEN=**********
 import json
 import logging
 import math
-import requests
 import os
 
 import datetime, time
@@ -36,7 +35,9 @@ from metrics_base import Project
 # Execute this command from a terminal to create an environment variable with your access tokem
 # export ROLLBAR_PROJECT_READ_ACCESS_TOKEN=**********
 #
-PROJECT_READ_TOKEN = os.environ['ROLLBAR_PROJECT_READ_ACCESS_TOKEN']
+# The token is read when the script runs, not when it is imported
+#
+PROJECT_READ_TOKEN_ENV_VAR = 'ROLLBAR_PROJECT_READ_ACCESS_TOKEN'
 
                 
 
@@ -82,12 +83,12 @@ def get_muted_items_by_env(proj, starttime_unix, endtime_unix):
 
 
 
-def print_muted_items():
+def print_muted_items(project_read_token):
 
     starttime_unix, finaltime_unix = get_start_and_final_time() 
 
     proj = Project()
-    proj.token = PROJECT_READ_TOKEN
+    proj.token = project_read_token
     result = get_muted_items_by_env(proj, starttime_unix, finaltime_unix)
 
     print(result)
@@ -99,6 +100,6 @@ if __name__ == "__main__":
                     format='%(process)d-%(levelname)s-%(message)s',
                     handlers=[logging.StreamHandler()]
                     )
-    print_muted_items()
+    print_muted_items(os.environ[PROJECT_READ_TOKEN_ENV_VAR])
 
     
\ No newline at end of file
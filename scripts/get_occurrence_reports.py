@@ -0,0 +1,176 @@
+"""
+Use this script to get the occurrence reports of all Rollbar Projects in an account for the last 30 days
+from one Metrics API query per project
+
+Usage:
+python3 get_occurrence_reports.py
+python3 get_occurrence_reports.py --output-format jsonl
+
+get_occurrences_by_env.py and get_muted_items.py each send their own query grouped by environment,
+level and status. Those queries are rollups of the Item level query, so this script sends only the
+Item level query for each project and derives the reports from it (see rollup.py):
+
+occurrences_by_env_level_last_30_days.csv - Occurrence counts by environment and level, the same rows
+                                            as get_occurrences_by_env.py
+occurrences_by_env_level_status_last_30_days.csv - Occurrence counts by environment, level and status
+occurrences_by_muted_last_30_days.csv - Occurrence counts of muted items by environment and level, the same
+                                        rows as get_muted_items.py for each project
+
+Projects and their read tokens are stored in a local project registry for 1 day.
+Use --refresh-projects to discover the projects again
+
+Use --shard-days N to split the 30 day window into N day shards that are queried concurrently
+
+Query results are cached in a local query cache. Use --no-query-cache to always call the Metrics API
+
+Requirements:
+1.
+The following environment variable needs to be set
+ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS - An account level token with Read scope
+Example:
+export ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS=**********
+
+"""
+
+
+import argparse
+import datetime
+import logging
+import math
+import os
+import time
+
+import instrumentation
+import metrics_base as mb
+import rollup
+from project_registry import open_project_registry
+from query_cache import QueryCache
+from sinks import SINK_FORMATS, get_output_file_name, open_sink
+
+
+# The environment variable with the account read token. It is read when the script runs
+ACCOUNT_READ_TOKEN_ENV_VAR = 'ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'
+
+ALLOWED_PROJECT_TOKEN_NAMES = ['metrics_api_token', 'read']
+
+DAYS = 30
+
+# The output file of each view. {} is the view name
+OUTPUT_FILE_TEMPLATE = 'occurrences_by_{}_last_30_days.csv'
+
+QUERY_CACHE_FILE = 'rollbar_query_cache.sqlite3'
+
+
+def process_all(refresh_projects=False, shard_seconds=None, output_format='csv', use_query_cache=True,
+                account_read_token=None, views=rollup.DEFAULT_VIEWS):
+    """
+    Use this method to write a report for each view for all projects
+
+    Arguments:
+    account_read_token - The account read token. ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS is used if this is not set
+    views - The RollupView objects to write a report for
+    """
+
+    if account_read_token is None:
+        account_read_token = os.environ[ACCOUNT_READ_TOKEN_ENV_VAR]
+
+    registry = open_project_registry(refresh_projects)
+    projects = mb.get_project_objects(account_read_token, ALLOWED_PROJECT_TOKEN_NAMES, registry=registry)
+
+    starttime_unix, finaltime_unix = get_start_and_final_time()
+    starttime_str = datetime.datetime.fromtimestamp(starttime_unix).strftime('%c')
+    finaltime_str = datetime.datetime.fromtimestamp(finaltime_unix).strftime('%c')
+
+    view_sinks = {}
+    for view in views:
+        output_file = get_output_file_name(OUTPUT_FILE_TEMPLATE.format(view.name), output_format)
+        view_sinks[view.name] = open_sink(output_file, view.get_csv_columns(), output_format)
+
+    query_cache = QueryCache(QUERY_CACHE_FILE) if use_query_cache else None
+
+    try:
+        for proj in projects:
+            result = get_item_level_result(proj, starttime_unix, finaltime_unix, shard_seconds, query_cache)
+            if result is None:
+                continue
+
+            view_results = rollup.rollup_result(result, views, proj.name)
+            for view in views:
+                write_view_result(proj, view, view_results[view.name], view_sinks[view.name], starttime_str,
+                                  finaltime_str)
+    finally:
+        for sink in view_sinks.values():
+            sink.close()
+
+        if query_cache is not None:
+            query_cache.log_stats()
+            query_cache.close()
+
+
+def get_item_level_result(proj, starttime_unix, endtime_unix, shard_seconds=None, query_cache=None):
+
+    query_data = mb.get_item_metrics_query(starttime_unix, endtime_unix)
+    if shard_seconds is None:
+        result = mb.make_occ_metrics_api_call(proj, query_data, query_cache=query_cache)
+    else:
+        result = mb.make_sharded_occ_metrics_api_call(proj, query_data, shard_seconds, query_cache=query_cache)
+
+    return result
+
+
+def write_view_result(proj, view, view_result, sink, starttime_str, endtime_str):
+
+    try:
+        rows = rollup.get_rollup_rows(proj, view_result, view, starttime_str, endtime_str)
+        with instrumentation.stage('write', proj.name, view.name) as event:
+            sink.write_rows(rows)
+            event.row_count = len(rows)
+    except Exception as ex:
+        msg = 'Exception writing the {} report for {}'.format(view.name, proj.name)
+        logging.exception(msg, exc_info=ex)
+
+
+def get_start_and_final_time():
+
+    final_time = datetime.datetime.now()
+    start_time = final_time - datetime.timedelta(days=DAYS)
+
+    finaltime_unix = math.floor(time.mktime(final_time.timetuple()))
+    starttime_unix = math.floor(time.mktime(start_time.timetuple()))
+
+    return starttime_unix, finaltime_unix
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Get the occurrence reports for all projects from one query each')
+    parser.add_argument('--refresh-projects', action='store_true',
+                        help='Discover the projects and read tokens again instead of using the project registry')
+    parser.add_argument('--shard-days', type=int, default=None,
+                        help='Split the time window into shards of this many days that are queried concurrently')
+    parser.add_argument('--output-format', choices=SINK_FORMATS, default='csv',
+                        help='The format of the output files')
+    parser.add_argument('--no-query-cache', dest='use_query_cache', action='store_false',
+                        help='Always call the Metrics API instead of using cached results for past time windows')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each stage and the slowest projects at the end of the run')
+    args = parser.parse_args()
+
+    shard_seconds = None
+    if args.shard_days is not None:
+        shard_seconds = args.shard_days * 24 * 60 * 60
+
+    logging.basicConfig(level=logging.INFO,
+                    format='%(process)d-%(levelname)s-%(message)s',
+                    handlers=[logging.StreamHandler()]
+                    )
+
+    if args.profile:
+        profiler = instrumentation.start_profiler()
+
+    process_all(args.refresh_projects, shard_seconds, args.output_format, args.use_query_cache,
+                os.environ[ACCOUNT_READ_TOKEN_ENV_VAR])
+
+    if args.profile:
+        profiler.stop()
+        profiler.print_summary()
@@ -4,6 +4,28 @@ Occurrence counts are separated by environment
 
 Usage:
 python3 get_occurrences_by_env.py
+python3 get_occurrences_by_env.py --async
+
+The --async option queries all projects concurrently from a single asyncio event loop
+(requires the aiohttp package)
+
+Projects and their read tokens are stored in a local project registry for 1 day.
+Use --refresh-projects to discover the projects again
+
+Use --shard-days N to split the 30 day window into N day shards that are queried concurrently
+
+Use --incremental to only query the time since the last successful run for each project.
+The new rows are appended to the CSV file and the end time collected for each project is stored
+in a checkpoint file, so an interrupted run continues where it stopped
+
+Use --store PATH to also append the rows to a local metrics store (see query_metrics_store.py)
+
+Use --output-format jsonl or --output-format parquet to write JSON Lines or Parquet instead of CSV
+(Parquet requires the pyarrow package and can not be used with --incremental)
+
+Query results are cached in a local query cache. Windows that ended in the past (e.g. the older
+shards with --shard-days) are served from the cache on later runs. Use --no-query-cache to
+always call the Metrics API. Cache hits are logged at the end of the run
 
 Output:
 A CSV file with the metrics
@@ -18,16 +40,22 @@ export ROLLBAR_PROJECT_READ_ACCESS_TOKEN=**********
 """
 
 
+import argparse
 import json
 import logging
 import math
-import requests
 import os
 
 import datetime, time
 
+import instrumentation
 import metrics_base as mb
+from checkpoints import CheckpointStore
 from metrics_base import Project
+from metrics_store import MetricsStore
+from project_registry import open_project_registry
+from query_cache import QueryCache
+from sinks import SINK_FORMATS, get_output_file_name, open_sink
 
 
 
@@ -39,29 +67,185 @@ from metrics_base import Project
 # export ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS=MY_READ_SCOPE_ACCESS_TOKEN
 #
 
-def process_all():
+OUTPUT_CSV_FILE = 'occurrence_counts_by_proj_and_env_last_30_days.csv'
+
+ALLOWED_PROJECT_TOKEN_NAMES = ['metrics_api_token', 'read']
+
+CHECKPOINT_FILE = 'occurrence_counts_by_proj_and_env_checkpoints.json'
+CHECKPOINT_QUERY_TYPE = 'items_by_env'
+
+QUERY_CACHE_FILE = 'rollbar_query_cache.sqlite3'
+
+
+def process_all(refresh_projects=False, shard_seconds=None, incremental=False, store_file=None,
+                output_format='csv', use_query_cache=True):
 
  
     account_read_token = os.environ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'] 
-    allowed_proj_token_names = ['metrics_api_token', 'read']
 
-    projects = mb.get_project_objects(account_read_token, allowed_proj_token_names)
+    registry = open_project_registry(refresh_projects)
+    projects = mb.get_project_objects(account_read_token, ALLOWED_PROJECT_TOKEN_NAMES, registry=registry)
     # look at the last 30 days  
     starttime_unix, finaltime_unix = get_start_and_final_time()
 
-    output_csv_file = 'occurrence_counts_by_proj_and_env_last_30_days.csv'
+    output_csv_file = get_output_file_name(OUTPUT_CSV_FILE, output_format)
+    checkpoints = open_checkpoints(output_csv_file, incremental)
+    store = open_store(store_file)
+    query_cache = open_query_cache(use_query_cache)
+
+    try:
+        with open_sink(output_csv_file, mb.OCCURRENCE_CSV_COLUMNS, output_format, append=incremental) as sink:
+            for proj in projects:
+
+                proj_starttime_unix = get_project_start_time(proj, checkpoints, starttime_unix)
+                if proj_starttime_unix >= finaltime_unix:
+                    continue
+
+                result = get_items_by_env(proj, proj_starttime_unix, finaltime_unix, shard_seconds, query_cache)
+                add_project_result(proj, result, sink, store, checkpoints, proj_starttime_unix, finaltime_unix)
+    finally:
+        close_store(store)
+        close_query_cache(query_cache)
+
+
+async def process_all_async(refresh_projects=False, shard_seconds=None, incremental=False, store_file=None,
+                            output_format='csv', use_query_cache=True):
+    #
+    # Same as process_all but all the Metrics API queries are in flight at the same time
+    #
+
+    import asyncio
+    import async_metrics_base as amb
+
+    account_read_token = os.environ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'] 
+
+    registry = open_project_registry(refresh_projects)
+
+    async with amb.AsyncApiClient() as client:
+        projects = await amb.get_project_objects(account_read_token, ALLOWED_PROJECT_TOKEN_NAMES, client,
+                                                 registry)
+        # look at the last 30 days  
+        starttime_unix, finaltime_unix = get_start_and_final_time()
+
+        output_csv_file = get_output_file_name(OUTPUT_CSV_FILE, output_format)
+        checkpoints = open_checkpoints(output_csv_file, incremental)
+        store = open_store(store_file)
+        query_cache = open_query_cache(use_query_cache)
+
+        async def collect_project(proj, sink):
+            # Each project is written and checkpointed as soon as its query finishes
+            proj_starttime_unix = get_project_start_time(proj, checkpoints, starttime_unix)
+            if proj_starttime_unix >= finaltime_unix:
+                return
+
+            query_data = get_items_by_env_query(proj_starttime_unix, finaltime_unix)
+            if shard_seconds is None:
+                result = await amb.make_occ_metrics_api_call(proj, query_data, client, query_cache)
+            else:
+                result = await amb.make_sharded_occ_metrics_api_call(proj, query_data, shard_seconds, client,
+                                                                     query_cache)
+
+            add_project_result(proj, result, sink, store, checkpoints, proj_starttime_unix, finaltime_unix)
+
+        try:
+            with open_sink(output_csv_file, mb.OCCURRENCE_CSV_COLUMNS, output_format, append=incremental) as sink:
+                await asyncio.gather(*[collect_project(proj, sink) for proj in projects])
+        finally:
+            close_store(store)
+            close_query_cache(query_cache)
+
+
+def add_project_result(proj, result, sink, store, checkpoints, starttime_unix, endtime_unix):
+    #
+    # Write the rows of a project and then move its checkpoint. The rows are flushed first, so a run
+    # that stops later never has a checkpoint for rows that were still in the sink buffer
+    #
+
+    if not add_results_to_csv_file(proj, result, sink, starttime_unix, endtime_unix):
+        return
+
+    add_results_to_store(proj, result, store, starttime_unix, endtime_unix)
+
+    if checkpoints is not None:
+        sink.flush()
+        save_checkpoint(proj, result, checkpoints, endtime_unix)
+
+
+def open_checkpoints(output_csv_file, incremental):
+    #
+    # Incremental runs append to the CSV file and use checkpoints.
+    # Full runs back up the old CSV file and do not use checkpoints
+    #
+
+    if incremental:
+        return CheckpointStore(CHECKPOINT_FILE)
+
+    backup_output_csv_file(output_csv_file)
+    return None
+
+
+def open_store(store_file):
+
+    if store_file is None:
+        return None
+
+    return MetricsStore(store_file)
+
+
+def close_store(store):
+
+    if store is not None:
+        store.close()
+
+
+def open_query_cache(use_query_cache):
+
+    if not use_query_cache:
+        return None
+
+    return QueryCache(QUERY_CACHE_FILE)
+
+
+def close_query_cache(query_cache):
+
+    if query_cache is not None:
+        query_cache.log_stats()
+        query_cache.close()
+
+
+def add_results_to_store(proj, result, store, starttime_unix, endtime_unix):
+
+    if store is None or result is None:
+        return
+
+    try:
+        store.append_result(proj, result, starttime_unix, endtime_unix)
+    except Exception as ex:
+        msg = 'Exception storing metrics for {}'.format(proj.name)
+        logging.exception(msg, exc_info=ex)
+
+
+def get_project_start_time(proj, checkpoints, starttime_unix):
+
+    if checkpoints is None:
+        return starttime_unix
+
+    return checkpoints.get_start_time(proj.id, CHECKPOINT_QUERY_TYPE, starttime_unix)
+
+
+def save_checkpoint(proj, result, checkpoints, endtime_unix):
+
+    if checkpoints is not None and result is not None:
+        checkpoints.set_end_time(proj.id, CHECKPOINT_QUERY_TYPE, endtime_unix)
+
+
+def backup_output_csv_file(output_csv_file):
 
     if os.path.exists(output_csv_file):
         backup_file_name = '{}_{}'.format(time.mktime(datetime.datetime.now().timetuple()), output_csv_file)
         os.rename(output_csv_file, backup_file_name)
 
 
-    for proj in projects:
-
-        result = get_items_by_env(proj, starttime_unix, finaltime_unix)
-        add_results_to_csv_file(proj, result, output_csv_file, starttime_unix, finaltime_unix)
-                
-
 def get_start_and_final_time():
 
     # datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
@@ -78,7 +262,18 @@ def get_start_and_final_time():
 
 
 
-def get_items_by_env(proj, starttime_unix, endtime_unix):
+def get_items_by_env(proj, starttime_unix, endtime_unix, shard_seconds=None, query_cache=None):
+
+    query_data = get_items_by_env_query(starttime_unix, endtime_unix)
+    if shard_seconds is None:
+        result = mb.make_occ_metrics_api_call(proj, query_data, query_cache=query_cache)
+    else:
+        result = mb.make_sharded_occ_metrics_api_call(proj, query_data, shard_seconds, query_cache=query_cache)
+
+    return result
+
+
+def get_items_by_env_query(starttime_unix, endtime_unix):
 
     query_data = {
             # epoch time in seconds
@@ -93,31 +288,75 @@ def get_items_by_env(proj, starttime_unix, endtime_unix):
               }
               ]
             }
-    result = mb.make_occ_metrics_api_call(proj, query_data)
 
-    return result
+    return query_data
 
 
-def add_results_to_csv_file(proj, result, output_csv_file, starttime_unix, endtime_unix):
+def add_results_to_csv_file(proj, result, sink, starttime_unix, endtime_unix):
+    #
+    # Returns True if the rows of the result were written to the sink
+    #
+
+    if result is None:
+        return False
 
     try:
-        mb.process_result(proj, result, output_csv_file,
+        mb.process_result(proj, result, sink,
             datetime.datetime.fromtimestamp(starttime_unix).strftime('%c'),
             datetime.datetime.fromtimestamp(endtime_unix).strftime('%c'))
     except Exception as ex:
         msg = 'Exception caclulating metrics for {}'.format(proj.name)
         logging.exception(msg, exc_info=ex)
+        return False
     
-    logging.info('Finished writing CSV file %s for %s: %s', output_csv_file, proj.name, starttime_unix)
+    logging.info('Finished writing CSV file %s for %s: %s', sink.path, proj.name, starttime_unix)
+    return True
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description='Get occurrence counts by environment for all projects')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Query all projects concurrently from an asyncio event loop')
+    parser.add_argument('--refresh-projects', action='store_true',
+                        help='Discover the projects and read tokens again instead of using the project registry')
+    parser.add_argument('--shard-days', type=int, default=None,
+                        help='Split the time window into shards of this many days that are queried concurrently')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only query the time since the last successful run and append to the CSV file')
+    parser.add_argument('--store', dest='store_file', default=None,
+                        help='Also append the rows to this local metrics store file')
+    parser.add_argument('--output-format', choices=SINK_FORMATS, default='csv',
+                        help='The format of the output file')
+    parser.add_argument('--no-query-cache', dest='use_query_cache', action='store_false',
+                        help='Always call the Metrics API instead of using cached results for past time windows')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each stage and the slowest projects at the end of the run')
+    args = parser.parse_args()
+
+    shard_seconds = None
+    if args.shard_days is not None:
+        shard_seconds = args.shard_days * 24 * 60 * 60
+
     logging.basicConfig(level=logging.INFO,
                     format='%(process)d-%(levelname)s-%(message)s',
                     handlers=[logging.StreamHandler()]
                     )
-    process_all()
+
+    if args.profile:
+        profiler = instrumentation.start_profiler()
+
+    if args.use_async:
+        import asyncio
+        asyncio.run(process_all_async(args.refresh_projects, shard_seconds, args.incremental, args.store_file,
+                                      args.output_format, args.use_query_cache))
+    else:
+        process_all(args.refresh_projects, shard_seconds, args.incremental, args.store_file, args.output_format,
+                    args.use_query_cache)
+
+    if args.profile:
+        profiler.stop()
+        profiler.print_summary()
 
     
 
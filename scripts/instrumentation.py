@@ -0,0 +1,245 @@
+"""
+Instrumentation hooks for the API calls and processing stages of a run
+
+metrics_base, api_client and async_metrics_base time each stage of a run and pass a StageEvent
+to every registered callback. Nothing is recorded when no callback is registered.
+
+Stages:
+discovery - Listing the projects in the account
+token_lookup - Getting the read token of a project
+metrics_query - A Metrics API query for a project, including retries and decoding the JSON body
+http - A single HTTP request (each retry is a separate event)
+parse - Turning the metrics rows of a response into ItemMetrics or CSV rows
+rollup - Deriving the environment / level / status reports from an Item level result (see rollup.py)
+enrichment - Adding assigned users to Item metrics with the get item API
+write - Writing the rows of a project to the output file
+
+Usage:
+
+def print_event(event):
+    print(event.stage, event.project, event.seconds)
+
+instrumentation.add_callback(print_event)
+
+or, to print a summary at the end of a run:
+
+profiler = instrumentation.start_profiler()
+...
+profiler.stop()
+profiler.print_summary()
+"""
+
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+_callbacks = []
+_callbacks_lock = threading.Lock()
+
+
+class StageEvent:
+    """
+    A class that stores the measurements for one stage of a run
+    """
+
+    __slots__ = ['stage', 'project', 'detail', 'seconds', 'status', 'byte_count', 'row_count', 'error']
+
+    def __init__(self, stage, project=None, detail=None):
+
+        self.stage = stage
+        self.project = project
+        self.detail = detail
+        self.seconds = None
+        self.status = None
+        self.byte_count = None
+        self.row_count = None
+        self.error = False
+
+
+def add_callback(callback):
+    """
+    Use this method to register a function that is called with a StageEvent when each stage finishes.
+    Callbacks can be called from several threads at the same time
+    """
+
+    with _callbacks_lock:
+        _callbacks.append(callback)
+
+
+def remove_callback(callback):
+
+    with _callbacks_lock:
+        if callback in _callbacks:
+            _callbacks.remove(callback)
+
+
+def is_enabled():
+    return len(_callbacks) > 0
+
+
+def record(event):
+    """
+    Use this method to pass a finished StageEvent to the callbacks
+    """
+
+    for callback in list(_callbacks):
+        try:
+            callback(event)
+        except Exception as ex:
+            logging.error('Error in instrumentation callback', exc_info=ex)
+
+
+@contextmanager
+def stage(name, project=None, detail=None):
+    """
+    Use this method to time a stage in a with statement. Set status, byte_count and row_count
+    on the returned event inside the with block
+
+    Arguments:
+    name - The stage name e.g. 'metrics_query'
+    project - The project name, if the stage is for a single project
+    detail - Optional extra information e.g. the API path
+
+    Returns:
+    A StageEvent
+    """
+
+    event = StageEvent(name, project, detail)
+    if not is_enabled():
+        yield event
+        return
+
+    start = time.perf_counter()
+    try:
+        yield event
+    except BaseException:
+        event.error = True
+        raise
+    finally:
+        event.seconds = time.perf_counter() - start
+        record(event)
+
+
+class Profiler:
+    """
+    A class that collects StageEvents and prints a per-stage and per-project summary
+    """
+
+    def __init__(self):
+
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def stop(self):
+        remove_callback(self.record)
+
+    def get_stage_summary(self):
+        """
+        Returns:
+        A list of dicts with the count, total, p50, p95 and max seconds, rows and bytes of each stage
+        """
+
+        with self.lock:
+            events = list(self.events)
+
+        events_by_stage = {}
+        for event in events:
+            events_by_stage.setdefault(event.stage, []).append(event)
+
+        summary = []
+        for stage_name, stage_events in events_by_stage.items():
+            seconds = sorted(event.seconds for event in stage_events)
+            summary.append({'stage': stage_name,
+                            'count': len(stage_events),
+                            'errors': sum(event.error or is_error_status(event.status) for event in stage_events),
+                            'total': sum(seconds),
+                            'p50': get_percentile(seconds, 50),
+                            'p95': get_percentile(seconds, 95),
+                            'max': seconds[-1],
+                            'rows': sum(event.row_count or 0 for event in stage_events),
+                            'bytes': sum(event.byte_count or 0 for event in stage_events)})
+
+        return summary
+
+    def get_slowest_projects(self, count=10):
+        """
+        Returns:
+        A list of (project, seconds) tuples for the projects with the most time in all stages
+        except http (http time is already part of the other stages)
+        """
+
+        with self.lock:
+            events = list(self.events)
+
+        seconds_by_project = {}
+        for event in events:
+            if event.project is None or event.stage == 'http':
+                continue
+            seconds_by_project[event.project] = seconds_by_project.get(event.project, 0.0) + event.seconds
+
+        # Ties are broken by project name so the report is the same for the same timings
+        projects = sorted(seconds_by_project.items(), key=lambda item: (-item[1], str(item[0])))
+
+        return projects[:count]
+
+    def print_summary(self, slowest_project_count=10):
+        """
+        Use this method to print the profile of the run
+        """
+
+        print('')
+        print('Profile by stage (seconds)')
+        print('{:<14} {:>7} {:>7} {:>10} {:>9} {:>9} {:>9} {:>10} {:>12}'.format(
+            'stage', 'count', 'errors', 'total', 'p50', 'p95', 'max', 'rows', 'bytes'))
+
+        for row in self.get_stage_summary():
+            print('{:<14} {:>7} {:>7} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>10} {:>12}'.format(
+                row['stage'], row['count'], row['errors'], row['total'], row['p50'], row['p95'], row['max'],
+                row['rows'], row['bytes']))
+
+        slowest_projects = self.get_slowest_projects(slowest_project_count)
+        if len(slowest_projects) > 0:
+            print('')
+            print('Slowest projects (seconds in all stages)')
+            for project, seconds in slowest_projects:
+                print('{:<40} {:>10.3f}'.format(str(project), seconds))
+
+        print('')
+
+
+def start_profiler():
+    """
+    Use this method to create a Profiler and register it as a callback
+
+    Returns:
+    A Profiler
+    """
+
+    profiler = Profiler()
+    add_callback(profiler.record)
+
+    return profiler
+
+
+def get_percentile(sorted_values, percentile):
+    #
+    # Nearest rank percentile of a sorted list
+    #
+
+    if len(sorted_values) == 0:
+        return 0.0
+
+    rank = max(1, math.ceil(percentile / 100 * len(sorted_values)))
+
+    return sorted_values[rank - 1]
+
+
+def is_error_status(status):
+    return isinstance(status, int) and status >= 400
@@ -0,0 +1,182 @@
+"""
+A local SQLite cache for the Item details returned by the Rollbar get item API
+
+Fields like assigned_user_id rarely change, so repeated runs can use the cached values
+instead of calling /api/1/item/{id} for every item again.
+
+Usage:
+
+item_cache = ItemCache('rollbar_item_cache.sqlite3', ttl_seconds=24 * 60 * 60)
+metrics = get_item_metrics(proj, start, end, add_assigned_users=True, item_cache=item_cache)
+item_cache.log_stats()
+item_cache.close()
+"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_ITEM_CACHE_FILE = 'rollbar_item_cache.sqlite3'
+
+# Cached items older than this are fetched again
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+# The least recently used items are removed when the cache has more items than this
+DEFAULT_MAX_ENTRIES = 200000
+
+# The get item API fields stored in the cache
+ITEM_CACHE_FIELDS = ['assigned_user_id']
+
+
+class ItemCache:
+    """
+    A class that stores Item details keyed by project id and item id
+    """
+
+    def __init__(self, path=DEFAULT_ITEM_CACHE_FILE, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS item_cache (
+                project_id TEXT NOT NULL,
+                item_id INTEGER NOT NULL,
+                fields TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (project_id, item_id)
+            )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS item_cache_used_at ON item_cache (used_at)')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_many(self, project_id, item_ids):
+        """
+        Use this method to look up many items at once
+
+        Arguments:
+        project_id - The id of the project the items belong to
+        item_ids - A list of item ids
+
+        Returns:
+        A dict of item id to the cached item fields for the items that are cached and not expired
+        """
+
+        project_key = get_project_key(project_id)
+        now = time.time()
+        oldest_fetched_at = now - self.ttl_seconds
+
+        cached_items = {}
+        with self.lock:
+            for id_chunk in chunks(list(item_ids), 500):
+                sql = 'SELECT item_id, fields FROM item_cache WHERE project_id = ? AND fetched_at >= ? ' \
+                      'AND item_id IN ({})'.format(','.join('?' * len(id_chunk)))
+
+                for item_id, fields in self.conn.execute(sql, [project_key, oldest_fetched_at] + id_chunk):
+                    cached_items[item_id] = json.loads(fields)
+
+            self.conn.executemany('UPDATE item_cache SET used_at = ? WHERE project_id = ? AND item_id = ?',
+                                  [(now, project_key, item_id) for item_id in cached_items])
+            self.conn.commit()
+
+            self.hits += len(cached_items)
+            self.misses += len(item_ids) - len(cached_items)
+
+        return cached_items
+
+    def get(self, project_id, item_id):
+        return self.get_many(project_id, [item_id]).get(item_id)
+
+    def put_many(self, project_id, items):
+        """
+        Use this method to store the details for many items at once
+
+        Arguments:
+        project_id - The id of the project the items belong to
+        items - A dict of item id to a get item API result
+        """
+
+        project_key = get_project_key(project_id)
+        now = time.time()
+
+        rows = []
+        for item_id, item in items.items():
+            fields = {field: item.get(field) for field in ITEM_CACHE_FIELDS}
+            rows.append((project_key, item_id, json.dumps(fields), now, now))
+
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO item_cache VALUES (?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+
+        self.evict()
+
+    def put(self, project_id, item_id, item):
+        self.put_many(project_id, {item_id: item})
+
+    def evict(self):
+        """
+        Use this method to remove expired items and the least recently used items above max_entries
+        """
+
+        oldest_fetched_at = time.time() - self.ttl_seconds
+
+        with self.lock:
+            cursor = self.conn.execute('DELETE FROM item_cache WHERE fetched_at < ?', (oldest_fetched_at,))
+            evicted = cursor.rowcount
+
+            count = self.conn.execute('SELECT COUNT(*) FROM item_cache').fetchone()[0]
+            if count > self.max_entries:
+                cursor = self.conn.execute('''
+                    DELETE FROM item_cache WHERE rowid IN (
+                        SELECT rowid FROM item_cache ORDER BY used_at LIMIT ?
+                    )''', (count - self.max_entries,))
+                evicted += cursor.rowcount
+
+            self.conn.commit()
+            self.evictions += evicted
+
+    def log_stats(self):
+        msg = 'Item cache hits={} misses={} evictions={}'.format(self.hits, self.misses, self.evictions)
+        logging.info(msg)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def get_project_key(project_id):
+    #
+    # Scripts for a single project only know the project token, not the project id.
+    # Item ids are unique across projects so an empty project key is still safe
+    #
+
+    if project_id is None:
+        return ''
+
+    return str(project_id)
+
+
+def chunks(values, size):
+    #
+    # SQLite limits the number of parameters in a query
+    #
+
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
@@ -2,14 +2,48 @@
 A file with methods for commonly requireed functionality when working with teh Rollbar Metrics API
 
 This file also includes stor light helper classes for storing metrics related data
+
+API calls go to https://api.rollbar.com unless the ROLLBAR_API_BASE_URL environment variable
+is set (see api_client.py)
 """
 
 
-from http.client import HTTPException
-import json
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 import logging
-import requests
 
+import instrumentation
+import query_shards
+import response_decoder
+import sinks
+from api_client import get_default_client
+
+
+# The maximum number of access token requests that are in flight at the same time
+DEFAULT_TOKEN_LOOKUP_WORKERS = 8
+
+# The maximum number of get item requests that are in flight at the same time
+DEFAULT_ITEM_LOOKUP_WORKERS = 8
+
+# The maximum number of time window shards of a Metrics API query that are in flight at the same time
+DEFAULT_SHARD_WORKERS = 8
+
+# Metrics API response fields and the ItemMetrics attributes they are stored in
+RESPONSE_FIELD_ATTRIBUTES = {
+    'item_id': 'id',
+    'item_title': 'title',
+    'item_counter': 'counter',
+    'environment': 'environment',
+    'item_level': 'level',
+    'item_status': 'status',
+    'occurrence_count': 'occurrence_count',
+    'ip_address_count': 'ip_address_count'
+}
+
+RESPONSE_FIELDS = list(RESPONSE_FIELD_ATTRIBUTES.keys())
+
+# The columns of the occurrence counts written by process_result
+OCCURRENCE_CSV_COLUMNS = ['Name', 'Id', 'Environment', 'Level', 'OccurrenceCount', 'StartTime', 'EndTime']
 
 
 class Project:
@@ -28,6 +62,15 @@ class ItemMetrics:
     A class that stores matric data for an item
     """
 
+    __slots__ = ['project_id', 'project_name', 'start_time_unix', 'end_time_unix',
+                 'id', 'title', 'counter', 'level', 'status', 'environment',
+                 'assigned_user_id', 'occurrence_count', 'ip_address_count']
+
+    # The columns written by get_csv_row
+    CSV_COLUMNS = ['project_id', 'project_name', 'start_time_unix', 'end_time_unix',
+                   'id', 'counter', 'title', 'level', 'status', 'environment',
+                   'occurrence_count', 'ip_address_count', 'assigned_user']
+
     def __init__(self):
         
         self.project_id = None
@@ -71,6 +114,25 @@ class ItemMetrics:
         return headers
 
 
+    def get_csv_row(self):
+        """
+        Returns a dict with the CSV_COLUMNS keys, for writing to a sink
+        """
+
+        return {'project_id': self.project_id,
+                'project_name': self.project_name,
+                'start_time_unix': self.start_time_unix,
+                'end_time_unix': self.end_time_unix,
+                'id': self.id,
+                'counter': self.counter,
+                'title': self.title,
+                'level': self.level,
+                'status': self.status,
+                'environment': self.environment,
+                'occurrence_count': self.occurrence_count,
+                'ip_address_count': self.ip_address_count,
+                'assigned_user': self.assigned_user_id}
+
     def get_csv_line(self):
         """
         Returns a comma separated list of data for a CSV
@@ -93,7 +155,202 @@ class ItemMetrics:
         return line
 
 
-def get_item_metrics(proj: Project, start_time_unix, end_time_unix, add_assigned_users=False):
+class DictionaryColumn:
+    """
+    A column of strings stored as integer codes into a list of distinct values.
+    Columns like environment and level only have a few distinct values
+    """
+
+    def __init__(self):
+        self.codes = array('i')
+        self.values = []
+        self.value_codes = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def append(self, value):
+
+        code = self.value_codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.value_codes[value] = code
+            self.values.append(value)
+
+        self.codes.append(code)
+
+    def to_numpy(self):
+        import numpy as np
+
+        return np.array(self.values, dtype=object)[np.frombuffer(self.codes, dtype=np.int32)]
+
+    def to_pandas(self):
+        import numpy as np
+        import pandas as pd
+
+        # None can not be a category, so it is stored with the code -1
+        codes = np.frombuffer(self.codes, dtype=np.int32).copy()
+        categories = list(self.values)
+        if None in self.value_codes:
+            none_code = self.value_codes[None]
+            codes[codes == none_code] = -1
+            codes[codes > none_code] -= 1
+            categories.remove(None)
+
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+
+class ItemMetricsBatch:
+    """
+    A class that stores metrics data for many items as columns instead of one object per item.
+    Numbers are stored in typed arrays and repeated strings are dictionary encoded.
+    Missing numbers are stored as MISSING_VALUE
+    """
+
+    MISSING_VALUE = -1
+
+    # The columns in the same order as the ItemMetrics attributes
+    COLUMNS = ['project_id', 'project_name', 'start_time_unix', 'end_time_unix',
+               'id', 'title', 'counter', 'level', 'status', 'environment',
+               'assigned_user_id', 'occurrence_count', 'ip_address_count']
+
+    INT_COLUMNS = ['project_id', 'start_time_unix', 'end_time_unix', 'id', 'counter',
+                   'assigned_user_id', 'occurrence_count', 'ip_address_count']
+
+    DICTIONARY_COLUMNS = ['project_name', 'level', 'status', 'environment']
+
+    def __init__(self):
+
+        self.columns = {}
+        for column in self.COLUMNS:
+            if column in self.INT_COLUMNS:
+                self.columns[column] = array('q')
+            elif column in self.DICTIONARY_COLUMNS:
+                self.columns[column] = DictionaryColumn()
+            else:
+                self.columns[column] = []
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.get_item_metrics(index)
+
+    def append(self, **values):
+        """
+        Use this method to add a row. values has a key for each column, missing columns are None
+        """
+
+        for column in self.INT_COLUMNS:
+            value = values.get(column)
+            self.columns[column].append(self.MISSING_VALUE if value is None else int(value))
+
+        for column in self.DICTIONARY_COLUMNS:
+            self.columns[column].append(values.get(column))
+
+        self.columns['title'].append(values.get('title'))
+
+    def extend(self, columns, value_rows, **constant_values):
+        """
+        Use this method to add many rows
+
+        Arguments:
+        columns - The column names of the values in each row of value_rows
+        value_rows - An iterable of tuples of values
+        constant_values - Values that are the same for every row e.g. project_id
+        """
+
+        columns = list(columns)
+        for values in value_rows:
+            row = dict(constant_values)
+            row.update(zip(columns, values))
+            self.append(**row)
+
+    def append_item_metrics(self, im: ItemMetrics):
+        self.append(**{column: getattr(im, column) for column in self.COLUMNS})
+
+    @staticmethod
+    def from_item_metrics(item_metrics_list):
+        """
+        Returns an ItemMetricsBatch with a row for each ItemMetrics object in the list
+        """
+
+        batch = ItemMetricsBatch()
+        for im in item_metrics_list:
+            batch.append_item_metrics(im)
+
+        return batch
+
+    def get_value(self, column, index):
+
+        value = self.columns[column][index]
+        if column in self.INT_COLUMNS and value == self.MISSING_VALUE:
+            return None
+
+        return value
+
+    def get_item_metrics(self, index):
+        """
+        Returns an ItemMetrics object for one row
+        """
+
+        im = ItemMetrics()
+        for column in self.COLUMNS:
+            setattr(im, column, self.get_value(column, index))
+
+        return im
+
+    def to_item_metrics_list(self):
+        return list(self)
+
+    def to_numpy(self):
+        """
+        Returns a dict of column name to NumPy array.
+        Integer columns share memory with the batch and use MISSING_VALUE for missing numbers
+        """
+
+        import numpy as np
+
+        arrays = {}
+        for column in self.COLUMNS:
+            if column in self.INT_COLUMNS:
+                arrays[column] = np.frombuffer(self.columns[column], dtype=np.int64)
+            elif column in self.DICTIONARY_COLUMNS:
+                arrays[column] = self.columns[column].to_numpy()
+            else:
+                arrays[column] = np.array(self.columns[column], dtype=object)
+
+        return arrays
+
+    def to_pandas(self):
+        """
+        Returns a pandas DataFrame with the same columns as the ItemMetrics attributes.
+        Integer columns are nullable and string columns with few values are categorical
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        data = {}
+        for column in self.COLUMNS:
+            if column in self.INT_COLUMNS:
+                values = np.frombuffer(self.columns[column], dtype=np.int64)
+                data[column] = pd.arrays.IntegerArray(values, values == self.MISSING_VALUE)
+            elif column in self.DICTIONARY_COLUMNS:
+                data[column] = self.columns[column].to_pandas()
+            else:
+                data[column] = self.columns[column]
+
+        return pd.DataFrame(data, columns=self.COLUMNS)
+
+
+def get_item_metrics(proj: Project, start_time_unix, end_time_unix, add_assigned_users=False, client=None,
+                     max_workers=DEFAULT_ITEM_LOOKUP_WORKERS, item_cache=None, shard_seconds=None, sink=None,
+                     query_cache=None, granularity=None, query_planner=None):
     """
     Use this method to get Item metrics for a project for a given time window
 
@@ -101,12 +358,178 @@ def get_item_metrics(proj: Project, start_time_unix, end_time_unix, add_assigned
     proj - A Project object
     start_time_unix - Start time winddow in unix epoch time (seconds)
     end_time_unix - End time winddow in unix epoch time (seconds)
+    add_assigned_users - If True the assigned_user_id is added to each Item metric
+    client - An optional ApiClient. The shared client is used if this is not set
+    max_workers - The maximum number of get item requests in flight when adding assigned users
+    item_cache - An optional ItemCache that is checked before calling the get item API
+    shard_seconds - If set the time window is split into shards of this length that are queried concurrently.
+                    Note: ip_address_count is an upper bound when the window is split
+    sink - An optional sink (see sinks.open_sink). If set the response is parsed one row at a time and
+           each Item metric is written to the sink instead of being returned, so memory use does not grow
+           with the size of the response. Can not be used with add_assigned_users or shard_seconds
+    query_cache - An optional QueryCache that is checked before calling the Metrics API (not used with sink)
+    granularity - If set e.g. 'hour' or 'day', there is an Item metric for each item and hour (or day) of the
+                  time window, with start_time_unix and end_time_unix set to the hour. Can not be used with sink
+    query_planner - An optional query_planner.QueryPlanner that splits the query into smaller queries if it
+                    fails because it is too large (not used with sink)
 
     Returns:
-    A list of Item metrics
+    A list of Item metrics (an empty list if sink is set)
+    """
+
+    if sink is not None:
+        if add_assigned_users or shard_seconds is not None or granularity is not None:
+            raise ValueError('Item metrics can not be streamed to a sink with add_assigned_users, shard_seconds '
+                             'or granularity')
+
+        row_count = 0
+        for im in stream_item_metrics(proj, start_time_unix, end_time_unix, client):
+            sink.write_row(im.get_csv_row())
+            row_count += 1
+
+        logging.info('Number of items in response=%s', row_count)
+        return []
+
+    query_data = get_item_metrics_query(start_time_unix, end_time_unix, granularity)
+
+    result = get_occ_metrics_result(proj, query_data, client, shard_seconds, query_cache, query_planner)
+
+    if result is None:
+        return []
+
+    metrics_list = get_metrics_from_response(proj, result, start_time_unix, end_time_unix)
+
+    logging.info('Number of items in response=%s', len(metrics_list))
+
+    if add_assigned_users is False:
+        return metrics_list
+
+    # Add assigned_user_id - by calling Rollbar get_item API once for each item
+    add_extra_info_to_metrics_list(proj, metrics_list, max_workers, client, item_cache)
+
+    return metrics_list
+
+
+def stream_item_metrics(proj: Project, start_time_unix, end_time_unix, client=None):
     """
+    Use this method to get Item metrics for a project one at a time, as the response is parsed
 
-    query = query_data = {
+    Arguments:
+    proj - A Project object
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
+    client - An optional ApiClient. The shared client is used if this is not set
+
+    Returns:
+    A generator of ItemMetrics objects
+    """
+
+    query_data = get_item_metrics_query(start_time_unix, end_time_unix)
+    metric_rows = stream_occ_metrics_api_call(proj, query_data, client)
+
+    for values in response_decoder.decode_metrics_rows(metric_rows, RESPONSE_FIELDS):
+        yield make_item_metrics(proj, start_time_unix, end_time_unix, values)
+
+
+def get_item_metrics_batch(proj: Project, start_time_unix, end_time_unix, client=None, shard_seconds=None,
+                           query_cache=None, granularity=None, query_planner=None):
+    """
+    Use this method to get Item metrics for a project as an ItemMetricsBatch.
+    This uses less memory than get_item_metrics for responses with many rows
+
+    Arguments:
+    proj - A Project object
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
+    client - An optional ApiClient. The shared client is used if this is not set
+    shard_seconds - If set the time window is split into shards of this length that are queried concurrently
+    query_cache - An optional QueryCache that is checked before calling the Metrics API
+    granularity - If set e.g. 'hour' or 'day', there is a row for each item and hour (or day) of the time window
+    query_planner - An optional query_planner.QueryPlanner that splits the query if it is too large
+
+    Returns:
+    An ItemMetricsBatch
+    """
+
+    query_data = get_item_metrics_query(start_time_unix, end_time_unix, granularity)
+
+    result = get_occ_metrics_result(proj, query_data, client, shard_seconds, query_cache, query_planner)
+
+    if result is None:
+        return ItemMetricsBatch()
+
+    batch = get_metrics_batch_from_response(proj, result, start_time_unix, end_time_unix)
+
+    logging.info('Number of items in response=%s', len(batch))
+
+    return batch
+
+
+def get_item_metrics_series(proj: Project, start_time_unix, end_time_unix, granularity='hour', client=None,
+                            shard_seconds=None, query_cache=None, query_planner=None):
+    """
+    Use this method to get the occurrence and IP address counts of each item in each hour (or day)
+    of a time window as NumPy matrices (requires numpy)
+
+    Arguments:
+    proj - A Project object
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
+    granularity - 'hour' or 'day'
+    client - An optional ApiClient. The shared client is used if this is not set
+    shard_seconds - If set the time window is split into shards of this length that are queried concurrently
+    query_cache - An optional QueryCache that is checked before calling the Metrics API
+    query_planner - An optional query_planner.QueryPlanner that splits the query if it is too large
+
+    Returns:
+    A time_series.MetricsSeries with a row for each (item_id, environment)
+    """
+
+    query_data = get_item_metrics_query(start_time_unix, end_time_unix, granularity)
+
+    result = get_occ_metrics_result(proj, query_data, client, shard_seconds, query_cache, query_planner)
+
+    return get_series_from_response(proj, result, start_time_unix, end_time_unix, granularity)
+
+
+def get_series_from_response(proj, result, start_time_unix, end_time_unix, granularity):
+    """
+    Use this method to decode every timepoint of an Item metrics result into a time_series.MetricsSeries
+
+    Arguments:
+    proj - A Project object
+    result - A dict with the Metrics API call data, or None if the call failed
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
+    granularity - The granularity of the query e.g. 'hour'
+
+    Returns:
+    A time_series.MetricsSeries (with no groups if result is None)
+    """
+
+    import time_series
+
+    if result is None:
+        result = {'timepoints': []}
+
+    with instrumentation.stage('parse', proj.name) as event:
+        series = time_series.decode_series(result, time_series.ITEM_SERIES_GROUP_BY,
+                                           time_series.ITEM_SERIES_METRICS, start_time_unix, end_time_unix,
+                                           granularity, time_series.ITEM_SERIES_LABELS)
+        event.row_count = len(series)
+
+    logging.info('Number of items in series=%s timepoints=%s', len(series), len(series.timestamps))
+
+    return series
+
+
+def get_item_metrics_query(start_time_unix, end_time_unix, granularity=None):
+    """
+    Returns the Metrics API query used to get Item metrics for a time window.
+    If granularity is set (e.g. 'hour' or 'day') the result has a timepoint for each hour or day
+    """
+
+    query_data = {
             # epoch time in seconds
             'start_time': start_time_unix,
             'end_time':  end_time_unix,
@@ -132,24 +555,12 @@ def get_item_metrics(proj: Project, start_time_unix, end_time_unix, add_assigned
               ]
             }
 
+    if granularity is not None:
+        query_data['granularity'] = granularity
 
-    result = make_occ_metrics_api_call(proj, query_data)
-    if result is None:
-        return []
-
-    metrics_list = get_metrics_from_response(proj, result, start_time_unix, end_time_unix)
-
-    logging.info('Number of items in response=%s', len(metrics_list))
-
-    if add_assigned_users is False:
-        return metrics_list
+    return query_data
 
-    # Add assigned_user_id - by calling Rollbar get_item API
-    for im in metrics_list:
-        add_extra_info_to_metrics(proj, im)
 
-    return metrics_list
-    
 def get_metrics_from_response(proj, result, start_time_unix, end_time_unix):
     """
     Use this method to parse a metrics API response dict and format the response 
@@ -162,133 +573,272 @@ def get_metrics_from_response(proj, result, start_time_unix, end_time_unix):
     end_time_unix - End time winddow in unix epoch time (seconds)
 
     Returns:
-    A list of ItemMetrics objects
+    A list of ItemMetrics objects. If the result has a timepoint for each hour (or day) there is an
+    ItemMetrics object for each item and timepoint, with the start and end time of the timepoint
     """
 
-    metric_rows = result['timepoints'][0]['metrics_rows']
-
-    if len(metric_rows) == 0:
-        msg = 'No rows for the time range from {} to {}'.format(start_time_unix, end_time_unix)
-        logging.info(msg)
+    windows = response_decoder.get_timepoint_windows(result, start_time_unix, end_time_unix)
+    log_empty_windows(windows, start_time_unix, end_time_unix)
     
-    item_metrics_list = []
-    for row_group in metric_rows:
-        
-        im = ItemMetrics()
-        im.project_id = proj.id
-        im.project_name = proj.name
-        im.start_time_unix = start_time_unix
-        im.end_time_unix = end_time_unix
+    with instrumentation.stage('parse', proj.name) as event:
+        item_metrics_list = []
+        for window_start, window_end, metric_rows in windows:
+            for values in response_decoder.decode_metrics_rows(metric_rows, RESPONSE_FIELDS):
+                item_metrics_list.append(make_item_metrics(proj, window_start, window_end, values))
 
-        for row in row_group:
+        event.row_count = len(item_metrics_list)
 
-            if row['field'] == 'item_id':
-                im.id = row['value']
+    return item_metrics_list
 
-            if row['field'] == 'item_title':
-                im.title = row['value']
 
-            if row['field'] == 'item_counter':
-                im.counter = row['value']
+def make_item_metrics(proj, start_time_unix, end_time_unix, values):
+    #
+    # Create an ItemMetrics object from a tuple of values in the same order as RESPONSE_FIELD_ATTRIBUTES
+    #
 
-            if row['field'] == 'environment':
-                im.environment = row['value']
+    im = ItemMetrics()
+    im.project_id = proj.id
+    im.project_name = proj.name
+    im.start_time_unix = start_time_unix
+    im.end_time_unix = end_time_unix
+    im.assigned_user_id = None
 
-            if row['field'] == 'item_level':
-                im.level = row['value']
+    (im.id, im.title, im.counter, im.environment, im.level, im.status,
+     im.occurrence_count, im.ip_address_count) = values
 
-            if row['field'] == 'item_status':
-                im.status = row['value']
+    return im
 
-            if row['field'] == 'occurrence_count':
-                im.occurrence_count = row['value']
 
-            if row['field'] == 'ip_address_count':
-                im.ip_address_count = row['value']
+def get_metrics_batch_from_response(proj, result, start_time_unix, end_time_unix):
+    """
+    Use this method to parse a metrics API response dict straight into an ItemMetricsBatch
 
-        # print(im.id, im.counter, im.environment, im.status, im.level, im.occurrence_count)
-        item_metrics_list.append(im)
+    Arguments:
+    proj - A Project object
+    result - A dict with the Metrics API call data
+    start_time_unix - Start time winddow in unix epoch time (seconds)
+    end_time_unix - End time winddow in unix epoch time (seconds)
 
-    return item_metrics_list
+    Returns:
+    An ItemMetricsBatch with a row for each item and timepoint of the result
+    """
+
+    windows = response_decoder.get_timepoint_windows(result, start_time_unix, end_time_unix)
+    log_empty_windows(windows, start_time_unix, end_time_unix)
+
+    with instrumentation.stage('parse', proj.name) as event:
+        batch = ItemMetricsBatch()
+        for window_start, window_end, metric_rows in windows:
+            batch.extend(RESPONSE_FIELD_ATTRIBUTES.values(),
+                         response_decoder.decode_metrics_rows(metric_rows, RESPONSE_FIELDS),
+                         project_id=proj.id, project_name=proj.name,
+                         start_time_unix=window_start, end_time_unix=window_end)
+
+        event.row_count = len(batch)
+
+    return batch
+
+
+def log_empty_windows(windows, start_time_unix, end_time_unix):
 
+    if sum(len(metric_rows) for _, _, metric_rows in windows) == 0:
+        msg = 'No rows for the time range from {} to {}'.format(start_time_unix, end_time_unix)
+        logging.info(msg)
 
 
-def get_all_enabled_projects(account_read_token):
+def get_all_enabled_projects(account_read_token, client=None):
     """
     Arguments:
     account_read_token: An Account level acces token with Read scope
+    client: An optional ApiClient. The shared client is used if this is not set
     
     Returns:
     A list with the project ids for all enabled projects in an account
     """
 
-    url = 'https://api.rollbar.com/api/1/projects'
-    headers = {'X-Rollbar-Access-Token': account_read_token}
+    if client is None:
+        client = get_default_client()
 
     proj_list = []
-    try:
-        resp = requests.get(url, headers=headers)
-        log = '/api/1/projects status={}'.format(resp.status_code)
-        logging.info(log)
+    with instrumentation.stage('discovery') as event:
+        try:
+            resp = client.get('/api/1/projects', account_read_token)
+            log = '/api/1/projects status={}'.format(resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
 
-        dct = json.loads(resp.text)['result']
+            dct = response_decoder.loads(resp.content)['result']
+            proj_list = get_enabled_projects_from_result(dct)
+            event.row_count = len(proj_list)
 
-        for item in dct:
-            if item['status'] == 'enabled':
-                p = Project()
-                p.id = item['id']
-                p.name = item['name']
-                proj_list.append(p)
-        
-    except Exception as ex:
-        logging.error('Error making request to Rollbar Metrics API', exc_info=ex)
+        except Exception as ex:
+            logging.error('Error making request to Rollbar Metrics API', exc_info=ex)
 
     return proj_list
 
 
-def get_project_objects_with_token(proj_list, account_read_token, allowed_token_names):
-    """ 
+def get_enabled_projects_from_result(result):
+    """
+    Returns a list of Project objects for the enabled projects in a /api/1/projects result
+    """
+
+    proj_list = []
+    for item in result:
+        if item['status'] == 'enabled':
+            p = Project()
+            p.id = item['id']
+            p.name = item['name']
+            proj_list.append(p)
+
+    return proj_list
+
+
+def get_project_access_tokens(proj: Project, account_read_token, client=None):
+    """
+    Use this method to get the access tokens for a single project
+
+    Arguments:
+    proj - A Project object (with the id and name properties set)
+    account_read_token - An account level access token with Read scope
+    client - An optional ApiClient. The shared client is used if this is not set
+
+    Returns:
+    A dict with the access_tokens API response, or None if the request failed without a response
+    or the response could not be decoded
+    """
+
+    if client is None:
+        client = get_default_client()
+
+    path = '/api/1/project/{}/access_tokens'.format(proj.id)
+
+    with instrumentation.stage('token_lookup', proj.name, path) as event:
+        try:
+            resp = client.get(path, account_read_token)
+            log = '{} /api/1/project/{}/access_tokens status={}'.format(proj.name, proj.id, resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
 
+            return response_decoder.loads(resp.content)
+
+        except Exception as ex:
+            event.error = True
+            msg = 'Error getting the access tokens for project={}'.format(proj.name)
+            logging.error(msg, exc_info=ex)
+            return None
+
+
+def get_all_project_access_tokens(proj_list, account_read_token, max_workers=DEFAULT_TOKEN_LOOKUP_WORKERS,
+                                  client=None):
+    """
+    Use this method to get the access tokens for many projects concurrently
+
+    Arguments:
+    proj_list - List of project objects (with the id and name properties set)
+    account_read_token - An account level access token with Read scope
+    max_workers - The maximum number of requests in flight at the same time
+    client - An optional ApiClient. The shared client is used if this is not set
+
+    Returns:
+    A list of access_tokens API response dicts in the same order as proj_list.
+    The response of a project whose request failed is None
+    """
+
+    if len(proj_list) == 0:
+        return []
+
+    if client is None:
+        client = get_default_client()
+
+    max_workers = max(1, min(max_workers, len(proj_list)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        resp_dicts = executor.map(lambda proj: get_project_access_tokens(proj, account_read_token, client),
+                                  proj_list)
+
+        return list(resp_dicts)
+
+
+def is_token_lookup_ok(resp_dict):
+    """
+    Returns True if an access_tokens response was returned without an error
+    """
+
+    return resp_dict is not None and resp_dict.get('err') == 0 and 'result' in resp_dict
+
+
+def is_allowed_read_token(token, allowed_token_names):
+    """
+    Returns True if the token has an allowed name and Read scope ONLY
+    """
+
+    return token['name'] in allowed_token_names and \
+        len(token['scopes']) == 1 and \
+        token['scopes'][0] == 'read'
+
+
+def get_allowed_read_token(token_list, allowed_token_names):
+    """
+    Returns the first allowed read token in an access_tokens response result, or None if there is none.
+    The same token is chosen for a project wherever its tokens are looked up
+    """
+
+    for token in token_list:
+        if is_allowed_read_token(token, allowed_token_names):
+            return token['access_token']
+
+    return None
+
+
+def get_project_objects_with_token(proj_list, account_read_token, allowed_token_names,
+                                   max_workers=DEFAULT_TOKEN_LOOKUP_WORKERS, client=None):
+    """ 
+    Use this method to get Project objects with a read token for each project in proj_list.
+    The access tokens for the projects are looked up concurrently
 
     Arguments:
     proj_list - List of partially initialized project objects
     account_read_token - An account level access token with Read scope
     allowed_token_names - List of alllowed token names. The allowed tokens must have Read scope ONLY
+    max_workers - The maximum number of access token requests in flight at the same time
+    client - An optional ApiClient. The shared client is used if this is not set
  
     Returns:
-    proj_list: List of project objects with valid read token property
+    proj_list: List of project objects with valid read token property (in the same order as proj_list)
     """
 
+    resp_dicts = get_all_project_access_tokens(proj_list, account_read_token, max_workers, client)
 
-    headers = {'X-Rollbar-Access-Token': account_read_token}
+    return get_project_objects_from_token_responses(proj_list, resp_dicts, allowed_token_names)
 
 
-    proj_objs_with_token = []
-    for proj in proj_list:
-        url = 'https://api.rollbar.com/api/1/project/{}/access_tokens'
-        url = url.format(proj.id)
-
-        resp = requests.get(url, headers=headers)
-        log = '{} /api/1/project/{}/access_tokens status={}'.format(proj.name, proj.id, resp.status_code)
-        logging.info(log)
+def get_project_objects_from_token_responses(proj_list, resp_dicts, allowed_token_names):
+    """
+    Returns a Project object for each project with an allowed token in the access_tokens responses.
+    If a project has more than one allowed token the first one is used, so each project is in the list once.
+    Projects whose lookup failed are left out. resp_dicts must be in the same order as proj_list
+    """
 
-        token_list = json.loads(resp.text)['result']
-        for token in token_list:
-            if token['name'] in allowed_token_names and \
-                 len(token['scopes']) == 1 and \
-                 token['scopes'][0] == 'read':
+    proj_objs_with_token = []
+    for proj, resp_dict in zip(proj_list, resp_dicts):
+        if not is_token_lookup_ok(resp_dict):
+            logging.error('Failed o get access token for project: %s', proj.name)
+            continue
 
-                p = Project()
-                p.id = proj.id
-                p.name = proj.name
-                p.token = token['access_token']
-                proj_objs_with_token.append(p)
-                continue
+        token = get_allowed_read_token(resp_dict['result'], allowed_token_names)
+        if token is not None:
+            p = Project()
+            p.id = proj.id
+            p.name = proj.name
+            p.token = token
+            proj_objs_with_token.append(p)
 
     return proj_objs_with_token
 
 
-def get_project_objects(account_read_token, allowed_token_names):
+def get_project_objects(account_read_token, allowed_token_names, max_workers=DEFAULT_TOKEN_LOOKUP_WORKERS,
+                        client=None, registry=None, refresh=False):
     """
     Use this method to get a list of Project objects
 
@@ -296,154 +846,461 @@ def get_project_objects(account_read_token, allowed_token_names):
     account_read_token - An account level access token with Read scope
     allowed_token_names - Only a token with a name from the allowed list of names will be chosen
                           Note: The token will be accepted if it has Read scope ONLY
+    max_workers - The maximum number of access token requests in flight at the same time
+    client - An optional ApiClient. The shared client is used if this is not set
+    registry - An optional ProjectRegistry. If the registry is fresh no API calls are made
+    refresh - If True the projects are discovered again even if the registry is fresh.
+              The registry is still updated when every token lookup succeeded
 
     Returns:
     List of Project objects with id, name, and read_access_token
     """
 
-    p_list = get_all_enabled_projects(account_read_token)
-    proj_list = get_project_objects_with_token(p_list, account_read_token, allowed_token_names)
+    if registry is not None and not refresh:
+        proj_list = registry.get_projects(account_read_token, allowed_token_names)
+        if proj_list is not None:
+            logging.info('Using %s projects from the project registry', len(proj_list))
+            return proj_list
+
+    p_list = get_all_enabled_projects(account_read_token, client)
+    resp_dicts = get_all_project_access_tokens(p_list, account_read_token, max_workers, client)
+    proj_list = get_project_objects_from_token_responses(p_list, resp_dicts, allowed_token_names)
+
+    # A project list with failed lookups is not stored, so the next run looks the projects up again
+    if registry is not None and len(p_list) > 0 and all(is_token_lookup_ok(r) for r in resp_dicts):
+        registry.set_projects(account_read_token, allowed_token_names, proj_list)
 
     return proj_list
 
-def make_occ_metrics_api_call(proj: Project, query_data):
+
+def rediscover_project_objects(account_read_token, allowed_token_names, current_count, refresh=True, client=None,
+                               registry=None):
+    """
+    Use this method to get a new list of Project objects for a long running script e.g. the collector,
+    which keeps its current list of projects if the discovery fails
+
+    Arguments:
+    account_read_token - An account level access token with Read scope
+    allowed_token_names - Only a token with a name from the allowed list of names will be chosen
+    current_count - The number of projects in the current list
+    refresh - If False the projects come from the registry if it is fresh
+    client - An optional ApiClient. The shared client is used if this is not set
+    registry - An optional ProjectRegistry. It is only updated when every token lookup succeeded
+
+    Returns:
+    List of Project objects, or None if the current list should be kept
+    """
+
+    try:
+        proj_list = get_project_objects(account_read_token, allowed_token_names, client=client, registry=registry,
+                                        refresh=refresh)
+    except Exception as ex:
+        logging.error('Error discovering the projects', exc_info=ex)
+        return None
+
+    if len(proj_list) == 0 and current_count > 0:
+        logging.error('No projects were discovered, the current list of %s projects is kept', current_count)
+        return None
+
+    return proj_list
+
+
+def get_occ_metrics_result(proj: Project, query_data, client=None, shard_seconds=None, query_cache=None,
+                           query_planner=None):
+    #
+    # Run a query in one call, in time window shards, or with a query planner
+    #
+
+    if shard_seconds is not None:
+        return make_sharded_occ_metrics_api_call(proj, query_data, shard_seconds, client=client,
+                                                 query_cache=query_cache, query_planner=query_planner)
+
+    if query_planner is not None:
+        return query_planner.run(proj, query_data, client, query_cache)
+
+    return make_occ_metrics_api_call(proj, query_data, client, query_cache)
+
+
+def make_occ_metrics_api_call(proj: Project, query_data, client=None, query_cache=None):
     """
     Use this method to return the data for the query passed as an argument
 
     Arguments:
     proj - A Project object (Requires name and token properties to be set)
     query_data - A JSON object which defines the Metrics API query
+    client - An optional ApiClient. The shared client is used if this is not set
+    query_cache - An optional QueryCache. Cached results are returned without calling the API,
+                  and identical queries in flight at the same time make one API call
 
     Returns:
     A dict with the Metrics API data
     """
 
+    if query_cache is not None:
+        return query_cache.get_or_fetch(proj, query_data,
+                                        lambda: make_occ_metrics_api_call(proj, query_data, client))
+
+    status_code, result = call_occ_metrics_api(proj, query_data, client)
+
+    return result
+
+
+def call_occ_metrics_api(proj: Project, query_data, client=None):
+    """
+    Use this method to make a Metrics API query and get the HTTP status with the result,
+    e.g. to tell a query that was too large from one with a bad token
+
+    Arguments:
+    proj - A Project object (Requires name and token properties to be set)
+    query_data - A JSON object which defines the Metrics API query
+    client - An optional ApiClient. The shared client is used if this is not set
+
+    Returns:
+    A tuple of (status_code, result). status_code is None if the request failed without a response
+    (e.g. a timeout) and result is None unless status_code is 200
+    """
+
+    if client is None:
+        client = get_default_client()
+
+    with instrumentation.stage('metrics_query', proj.name, '/api/1/metrics/occurrences') as event:
+        try:
+
+            # POST request
+            resp = client.post('/api/1/metrics/occurrences', proj.token, json=query_data)
+            log = '/api/1/metrics/occurrences proj={} status={}'.format(proj.name, resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
+
+            if resp.status_code == 200:
+                result = response_decoder.loads(resp.content)['result']
+                return resp.status_code, result
+            else:
+                msg = 'Rollbar Metrics API query failed project={} status={}'.format(proj.name, resp.status_code)
+                logging.error(msg)
+                return resp.status_code, None
+
+        except Exception as ex:
+            event.error = True
+            msg = 'Error making request to Rollbar Metrics API project={}'.format(proj.name)
+            logging.error(msg, exc_info=ex)
+            return None, None
+
+
+def stream_occ_metrics_api_call(proj: Project, query_data, client=None):
+    """
+    Use this method to return the metrics rows for the query passed as an argument one row at a time.
+    The response body is parsed as it is read, so the whole response is never held in memory
+
+    Arguments:
+    proj - A Project object (Requires name and token properties to be set)
+    query_data - A JSON object which defines the Metrics API query
+    client - An optional ApiClient. The shared client is used if this is not set
+
+    Returns:
+    A generator of metrics rows (lists of field/value dicts). No rows are generated if the request fails
+    """
+
+    if client is None:
+        client = get_default_client()
+
     try:
-        
-        url = 'https://api.rollbar.com/api/1/metrics/occurrences'
-        headers = {'X-Rollbar-Access-Token': proj.token, 'Content-Type': 'application/json'}
 
-        # POST request
-        resp = requests.post(url, json=query_data, headers=headers)
-        log = '/api/1/metrics/occurrences proj={} status={}'.format(proj.name, resp.status_code)
-        logging.info(log)
+        # POST request. The connection is returned to the pool when the with block ends
+        with client.post('/api/1/metrics/occurrences', proj.token, json=query_data, stream=True) as resp:
+            log = '/api/1/metrics/occurrences proj={} status={}'.format(proj.name, resp.status_code)
+            logging.info(log)
 
-        if resp.status_code == 200:
-            result = json.loads(resp.text)['result']
-            return result
-        else:
-            return None
+            if resp.status_code != 200:
+                return
+
+            # Undo any gzip content encoding while the body is read
+            resp.raw.decode_content = True
+            yield from response_decoder.iter_metrics_rows(resp.raw)
 
     except Exception as ex:
         msg = 'Error making request to Rollbar Metrics API project={}'.format(proj.name)
         logging.error(msg, exc_info=ex)
 
 
-def get_all_projects(account_read_token):
+def make_sharded_occ_metrics_api_call(proj: Project, query_data, shard_seconds,
+                                      max_workers=DEFAULT_SHARD_WORKERS, client=None, query_cache=None,
+                                      query_planner=None):
+    """
+    Use this method to split the time window of a query into shards, query the shards concurrently
+    and merge the results. See query_shards for how the metrics rows are merged
+
+    Arguments:
+    proj - A Project object (Requires name and token properties to be set)
+    query_data - A JSON object which defines the Metrics API query
+    shard_seconds - The length of each time window shard e.g. 24 * 60 * 60 for one shard per day
+    max_workers - The maximum number of shard queries in flight at the same time
+    client - An optional ApiClient. The shared client is used if this is not set
+    query_cache - An optional QueryCache for the shard queries. The shards are aligned to multiples of
+                  shard_seconds so the closed shards of the last run are cache hits
+    query_planner - An optional query_planner.QueryPlanner that splits each shard query if it is too large
+
+    Returns:
+    A dict with the merged Metrics API data, or None if the query for any shard failed
+    """
+
+    shards = query_shards.split_time_window(query_data['start_time'], query_data['end_time'], shard_seconds,
+                                            align=query_cache is not None)
+    shard_queries = [query_shards.get_shard_query(query_data, start, end) for start, end in shards]
+
+    if client is None:
+        client = get_default_client()
+
+    max_workers = max(1, min(max_workers, len(shard_queries)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda shard_query: get_occ_metrics_result(proj, shard_query, client,
+                                                                              query_cache=query_cache,
+                                                                              query_planner=query_planner),
+                                    shard_queries))
+
+    if any(result is None for result in results):
+        msg = 'Error getting {} of {} time window shards for project={}'
+        logging.error(msg.format(sum(result is None for result in results), len(results), proj.name))
+        return None
+
+    return query_shards.merge_metrics_results(results, query_data)
+
+
+def get_all_projects(account_read_token, client=None):
     """
     Use this method to get the list of Projects in an account
 
     Arguments:
     account_read_token - An Account level access token with Read scope
+    client - An optional ApiClient. The shared client is used if this is not set
 
     Returns:
     List of Project object with id and name properties populated (Doesnt set the token property)
     """
 
 
-    url = 'https://api.rollbar.com/api/1/projects'
-    headers = {'X-Rollbar-Access-Token': account_read_token}
+    if client is None:
+        client = get_default_client()
 
     proj_list = []
-    try:
-        resp = requests.get(url, headers=headers)
-        log = '/api/1/projects status={}'.format(resp.status_code)
-        logging.info(log)
+    with instrumentation.stage('discovery') as event:
+        try:
+            resp = client.get('/api/1/projects', account_read_token)
+            log = '/api/1/projects status={}'.format(resp.status_code)
+            logging.info(log)
+            event.status = resp.status_code
+            event.byte_count = len(resp.content)
 
-        dct = json.loads(resp.text)['result']
+            dct = response_decoder.loads(resp.content)['result']
+            proj_list = get_enabled_projects_from_result(dct)
+            event.row_count = len(proj_list)
 
-        for item in dct:
-            if item['status'] == 'enabled':
-                p = Project()
-                p.id = item['id']
-                p.name = item['name']
-                proj_list.append(p)
-        
-    except Exception as ex:
-        logging.error('Error making request to Rollbar Metrics API', exc_info=ex)
+        except Exception as ex:
+            logging.error('Error making request to Rollbar Metrics API', exc_info=ex)
 
     return proj_list
 
 
-def add_read_token_to_projects(proj_list, account_read_token, allowed_project_token_names):
+def add_read_token_to_projects(proj_list, account_read_token, allowed_project_token_names,
+                               max_workers=DEFAULT_TOKEN_LOOKUP_WORKERS, client=None, registry=None):
     #
     # For each project object in proj_list add the token property
+    # The access tokens are looked up concurrently with at most max_workers requests in flight
+    # If a ProjectRegistry is passed in, only projects without a fresh registry token are looked up
+    #
+
+    lookup_list = add_read_tokens_from_registry(proj_list, account_read_token, allowed_project_token_names,
+                                                registry)
+
+    resp_dicts = get_all_project_access_tokens(lookup_list, account_read_token, max_workers, client)
+
+    add_read_tokens_from_responses(lookup_list, resp_dicts, allowed_project_token_names)
+    save_read_tokens_to_registry(lookup_list, resp_dicts, account_read_token, allowed_project_token_names,
+                                 registry)
+
+
+def add_read_tokens_from_registry(proj_list, account_read_token, allowed_project_token_names, registry):
+    #
+    # Set the token property from the registry and return the projects that still need a token lookup
     #
 
-    headers = {'X-Rollbar-Access-Token': account_read_token}
+    if registry is None:
+        return proj_list
 
+    lookup_list = []
     for proj in proj_list:
-        url = 'https://api.rollbar.com/api/1/project/{}/access_tokens'
-        url = url.format(proj.id)
+        found, token = registry.get_project_token(account_read_token, allowed_project_token_names, proj)
+        if not found:
+            lookup_list.append(proj)
+        elif token is not None:
+            proj.token = token
 
-        resp = requests.get(url, headers=headers)
-        log = '{} /api/1/project/{}/access_tokens status={}'.format(proj.name, proj.id, resp.status_code)
-        logging.info(log)
+    logging.info('Using %s project tokens from the project registry', len(proj_list) - len(lookup_list))
+
+    return lookup_list
+
+
+def save_read_tokens_to_registry(proj_list, resp_dicts, account_read_token, allowed_project_token_names,
+                                 registry):
+    #
+    # Store the tokens of projects that were looked up successfully
+    #
 
-        resp_dict = json.loads(resp.text)
+    if registry is None or len(proj_list) == 0:
+        return
 
-        if resp_dict['err'] != 0:
+    looked_up_list = [proj for proj, resp_dict in zip(proj_list, resp_dicts) if is_token_lookup_ok(resp_dict)]
+    registry.set_project_tokens(account_read_token, allowed_project_token_names, looked_up_list)
+
+
+def add_read_tokens_from_responses(proj_list, resp_dicts, allowed_project_token_names):
+    #
+    # Set the token property of each project from its access_tokens response
+    # resp_dicts must be in the same order as proj_list
+    #
+
+    for proj, resp_dict in zip(proj_list, resp_dicts):
+        if not is_token_lookup_ok(resp_dict):
             logging.error('Failed o get access token for project: %s', proj.name)
             continue
         
-        token_list = resp_dict['result']
-        for token in token_list:
-            if token['name'] in allowed_project_token_names and \
-                 len(token['scopes']) == 1 and \
-                 token['scopes'][0] == 'read':
-                proj.token = token['access_token']
-                continue
+        token = get_allowed_read_token(resp_dict['result'], allowed_project_token_names)
+        if token is not None:
+            proj.token = token
 
 
-def add_extra_info_to_metrics(proj: Project, item_metrics: ItemMetrics):
+def get_item(proj: Project, item_id, client=None):
     """
-    Use this method to add additional data to the ItemMetrics object.
-    This method adds the following fields to a partially populated ItemMetrcs object:
-    - title
-    - assigned_user_id
+    Use this method to get the details of an Item from the Rollbar get item API
 
     Arguments:
     proj - A Project obect (with the token and name properties set)
-    item_metrics - A object with som emetrics for an Item already set
+    item_id - The id of the Item
+    client - An optional ApiClient. The shared client is used if this is not set
+
+    Returns:
+    A dict with the Item details, or None if the request failed
     """
 
+    if client is None:
+        client = get_default_client()
+
     try:
-        
-        url = 'https://api.rollbar.com/api/1/item/{}'.format(item_metrics.id)
-        headers = {'X-Rollbar-Access-Token': proj.token, 'Content-Type': 'application/json'}
 
         # GET request
-        resp = requests.get(url, headers=headers)
+        resp = client.get('/api/1/item/{}'.format(item_id), proj.token)
 
         log = 'Get Item HTTP response status={}'.format(resp.status_code)
         logging.info(log)
 
         if resp.status_code == 200:
-            result = json.loads(resp.text)['result']
-            item_metrics.assigned_user_id = result['assigned_user_id']
-        else:
-            msg = 'Error getting extra info for metrics id={} counter={} project={} status_code={}'
-            msg = msg.format(item_metrics.id, item_metrics.counter,
-                             item_metrics.project_name, resp.status_code)
-            logging.error(msg)
+            return response_decoder.loads(resp.content)['result']
+
+        msg = 'Error getting extra info for item id={} project={} status_code={}'
+        msg = msg.format(item_id, proj.name, resp.status_code)
+        logging.error(msg)
 
     except Exception as ex:
         msg = 'Error making request to Rollbar Get item API project={}'.format(proj.name)
         logging.error(msg, exc_info=ex)
 
-        return item_metrics
+    return None
+
+
+def add_extra_info_to_metrics(proj: Project, item_metrics: ItemMetrics, client=None):
+    """
+    Use this method to add additional data to the ItemMetrics object.
+    This method adds the following fields to a partially populated ItemMetrcs object:
+    - assigned_user_id
+
+    Arguments:
+    proj - A Project obect (with the token and name properties set)
+    item_metrics - A object with som emetrics for an Item already set
+    client - An optional ApiClient. The shared client is used if this is not set
+    """
+
+    item = get_item(proj, item_metrics.id, client)
+    if item is not None:
+        set_extra_info_from_item([item_metrics], item)
+
 
-    return
+def add_extra_info_to_metrics_list(proj: Project, metrics_list, max_workers=DEFAULT_ITEM_LOOKUP_WORKERS,
+                                   client=None, item_cache=None):
+    """
+    Use this method to add additional data to every ItemMetrics object in a list.
+    Metrics rows for the same item (e.g. one row per environment) share one get item request,
+    and the requests for different items are made concurrently
+
+    Arguments:
+    proj - A Project obect (with the token and name properties set)
+    metrics_list - A list of ItemMetrics objects
+    max_workers - The maximum number of get item requests in flight at the same time
+    client - An optional ApiClient. The shared client is used if this is not set
+    item_cache - An optional ItemCache. Only items that are not cached are requested from the API
+    """
+
+    metrics_by_item_id = group_metrics_by_item_id(metrics_list)
+    item_ids = get_uncached_item_ids(proj, metrics_by_item_id, item_cache)
+    if len(item_ids) == 0:
+        return
+
+    if client is None:
+        client = get_default_client()
+
+    logging.info('Getting extra info for %s items in %s metrics rows', len(item_ids), len(metrics_list))
+
+    max_workers = max(1, min(max_workers, len(item_ids)))
+    with instrumentation.stage('enrichment', proj.name) as event:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            items = executor.map(lambda item_id: get_item(proj, item_id, client), item_ids)
+
+            fetched_items = {}
+            for item_id, item in zip(item_ids, items):
+                if item is not None:
+                    set_extra_info_from_item(metrics_by_item_id[item_id], item)
+                    fetched_items[item_id] = item
+
+        event.row_count = len(item_ids)
+
+    if item_cache is not None:
+        item_cache.put_many(proj.id, fetched_items)
+
+
+def get_uncached_item_ids(proj: Project, metrics_by_item_id, item_cache):
+    #
+    # Set the extra info from the item cache and return the item ids that still need an API call
+    #
+
+    if item_cache is None:
+        return list(metrics_by_item_id.keys())
+
+    cached_items = item_cache.get_many(proj.id, list(metrics_by_item_id.keys()))
+    for item_id, item in cached_items.items():
+        set_extra_info_from_item(metrics_by_item_id[item_id], item)
+
+    return [item_id for item_id in metrics_by_item_id if item_id not in cached_items]
+
+
+def group_metrics_by_item_id(metrics_list):
+    """
+    Returns a dict of item id to the list of ItemMetrics objects for that item
+    """
+
+    metrics_by_item_id = {}
+    for im in metrics_list:
+        metrics_by_item_id.setdefault(im.id, []).append(im)
+
+    return metrics_by_item_id
+
+
+def set_extra_info_from_item(item_metrics_list, item):
+    #
+    # Copy the fields we use from a get item API result to each ItemMetrics object
+    #
+
+    for im in item_metrics_list:
+        im.assigned_user_id = item['assigned_user_id']
 
 
 def process_result(proj: Project, result, output_csv_file, start_time_str, end_time_str):
@@ -453,37 +1310,78 @@ def process_result(proj: Project, result, output_csv_file, start_time_str, end_t
     Arguments:
     proj - A Project object (with name property set)
     result - A dict with metrics data for 1 or more Items
-    output_csv_file - Name of teh CSV file to write results to
+    output_csv_file - A sink from sinks.open_sink (opened once per run with OCCURRENCE_CSV_COLUMNS),
+                      or the name of a CSV file to append the results to
     start_time_str - A string that represents the start of the time window for the metrics
     end_time_str - A string that represents the end of the time window for the metrics
     """
-    
-    metric_rows = result['timepoints'][0]['metrics_rows']
 
-    if len(metric_rows) == 0:
+    rows = get_occurrence_rows(proj, result, start_time_str, end_time_str)
+
+    with instrumentation.stage('write', proj.name) as event:
+        if isinstance(output_csv_file, str):
+            with sinks.open_sink(output_csv_file, OCCURRENCE_CSV_COLUMNS, append=True) as sink:
+                sink.write_rows(rows)
+        else:
+            output_csv_file.write_rows(rows)
+
+        event.row_count = len(rows)
+
+
+def get_occurrence_rows(proj: Project, result, start_time_str, end_time_str):
+    """
+    Use this method to get the rows of a Metrics API result grouped by environment and level
+
+    Arguments:
+    proj - A Project object (with name property set)
+    result - A dict with metrics data
+    start_time_str - A string that represents the start of the time window for the metrics
+    end_time_str - A string that represents the end of the time window for the metrics
+
+    Returns:
+    A list of dicts with the OCCURRENCE_CSV_COLUMNS keys. The counts of all the timepoints of the
+    result are added up, so each row has the count for the whole time window
+    """
+
+    timepoints = result['timepoints']
+
+    if sum(len(timepoint['metrics_rows']) for timepoint in timepoints) == 0:
         msg = 'No rows for {} from {} to {}'.format(proj.name, start_time_str, end_time_str)
         logging.info(msg)
-    
-    for row_group in metric_rows:
-        env = 'nothing'
-        item_level = 'nothing'
-        occ_count = 'nothing'
-        
-        for row in row_group:
-            if row['field'] == 'environment':
-                env = row['value']
 
-            if row['field'] == 'item_level':
-                item_level = row['value']
+    with instrumentation.stage('parse', proj.name) as event:
+        fields = ['environment', 'item_level', 'occurrence_count']
+        if len(timepoints) == 1:
+            values = response_decoder.decode_metrics_rows(timepoints[0]['metrics_rows'], fields, 'nothing')
+        else:
+            values = sum_occurrence_counts(timepoints, fields)
+
+        rows = []
+        for env, item_level, occ_count in values:
+            rows.append({'Name': proj.name,
+                         'Id': proj.id,
+                         'Environment': env,
+                         'Level': item_level,
+                         'OccurrenceCount': occ_count,
+                         'StartTime': start_time_str,
+                         'EndTime': end_time_str})
+
+        event.row_count = len(rows)
 
-            if row['field'] == 'occurrence_count':
-                occ_count = row['value']
+    return rows
 
-        line = '{},{},{},{},{},{},{}\n'
-        line = line.format(proj.name, proj.id, env, item_level,
-                           occ_count, start_time_str, end_time_str)
 
-        f = open(output_csv_file, 'a')
-        f.writelines([line])
-        f.close()
+def sum_occurrence_counts(timepoints, fields):
+    #
+    # Add up the occurrence counts of each environment and level over all the timepoints of a granular result.
+    # Returns a list of (environment, item_level, occurrence_count) tuples in the order they are first seen
+    #
+
+    counts = {}
+    for timepoint in timepoints:
+        for env, item_level, occ_count in response_decoder.decode_metrics_rows(timepoint['metrics_rows'], fields,
+                                                                               'nothing'):
+            key = (env, item_level)
+            counts[key] = counts.get(key, 0) + (occ_count if isinstance(occ_count, (int, float)) else 0)
 
+    return [key + (occ_count,) for key, occ_count in counts.items()]
@@ -0,0 +1,419 @@
+"""
+Use this script to serve the occurrence counts of all Rollbar Projects in an account to Prometheus
+(or any scraper of the Prometheus text or OpenMetrics format)
+
+Usage:
+python3 metrics_exporter.py
+python3 metrics_exporter.py --port 9464 --window-hours 24 --refresh-minutes 5
+python3 metrics_exporter.py --once
+
+The occurrence counts of the last --window-hours are served at http://HOST:PORT/metrics by project,
+environment, level and status (the dimensions of get_occurrences_by_env.py and get_muted_items.py):
+
+rollbar_occurrences{project="my-project",project_id="1",environment="production",level="error",status="active"} 42
+
+A background thread sends one Metrics API query per project every --refresh-minutes and replaces
+the served page when all the projects are done. A scrape only returns the last page, so it never
+waits for the Rollbar API. If the query for a project fails, the counts of its last successful
+query are kept and rollbar_exporter_project_up is 0 for the project.
+
+Use --once to query the projects once, print the page and exit.
+Set ROLLBAR_API_BASE_URL to run the exporter against a local fake_rollbar_api.py server.
+
+Requirements:
+1.
+The following environment variable needs to be set
+ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS - An account level token with Read scope
+Example:
+export ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS=**********
+
+"""
+
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import threading
+import time
+
+import metrics_base as mb
+from aggregate_index import AggregateIndex
+from api_client import get_default_client
+from project_registry import open_project_registry
+from rollup import ALL_LEVELS
+
+
+# The environment variable with the account read token. It is read when the script runs
+ACCOUNT_READ_TOKEN_ENV_VAR = 'ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'
+
+ALLOWED_PROJECT_TOKEN_NAMES = ['metrics_api_token', 'read']
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_PORT = 9464
+
+DEFAULT_WINDOW_SECONDS = 24 * 60 * 60
+DEFAULT_REFRESH_SECONDS = 5 * 60
+
+# The maximum number of Metrics API queries in flight at the same time during a refresh
+DEFAULT_WORKERS = 4
+
+DEFAULT_PROJECT_REFRESH_SECONDS = 60 * 60
+
+TEXT_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+class ProjectCounts:
+    """
+    A class that stores the occurrence counts of the last successful query of a project
+    """
+
+    def __init__(self, proj):
+
+        self.proj = proj
+        self.aggregates = None
+        self.up = False
+        self.query_seconds = None
+        self.updated_at = None
+
+
+class MetricsExporter:
+    """
+    A class that refreshes the occurrence counts of all projects in the background and keeps
+    the rendered page for the scrapes
+
+    Arguments:
+    account_read_token - An account level access token with Read scope
+    window_seconds - The occurrence counts are for this many seconds before each refresh
+    refresh_seconds - The time from the end of a refresh to the start of the next one
+    max_workers - The maximum number of Metrics API queries in flight at the same time
+    client - An optional ApiClient. The shared client is used if this is not set
+    registry - An optional ProjectRegistry used for the first project list
+    project_refresh_seconds - The time between discoveries of the project list and read tokens
+    """
+
+    def __init__(self, account_read_token, window_seconds=DEFAULT_WINDOW_SECONDS,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS, max_workers=DEFAULT_WORKERS, client=None, registry=None,
+                 project_refresh_seconds=DEFAULT_PROJECT_REFRESH_SECONDS):
+
+        self.account_read_token = account_read_token
+        self.window_seconds = window_seconds
+        self.refresh_seconds = refresh_seconds
+        self.max_workers = max_workers
+        self.client = client
+        self.registry = registry
+        self.project_refresh_seconds = project_refresh_seconds
+
+        # project id -> ProjectCounts. Only the refresh thread uses this
+        self.project_counts = {}
+        self.projects_updated_at = None
+
+        self.refresh_count = 0
+        self.last_refresh_time = None
+        self.last_refresh_seconds = None
+
+        # format -> the rendered page. A refresh replaces the whole dict, so a scrape never
+        # needs a lock and never sees half of a refresh
+        self.pages = {'text': render_page([], [], openmetrics=False),
+                      'openmetrics': render_page([], [], openmetrics=True)}
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def get_page(self, openmetrics=False):
+        """
+        Returns the bytes of the last rendered page, in the OpenMetrics format if openmetrics is True
+        """
+
+        return self.pages['openmetrics' if openmetrics else 'text']
+
+    def start(self):
+        """
+        Use this method to start the background refresh thread
+        """
+
+        self.thread = threading.Thread(target=self.run, name='metrics-exporter-refresh', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+
+        while not self.stop_event.is_set():
+            try:
+                self.refresh()
+            except Exception as ex:
+                logging.error('Error refreshing the occurrence metrics', exc_info=ex)
+
+            self.stop_event.wait(self.refresh_seconds)
+
+    def refresh(self):
+        """
+        Use this method to query the occurrence counts of all projects and replace the served page
+        """
+
+        if self.client is None:
+            self.client = get_default_client()
+
+        start = time.time()
+
+        if self.projects_updated_at is None or start - self.projects_updated_at >= self.project_refresh_seconds:
+            self.refresh_projects()
+
+        end_time_unix = int(start)
+        start_time_unix = end_time_unix - self.window_seconds
+
+        counts_list = list(self.project_counts.values())
+        max_workers = max(1, min(self.max_workers, len(counts_list)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda counts: self.refresh_project(counts, start_time_unix, end_time_unix),
+                              counts_list))
+
+        self.refresh_count += 1
+        self.last_refresh_time = time.time()
+        self.last_refresh_seconds = self.last_refresh_time - start
+
+        exporter_samples = get_exporter_samples(self)
+        self.pages = {'text': render_page(counts_list, exporter_samples, openmetrics=False),
+                      'openmetrics': render_page(counts_list, exporter_samples, openmetrics=True)}
+
+        up_count = sum(counts.up for counts in counts_list)
+        logging.info('Refreshed the occurrence metrics of {} of {} projects in {:.2f}s'.format(
+            up_count, len(counts_list), self.last_refresh_seconds))
+
+    def refresh_projects(self):
+        #
+        # The first list comes from the project registry if it is fresh. The counts of projects
+        # that are still in the list are kept
+        #
+
+        proj_list = mb.rediscover_project_objects(self.account_read_token, ALLOWED_PROJECT_TOKEN_NAMES,
+                                                  len(self.project_counts),
+                                                  refresh=self.projects_updated_at is not None,
+                                                  client=self.client, registry=self.registry)
+        if proj_list is None:
+            return
+
+        project_counts = {}
+        for proj in proj_list:
+            counts = self.project_counts.get(proj.id)
+            if counts is None:
+                counts = ProjectCounts(proj)
+            counts.proj = proj
+            project_counts[proj.id] = counts
+
+        self.project_counts = project_counts
+        self.projects_updated_at = time.time()
+
+    def refresh_project(self, counts: ProjectCounts, start_time_unix, end_time_unix):
+
+        start = time.time()
+        query_data = get_occurrence_counts_query(start_time_unix, end_time_unix)
+        result = mb.make_occ_metrics_api_call(counts.proj, query_data, self.client)
+
+        counts.up = result is not None
+        if result is None:
+            return
+
+        counts.aggregates = AggregateIndex.from_result(result)
+        counts.query_seconds = time.time() - start
+        counts.updated_at = time.time()
+
+
+def get_occurrence_counts_query(start_time_unix, end_time_unix):
+    """
+    Returns the Metrics API query for the occurrence counts by environment, level and status.
+    The counts of get_occurrences_by_env.py are the sums over status, and the counts of
+    get_muted_items.py are the rows with the 'mute' status
+    """
+
+    query_data = {
+            # epoch time in seconds
+            'start_time': start_time_unix,
+            'end_time':  end_time_unix,
+            'group_by': ['environment', 'item_level', 'item_status'],
+             'filters': [
+              {
+                'field': 'item_level',
+                'values': ALL_LEVELS,
+                'operator': 'eq'
+              }
+              ]
+            }
+
+    return query_data
+
+
+def get_exporter_samples(exporter: MetricsExporter):
+    #
+    # A list of (name, type, help, value) of the exporter's own metrics
+    #
+
+    return [
+        ('rollbar_exporter_refreshes', 'counter', 'Completed refreshes of the occurrence metrics',
+         exporter.refresh_count),
+        ('rollbar_exporter_last_refresh_timestamp_seconds', 'gauge', 'The time the last refresh finished',
+         exporter.last_refresh_time),
+        ('rollbar_exporter_refresh_duration_seconds', 'gauge', 'The wall time of the last refresh',
+         exporter.last_refresh_seconds),
+        ('rollbar_exporter_window_seconds', 'gauge', 'The length of the time window of the occurrence counts',
+         exporter.window_seconds)
+    ]
+
+
+def render_page(counts_list, exporter_samples, openmetrics=False):
+    """
+    Use this method to render the occurrence counts in the Prometheus text or OpenMetrics format
+
+    Arguments:
+    counts_list - A list of ProjectCounts objects
+    exporter_samples - A list of (name, type, help, value) tuples with the exporter's own metrics
+    openmetrics - If True the page is in the OpenMetrics format, otherwise the Prometheus text format
+
+    Returns:
+    The page as UTF-8 bytes
+    """
+
+    lines = ['# HELP rollbar_occurrences Occurrences in the time window by project, environment, level and status',
+             '# TYPE rollbar_occurrences gauge']
+
+    for counts in sorted(counts_list, key=lambda counts: str(counts.proj.name)):
+        if counts.aggregates is None:
+            continue
+
+        project_labels = 'project="{}",project_id="{}"'.format(escape_label_value(counts.proj.name),
+                                                              escape_label_value(counts.proj.id))
+        for (environment, level, status), total in sorted(counts.aggregates.totals.items(),
+                                                           key=lambda entry: tuple(map(str, entry[0]))):
+            lines.append('rollbar_occurrences{{{},environment="{}",level="{}",status="{}"}} {}'.format(
+                project_labels, escape_label_value(environment), escape_label_value(level),
+                escape_label_value(status), format_value(total[0])))
+
+    lines.append('# HELP rollbar_exporter_project_up 1 if the last query of the project succeeded')
+    lines.append('# TYPE rollbar_exporter_project_up gauge')
+    for counts in sorted(counts_list, key=lambda counts: str(counts.proj.name)):
+        lines.append('rollbar_exporter_project_up{{project="{}",project_id="{}"}} {}'.format(
+            escape_label_value(counts.proj.name), escape_label_value(counts.proj.id), int(counts.up)))
+
+    for name, metric_type, help_text, value in exporter_samples:
+        if value is None:
+            continue
+
+        # OpenMetrics counter samples have a _total suffix
+        sample_name = name + '_total' if openmetrics and metric_type == 'counter' else name
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        lines.append('{} {}'.format(sample_name, format_value(value)))
+
+    if openmetrics:
+        lines.append('# EOF')
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def escape_label_value(value):
+
+    if value is None:
+        return ''
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def start_http_server(exporter: MetricsExporter, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """
+    Use this method to serve the exporter's page at /metrics from a background thread
+
+    Arguments:
+    exporter - A MetricsExporter object
+    host - The address to listen on
+    port - The port to listen on. 0 picks a free port
+
+    Returns:
+    The ThreadingHTTPServer object. Its server_address has the port, and shutdown() stops it
+    """
+
+    # http.server is imported when the server starts, so the script starts quickly
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+        def do_GET(self):
+
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+            page = exporter.get_page(openmetrics)
+
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-exporter-http', daemon=True).start()
+
+    logging.info('Serving the occurrence metrics at http://{}:{}/metrics'.format(host, server.server_address[1]))
+
+    return server
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve the occurrence counts of all projects to Prometheus')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='The address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='The port to listen on')
+    parser.add_argument('--window-hours', type=float, default=DEFAULT_WINDOW_SECONDS / 3600,
+                        help='The occurrence counts are for this many hours before each refresh')
+    parser.add_argument('--refresh-minutes', type=float, default=DEFAULT_REFRESH_SECONDS / 60,
+                        help='The time between refreshes of the occurrence counts')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='The maximum number of Metrics API queries in flight at the same time')
+    parser.add_argument('--refresh-projects', action='store_true',
+                        help='Discover the projects and read tokens again instead of using the project registry')
+    parser.add_argument('--once', action='store_true',
+                        help='Query the projects once, print the page and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                    format='%(process)d-%(levelname)s-%(message)s',
+                    handlers=[logging.StreamHandler()]
+                    )
+
+    exporter = MetricsExporter(os.environ[ACCOUNT_READ_TOKEN_ENV_VAR],
+                               window_seconds=int(args.window_hours * 3600),
+                               refresh_seconds=args.refresh_minutes * 60,
+                               max_workers=args.workers,
+                               registry=open_project_registry(args.refresh_projects))
+
+    if args.once:
+        exporter.refresh()
+        print(exporter.get_page().decode('utf-8'), end='')
+    else:
+        server = start_http_server(exporter, args.host, args.port)
+        exporter.start()
+        try:
+            exporter.thread.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
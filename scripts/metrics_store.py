@@ -0,0 +1,208 @@
+"""
+A local SQLite store for collected occurrence metrics
+
+Metrics collected by the scripts are appended to the store, and rollups by project,
+environment, level, status and time range are served from the store instead of
+calling the Rollbar API again.
+
+Each stored row has the time window it was collected for. Storing a window for a project
+replaces the stored rows of that project (and source) whose windows overlap it, so the counts of
+the same time are never added up twice e.g. when a 30 day run is stored every day. Consecutive
+windows e.g. from get_occurrences_by_env.py --incremental do not overlap and are all kept.
+
+A rollup for a time range adds up the rows whose windows overlap the range. A window that is
+only partly in the range is counted whole, since the store does not know when in the window
+the occurrences happened.
+
+Usage:
+
+with MetricsStore('rollbar_metrics.sqlite3') as store:
+    store.append_result(proj, result, start_time_unix, end_time_unix)
+    rows = store.query_rollup(group_by=['environment', 'level'], project_id=proj.id)
+"""
+
+import sqlite3
+
+
+DEFAULT_METRICS_STORE_FILE = 'rollbar_metrics.sqlite3'
+
+# Rows from queries grouped by environment and level e.g. get_items_by_env
+SOURCE_ENV_LEVEL = 'env_level'
+
+# Rows from Item level queries e.g. get_item_metrics
+SOURCE_ITEM = 'item'
+
+# The columns that rollups can be grouped and filtered by
+ROLLUP_COLUMNS = ['project_id', 'project_name', 'environment', 'level', 'status',
+                  'item_id', 'item_counter', 'title', 'start_time', 'end_time']
+
+
+class MetricsStore:
+    """
+    A class that appends occurrence metrics to a SQLite file and queries rollups of them
+    """
+
+    def __init__(self, path=DEFAULT_METRICS_STORE_FILE):
+
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS occurrence_metrics (
+                source TEXT NOT NULL,
+                project_id INTEGER NOT NULL DEFAULT 0,
+                project_name TEXT,
+                start_time INTEGER NOT NULL,
+                end_time INTEGER NOT NULL,
+                environment TEXT NOT NULL DEFAULT '',
+                level TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL DEFAULT '',
+                item_id INTEGER NOT NULL DEFAULT 0,
+                item_counter INTEGER,
+                title TEXT,
+                occurrence_count INTEGER,
+                ip_address_count INTEGER,
+                PRIMARY KEY (source, project_id, start_time, end_time, environment, level, status, item_id)
+            )''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS occurrence_metrics_rollup
+            ON occurrence_metrics (source, project_id, environment, level, start_time)''')
+        self.conn.execute('''
+            CREATE INDEX IF NOT EXISTS occurrence_metrics_time
+            ON occurrence_metrics (source, start_time, end_time)''')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append_result(self, proj, result, start_time_unix, end_time_unix):
+        """
+        Use this method to store the rows of a Metrics API result grouped by environment and level
+
+        Arguments:
+        proj - A Project object (with the id and name properties set)
+        result - A dict with the Metrics API data e.g. from get_items_by_env
+        start_time_unix - Start of the time window of the result in unix epoch time (seconds)
+        end_time_unix - End of the time window of the result in unix epoch time (seconds)
+        """
+
+        rows = []
+        windows = [(SOURCE_ENV_LEVEL, get_project_id(proj.id), int(start_time_unix), int(end_time_unix))]
+        for timepoint in result['timepoints']:
+            for row in timepoint['metrics_rows']:
+                values = {cell['field']: cell['value'] for cell in row}
+                rows.append((SOURCE_ENV_LEVEL, get_project_id(proj.id), proj.name,
+                             int(start_time_unix), int(end_time_unix),
+                             values.get('environment') or '',
+                             values.get('item_level') or '',
+                             values.get('item_status') or '',
+                             0, None, None,
+                             values.get('occurrence_count'),
+                             values.get('ip_address_count')))
+
+        self.replace_windows(windows, rows)
+
+    def append_item_metrics(self, item_metrics_list):
+        """
+        Use this method to store a list of ItemMetrics objects e.g. from get_item_metrics
+        """
+
+        rows = []
+        windows = set()
+        for im in item_metrics_list:
+            windows.add((SOURCE_ITEM, get_project_id(im.project_id), int(im.start_time_unix), int(im.end_time_unix)))
+            rows.append((SOURCE_ITEM, get_project_id(im.project_id), im.project_name,
+                         int(im.start_time_unix), int(im.end_time_unix),
+                         im.environment or '', im.level or '', im.status or '',
+                         im.id or 0, im.counter, im.title,
+                         im.occurrence_count, im.ip_address_count))
+
+        self.replace_windows(sorted(windows), rows)
+
+    def replace_windows(self, windows, rows):
+        #
+        # windows is a list of (source, project_id, start_time, end_time) of the new rows. Stored rows
+        # of the same source and project with an overlapping window are deleted in the same transaction
+        # as the new rows are inserted. The windows of one call (e.g. the hours of a granular query) do
+        # not overlap each other
+        #
+
+        with self.conn:
+            self.conn.executemany('DELETE FROM occurrence_metrics WHERE source = ? AND project_id = ? '
+                                  'AND start_time < ? AND end_time > ?',
+                                  [(source, project_id, end_time, start_time)
+                                   for source, project_id, start_time, end_time in windows])
+            self.conn.executemany('INSERT OR REPLACE INTO occurrence_metrics VALUES '
+                                  '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def query_rollup(self, group_by=('project_id', 'environment', 'level'), project_id=None,
+                     environment=None, level=None, status=None, start_time_unix=None, end_time_unix=None,
+                     source=SOURCE_ENV_LEVEL):
+        """
+        Use this method to add up the stored occurrence counts
+
+        Arguments:
+        group_by - A list of columns from ROLLUP_COLUMNS to group the counts by
+        project_id - Only count rows for this project id
+        environment - Only count rows for this environment (or a list of environments)
+        level - Only count rows for this item level (or a list of levels)
+        status - Only count rows for this item status (or a list of statuses)
+        start_time_unix - Only count rows for windows that end after this time
+        end_time_unix - Only count rows for windows that start before this time
+        source - SOURCE_ENV_LEVEL or SOURCE_ITEM
+
+        Returns:
+        A list of dicts with the group_by columns and occurrence_count
+        """
+
+        for column in group_by:
+            if column not in ROLLUP_COLUMNS:
+                raise ValueError('Can not group by {}. Allowed columns are {}'.format(column, ROLLUP_COLUMNS))
+
+        conditions = ['source = ?']
+        params = [source]
+
+        for column, value in [('project_id', project_id), ('environment', environment),
+                              ('level', level), ('status', status)]:
+            if value is None:
+                continue
+
+            values = value if isinstance(value, (list, tuple)) else [value]
+            conditions.append('{} IN ({})'.format(column, ','.join('?' * len(values))))
+            params.extend(values)
+
+        # Windows that overlap the time range are counted
+        if start_time_unix is not None:
+            conditions.append('end_time > ?')
+            params.append(int(start_time_unix))
+
+        if end_time_unix is not None:
+            conditions.append('start_time < ?')
+            params.append(int(end_time_unix))
+
+        select_columns = list(group_by) + ['SUM(occurrence_count) AS occurrence_count']
+        sql = 'SELECT {} FROM occurrence_metrics WHERE {}'.format(', '.join(select_columns),
+                                                                  ' AND '.join(conditions))
+        if len(group_by) > 0:
+            sql += ' GROUP BY {0} ORDER BY {0}'.format(', '.join(group_by))
+
+        cursor = self.conn.execute(sql, params)
+        columns = [description[0] for description in cursor.description]
+
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        self.conn.close()
+
+
+def get_project_id(project_id):
+    #
+    # Scripts for a single project do not know the project id
+    #
+
+    if project_id is None:
+        return 0
+
+    return project_id
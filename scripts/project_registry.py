@@ -0,0 +1,189 @@
+"""
+A local registry of the projects in an account and the read token chosen for each project
+
+Scripts that run many times a day can use the registry instead of calling
+/api/1/projects and /api/1/project/{id}/access_tokens on every run.
+The registry file contains access tokens so it is only readable by the current user.
+
+Usage:
+
+registry = ProjectRegistry(ttl_seconds=24 * 60 * 60)
+projects = get_project_objects(account_read_token, ['read'], registry=registry)
+
+Call registry.clear() to force the next run to discover the projects again
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from metrics_base import Project
+
+
+DEFAULT_REGISTRY_FILE = os.path.join(os.path.expanduser('~'), '.rollbar_project_registry.json')
+
+# Projects and tokens older than this are discovered again
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+
+class ProjectRegistry:
+    """
+    A class that stores project ids, names and read tokens in a JSON file
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY_FILE, ttl_seconds=DEFAULT_TTL_SECONDS):
+
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.data = self.load()
+
+    def load(self):
+
+        if not os.path.exists(self.path):
+            return get_empty_registry()
+
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except Exception as ex:
+            logging.error('Error reading project registry %s', self.path, exc_info=ex)
+            return get_empty_registry()
+
+    def save(self):
+        #
+        # Write to a new file that only the current user can read, then replace the old file
+        #
+
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.data, f)
+
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """
+        Use this method to remove all projects and tokens so they are discovered again
+        """
+
+        self.data = get_empty_registry()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def is_fresh(self, updated_at):
+        return updated_at is not None and time.time() - updated_at < self.ttl_seconds
+
+    def get_projects(self, account_read_token, allowed_token_names):
+        """
+        Use this method to get the cached list of projects with a read token
+
+        Arguments:
+        account_read_token - The account level access token used to discover the projects
+        allowed_token_names - The allowed project token names used to choose the tokens
+
+        Returns:
+        A list of Project objects, or None if the cached list is missing or expired
+        """
+
+        key = get_registry_key(account_read_token, allowed_token_names)
+        if self.data['key'] != key or not self.is_fresh(self.data['projects_updated_at']):
+            return None
+
+        proj_list = []
+        for proj_id in self.data['project_ids']:
+            entry = self.data['projects'][str(proj_id)]
+            if entry['token'] is not None:
+                proj_list.append(get_project_from_entry(proj_id, entry))
+
+        return proj_list
+
+    def set_projects(self, account_read_token, allowed_token_names, proj_list):
+        """
+        Use this method to store the complete list of projects with a read token
+        """
+
+        self.update_project_entries(account_read_token, allowed_token_names, proj_list)
+
+        self.data['project_ids'] = list(dict.fromkeys(proj.id for proj in proj_list))
+        self.data['projects_updated_at'] = time.time()
+        self.save()
+
+    def get_project_token(self, account_read_token, allowed_token_names, proj: Project):
+        """
+        Returns a tuple of (found, token) for the cached read token of a project.
+        found is False if the project token is missing or expired.
+        token is None if the project does not have an allowed read token
+        """
+
+        key = get_registry_key(account_read_token, allowed_token_names)
+        entry = self.data['projects'].get(str(proj.id))
+        if self.data['key'] != key or entry is None or not self.is_fresh(entry['updated_at']):
+            return False, None
+
+        return True, entry['token']
+
+    def set_project_tokens(self, account_read_token, allowed_token_names, proj_list):
+        """
+        Use this method to store the read token for each project in proj_list
+        """
+
+        self.update_project_entries(account_read_token, allowed_token_names, proj_list)
+        self.save()
+
+    def update_project_entries(self, account_read_token, allowed_token_names, proj_list):
+
+        key = get_registry_key(account_read_token, allowed_token_names)
+        if self.data['key'] != key:
+            self.data = get_empty_registry()
+            self.data['key'] = key
+
+        now = time.time()
+        for proj in proj_list:
+            self.data['projects'][str(proj.id)] = {'name': proj.name, 'token': proj.token, 'updated_at': now}
+
+
+def open_project_registry(refresh=False, path=DEFAULT_REGISTRY_FILE, ttl_seconds=DEFAULT_TTL_SECONDS):
+    """
+    Use this method to open the project registry used by the scripts
+
+    Arguments:
+    refresh - If True the registry is cleared so projects and tokens are discovered again
+    path - The registry file
+    ttl_seconds - Projects and tokens older than this are discovered again
+
+    Returns:
+    A ProjectRegistry object
+    """
+
+    registry = ProjectRegistry(path, ttl_seconds)
+    if refresh:
+        registry.clear()
+
+    return registry
+
+
+def get_empty_registry():
+    return {'key': None, 'project_ids': [], 'projects_updated_at': None, 'projects': {}}
+
+
+def get_registry_key(account_read_token, allowed_token_names):
+    #
+    # The registry is only valid for the same account token and token names.
+    # A hash is stored so the account token itself is never written to the file
+    #
+
+    key = account_read_token + '|' + ','.join(sorted(allowed_token_names))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_project_from_entry(proj_id, entry):
+
+    p = Project()
+    p.id = proj_id
+    p.name = entry['name']
+    p.token = entry['token']
+
+    return p
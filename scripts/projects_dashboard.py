@@ -1,22 +1,25 @@
-from metrics_base import get_all_projects
-from metrics_base import add_read_token_to_projects
-from metrics_base import get_item_metrics
+from metrics_base import get_project_objects
+from metrics_base import get_item_metrics_batch
+from project_registry import open_project_registry
+from query_planner import QueryPlanner
+import instrumentation
 
+import argparse
 import datetime
 import logging
 import math
 import os
-import pandas as pd
 import time
 
-from metrics_base import ItemMetrics
-from tabulate import tabulate
+from metrics_base import ItemMetricsBatch
+from top_k import TopK
 
 """
 A script that generates a table view of the top X (default=20) items
 with the highest occurrence counts in the last Y (default=30) days
 
-This scripts loops through each project in the account and generates a table for each project
+This scripts loops through each project in the account and generates a table for each project,
+followed by a table of the top items across all projects
 
 This was tested with Python 3.9.1
 
@@ -40,12 +43,20 @@ with an access token name of 'read' or 'metrics_api_token'
 
 pip3 install request
 pip3 install tabulate
-pip3 install pandas
+
+7. Run with --async to query all projects concurrently from an asyncio event loop.
+This also requires
+
+pip3 install aiohttp
+
+8. Projects and their read tokens are stored in a local project registry for 1 day.
+Run with --refresh-projects to discover the projects again
 
 """
 
-# Read the environment variable
-ACCOUNT_READ_TOKEN = os.environ['ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS']
+# The environment variable with the account read token. It is read when the script runs,
+# not when it is imported
+ACCOUNT_READ_TOKEN_ENV_VAR = 'ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS'
 
 # Last number fo days to get the data for
 DAYS = 30
@@ -56,68 +67,172 @@ TOP_ITEM_LIST = 10
 # Field to sort by. For example 'occurrence_count', 'ip_address_count' etc.
 SORT_FIELD = 'occurrence_count'
 
+# The columns displayed in each table
+TABLE_COLUMNS = ['project_name', 'title', 'counter', 'level', 'status', 'environment',
+                 'assigned_user_id', 'occurrence_count', 'ip_address_count']
+
+# Titles are truncated to this many characters
+TITLE_LENGTH = 20
+
+
+# Only project access tokens with these names are used. They MUST be 'read' scope ONLY
+ALLOWED_PROJECT_TOKEN_NAMES = ['metrics_api_token', 'read']
 
-def get_projects():
-    proj_list = get_all_projects(ACCOUNT_READ_TOKEN)
-    add_read_token_to_projects(proj_list, ACCOUNT_READ_TOKEN, ['metrics_api_token', 'read'])
+
+def get_account_read_token(account_read_token=None):
+
+    if account_read_token is None:
+        account_read_token = os.environ[ACCOUNT_READ_TOKEN_ENV_VAR]
+
+    return account_read_token
+
+
+def get_projects(account_read_token, refresh_projects=False):
+    registry = open_project_registry(refresh_projects)
+    proj_list = get_project_objects(account_read_token, ALLOWED_PROJECT_TOKEN_NAMES, registry=registry)
 
     return proj_list
 
-def get_last_x_days_metrics(proj, days):
+def get_last_x_days_window(days):
 
-    # last 24 hours
     final_time = datetime.datetime.now()
     start_time = final_time - datetime.timedelta(days=days)
     final_time_unix = math.floor(time.mktime(final_time.timetuple()))   
     start_time_unix = math.floor(time.mktime(start_time.timetuple()))
 
-    metrics: ItemMetrics
-    metrics = get_item_metrics(proj, start_time_unix, final_time_unix)
+    return start_time_unix, final_time_unix
 
-    metrics_list_of_dicts = []
-    for item_metrics in metrics:
-        metrics_list_of_dicts.append(item_metrics.__dict__)
 
+def get_last_x_days_metrics(proj, days):
+
+    start_time_unix, final_time_unix = get_last_x_days_window(days)
+
+    metrics: ItemMetricsBatch
+    # Item metrics queries of big projects that are too large are split into smaller queries
+    metrics = get_item_metrics_batch(proj, start_time_unix, final_time_unix, query_planner=QueryPlanner())
+
+    return metrics
+
+
+def add_project_metrics(metrics: ItemMetricsBatch, account_top_items: TopK):
+    #
+    # Print the top items of a project and add its rows to the top items of the account.
+    # Only the top items are kept, so the batch can be dropped when this returns
+    #
 
-    df = None 
-    if len(metrics_list_of_dicts) > 0:
-        df = pd.DataFrame(metrics_list_of_dicts)
+    if len(metrics) == 0:
+        return
 
-    return df
+    project_top_items = TopK(TOP_ITEM_LIST, SORT_FIELD)
+    project_top_items.add_batch(metrics)
+    account_top_items.add_batch(metrics)
 
-def print_metrics(df_orig):
+    print_metrics(project_top_items.get_items())
 
-    df = df_orig
-    del df['project_id']
-    del df['start_time_unix']
-    del df['end_time_unix']
-    del df['id']
+
+def get_table_row(im):
+
+    row = [getattr(im, column) for column in TABLE_COLUMNS]
 
     # truncate the title
-    df['title'] = df['title'].str.slice(0, 20)
+    title_index = TABLE_COLUMNS.index('title')
+    if row[title_index] is not None:
+        row[title_index] = row[title_index][:TITLE_LENGTH]
+
+    return row
+
+
+def print_metrics(item_metrics_list, title=None):
+    from tabulate import tabulate
 
-    df = df.nlargest(TOP_ITEM_LIST, SORT_FIELD)
+    if title is not None:
+        print(title)
 
-    print(tabulate(df, headers='keys', tablefmt='grid'))   
+    rows = [get_table_row(im) for im in item_metrics_list]
+
+    print(tabulate(rows, headers=TABLE_COLUMNS, tablefmt='grid', showindex=True))
     print('')
     print()     
 
-def generate_dashboard():
+def print_account_metrics(account_top_items: TopK):
+
+    if len(account_top_items) > 0:
+        print_metrics(account_top_items.get_items(), 'Top items across all projects')
+
+
+def generate_dashboard(refresh_projects=False, account_read_token=None):
     print('Generate dashboard')
-    proj_list = get_projects()
+    proj_list = get_projects(get_account_read_token(account_read_token), refresh_projects)
 
+    account_top_items = TopK(TOP_ITEM_LIST, SORT_FIELD)
 
     for proj in proj_list:
-        df = get_last_x_days_metrics(proj, DAYS)
-        if df is not None:
-            print_metrics(df)
+        metrics = get_last_x_days_metrics(proj, DAYS)
+        add_project_metrics(metrics, account_top_items)
+
+    print_account_metrics(account_top_items)
+
+
+async def generate_dashboard_async(refresh_projects=False, account_read_token=None):
+    #
+    # Same as generate_dashboard but the metrics for all projects are requested concurrently
+    #
+
+    import asyncio
+    import async_metrics_base as amb
+
+    account_read_token = get_account_read_token(account_read_token)
+
+    print('Generate dashboard')
+    start_time_unix, final_time_unix = get_last_x_days_window(DAYS)
+
+    registry = open_project_registry(refresh_projects)
+
+    async with amb.AsyncApiClient() as client:
+        proj_list = await amb.get_project_objects(account_read_token, ALLOWED_PROJECT_TOKEN_NAMES, client,
+                                                  registry)
+
+        metrics_lists = await asyncio.gather(*[amb.get_item_metrics_batch(proj, start_time_unix,
+                                                                          final_time_unix, client,
+                                                                          query_planner=QueryPlanner())
+                                               for proj in proj_list])
+
+    account_top_items = TopK(TOP_ITEM_LIST, SORT_FIELD)
+
+    for metrics in metrics_lists:
+        add_project_metrics(metrics, account_top_items)
+
+    print_account_metrics(account_top_items)
 
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description='Print the top items for each project')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Query all projects concurrently from an asyncio event loop')
+    parser.add_argument('--refresh-projects', action='store_true',
+                        help='Discover the projects and read tokens again instead of using the project registry')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each stage and the slowest projects at the end of the run')
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.WARNING,
                 format='%(process)d-%(levelname)s-%(message)s',
                 handlers=[logging.StreamHandler()]
                 )
-    generate_dashboard()
\ No newline at end of file
+
+    if args.profile:
+        profiler = instrumentation.start_profiler()
+
+    account_read_token = get_account_read_token()
+
+    if args.use_async:
+        import asyncio
+        asyncio.run(generate_dashboard_async(args.refresh_projects, account_read_token))
+    else:
+        generate_dashboard(args.refresh_projects, account_read_token)
+
+    if args.profile:
+        profiler.stop()
+        profiler.print_summary()
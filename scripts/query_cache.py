@@ -0,0 +1,274 @@
+"""
+A local SQLite cache of Metrics API query results
+
+The metrics for a time window that ended in the past do not change, so the results of
+those queries are kept on disk and served to later runs without calling the API again.
+Results for windows that are still open (end_time close to now) are only kept for a
+short TTL.
+
+Results are keyed by the project and a canonical form of the query (sorted keys, sorted
+filters and filter values), so the same query written in a different order is a cache hit.
+
+Identical queries made at the same time from several threads (or asyncio tasks) are
+coalesced: only one of them calls the API and the others wait for its result.
+
+Usage:
+
+with QueryCache('rollbar_query_cache.sqlite3') as query_cache:
+    result = make_occ_metrics_api_call(proj, query_data, query_cache=query_cache)
+    query_cache.log_stats()
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+DEFAULT_QUERY_CACHE_FILE = 'rollbar_query_cache.sqlite3'
+
+# Results for windows that are still open are fetched again after this many seconds
+DEFAULT_OPEN_WINDOW_TTL_SECONDS = 5 * 60
+
+# Late occurrences can still be counted for a while after a window ends.
+# A window is closed when its end_time is at least this many seconds in the past
+DEFAULT_CLOSED_WINDOW_DELAY_SECONDS = 60 * 60
+
+
+class QueryCache:
+    """
+    A class that stores Metrics API results keyed by project and canonical query
+    """
+
+    def __init__(self, path=DEFAULT_QUERY_CACHE_FILE, open_window_ttl_seconds=DEFAULT_OPEN_WINDOW_TTL_SECONDS,
+                 closed_window_delay_seconds=DEFAULT_CLOSED_WINDOW_DELAY_SECONDS):
+
+        self.path = path
+        self.open_window_ttl_seconds = open_window_ttl_seconds
+        self.closed_window_delay_seconds = closed_window_delay_seconds
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        # Futures for the queries that are being fetched, keyed by cache key
+        self.in_flight = {}
+        self.async_in_flight = {}
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_cache (
+                cache_key TEXT PRIMARY KEY,
+                project_key TEXT NOT NULL,
+                result TEXT NOT NULL,
+                closed INTEGER NOT NULL,
+                fetched_at REAL NOT NULL
+            )''')
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_or_fetch(self, proj, query_data, fetch):
+        """
+        Use this method to return a cached result, or call fetch and cache its result
+
+        Arguments:
+        proj - A Project object
+        query_data - A JSON object which defines the Metrics API query
+        fetch - A function with no arguments that calls the API and returns the result (or None on failure)
+
+        Returns:
+        A dict with the Metrics API data, or None if fetch failed
+        """
+
+        cache_key = get_cache_key(proj, query_data)
+
+        with self.lock:
+            result = self.lookup(cache_key)
+            if result is not None:
+                self.hits += 1
+                return result
+
+            future = self.in_flight.get(cache_key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.in_flight[cache_key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = fetch()
+            self.store(cache_key, proj, query_data, result)
+            future.set_result(result)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[cache_key]
+
+        return result
+
+    async def get_or_fetch_async(self, proj, query_data, fetch):
+        """
+        The same as get_or_fetch for asyncio. fetch is a function that returns an awaitable
+        """
+
+        import asyncio
+
+        cache_key = get_cache_key(proj, query_data)
+
+        with self.lock:
+            result = self.lookup(cache_key)
+            if result is not None:
+                self.hits += 1
+                return result
+
+            future = self.async_in_flight.get(cache_key)
+            is_owner = future is None
+            if is_owner:
+                future = asyncio.get_running_loop().create_future()
+                self.async_in_flight[cache_key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not is_owner:
+            return await asyncio.shield(future)
+
+        try:
+            result = await fetch()
+            self.store(cache_key, proj, query_data, result)
+            future.set_result(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        finally:
+            with self.lock:
+                del self.async_in_flight[cache_key]
+
+        return result
+
+    def is_closed_window(self, query_data, now=None):
+        """
+        Returns True if the query window ended long enough ago that its result will not change
+        """
+
+        if now is None:
+            now = time.time()
+
+        return query_data['end_time'] <= now - self.closed_window_delay_seconds
+
+    def lookup(self, cache_key):
+        #
+        # Closed windows are served forever, open windows until the TTL expires.
+        # The caller holds self.lock
+        #
+
+        oldest_fetched_at = time.time() - self.open_window_ttl_seconds
+        row = self.conn.execute('SELECT result FROM query_cache WHERE cache_key = ? '
+                                'AND (closed = 1 OR fetched_at >= ?)', (cache_key, oldest_fetched_at)).fetchone()
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def store(self, cache_key, proj, query_data, result):
+        #
+        # Failed queries are not cached
+        #
+
+        if result is None:
+            return
+
+        closed = 1 if self.is_closed_window(query_data) else 0
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?, ?)',
+                              (cache_key, get_project_key(proj), json.dumps(result), closed, time.time()))
+            self.conn.commit()
+
+    def evict_expired(self):
+        """
+        Use this method to remove the results for open windows whose TTL expired
+        """
+
+        oldest_fetched_at = time.time() - self.open_window_ttl_seconds
+        with self.lock:
+            cursor = self.conn.execute('DELETE FROM query_cache WHERE closed = 0 AND fetched_at < ?',
+                                       (oldest_fetched_at,))
+            self.conn.commit()
+
+        return cursor.rowcount
+
+    def log_stats(self):
+        msg = 'Query cache hits={} misses={} coalesced={}'.format(self.hits, self.misses, self.coalesced)
+        logging.info(msg)
+
+    def close(self):
+        self.evict_expired()
+        with self.lock:
+            self.conn.close()
+
+
+def canonicalize_query(query_data):
+    """
+    Returns a copy of query_data with filters, filter values and aggregates in a fixed order.
+    group_by is left in order because it sets the order of the fields in each metrics row
+    """
+
+    query = dict(query_data)
+
+    if 'filters' in query:
+        filters = []
+        for query_filter in query['filters']:
+            query_filter = dict(query_filter)
+            if isinstance(query_filter.get('values'), list):
+                query_filter['values'] = sorted(query_filter['values'], key=json.dumps)
+            filters.append(query_filter)
+
+        query['filters'] = sorted(filters, key=lambda query_filter: json.dumps(query_filter, sort_keys=True))
+
+    if 'aggregates' in query:
+        query['aggregates'] = sorted(query['aggregates'],
+                                     key=lambda aggregate: json.dumps(aggregate, sort_keys=True))
+
+    return query
+
+
+def get_cache_key(proj, query_data):
+    """
+    Returns the cache key for a project and query
+    """
+
+    key_data = {'project': get_project_key(proj), 'query': canonicalize_query(query_data)}
+    key_json = json.dumps(key_data, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+
+def get_project_key(proj):
+    #
+    # Scripts for a single project only know the project token.
+    # A hash of the token is used so the token is not stored in the cache file
+    #
+
+    if proj.id is not None:
+        return str(proj.id)
+
+    return 'token-' + hashlib.sha256((proj.token or '').encode('utf-8')).hexdigest()[:16]
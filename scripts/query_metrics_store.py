@@ -0,0 +1,67 @@
+"""
+Use this script to print occurrence count rollups from a local metrics store
+No Rollbar API calls are made
+
+Usage:
+python3 query_metrics_store.py --group-by project_name,environment,level --days 7
+python3 query_metrics_store.py --project-id 123 --environment production --level error --level critical
+
+Output:
+CSV rows printed to the screen
+
+Requirements:
+1.
+A metrics store created by running one of these scripts with the --store option
+get_occurrences_by_env.py (source env_level)
+get_common_item_metrics.py (source item)
+"""
+
+import argparse
+import csv
+import datetime
+import math
+import sys
+import time
+
+from metrics_store import DEFAULT_METRICS_STORE_FILE, SOURCE_ENV_LEVEL, SOURCE_ITEM
+from metrics_store import MetricsStore
+
+
+def print_rollup(args):
+
+    start_time_unix = None
+    if args.days is not None:
+        start_time = datetime.datetime.now() - datetime.timedelta(days=args.days)
+        start_time_unix = math.floor(time.mktime(start_time.timetuple()))
+
+    group_by = [column for column in args.group_by.split(',') if column != '']
+
+    with MetricsStore(args.store) as store:
+        rows = store.query_rollup(group_by=group_by,
+                                  project_id=args.project_id,
+                                  environment=args.environment,
+                                  level=args.level,
+                                  status=args.status,
+                                  start_time_unix=start_time_unix,
+                                  source=args.source)
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=group_by + ['occurrence_count'])
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Print occurrence count rollups from a local metrics store')
+    parser.add_argument('--store', default=DEFAULT_METRICS_STORE_FILE, help='The metrics store file')
+    parser.add_argument('--group-by', default='project_name,environment,level',
+                        help='Comma separated list of columns to group by')
+    parser.add_argument('--project-id', type=int, default=None)
+    parser.add_argument('--environment', action='append', default=None)
+    parser.add_argument('--level', action='append', default=None)
+    parser.add_argument('--status', action='append', default=None)
+    parser.add_argument('--days', type=int, default=None, help='Only count windows that overlap the last number of days')
+    parser.add_argument('--source', choices=[SOURCE_ENV_LEVEL, SOURCE_ITEM], default=SOURCE_ENV_LEVEL)
+    args = parser.parse_args()
+
+    print_rollup(args)
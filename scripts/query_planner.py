@@ -0,0 +1,499 @@
+"""
+Adaptive partitioning of Metrics API queries that are too large to run in one call
+
+A query for the Item metrics of a big project can time out or be refused because its result is
+too large. make_occ_metrics_api_call then returns None, and the project looks like it has no items.
+QueryPlanner.run sends the query, and if it fails with a status that a smaller query may not get
+(a timeout, 413, 422 or 5xx) or its result looks truncated, the query is split in two and both
+halves are run again, concurrently. Halves that still fail are split again, up to max_depth times.
+
+A query is split by the first of these that applies:
+
+1. The values of a partition field (item_level, then environment) that is in the query group_by.
+   The values come from the query filter, or for a field without a filter from a small query grouped
+   by that field alone. Partitions have no rows in common, so the merged result is exact.
+2. The time window, cut in half (on an hour or day boundary for granular queries). count_distinct
+   aggregates (e.g. ip_address_count) of the merged result are upper bounds (see query_shards).
+
+Queries that fail with any other status (e.g. 401 or 403) are not split, since a smaller query would
+fail the same way.
+
+Usage:
+
+planner = QueryPlanner()
+result = planner.run(proj, mb.get_item_metrics_query(start_time_unix, end_time_unix))
+
+or pass it to the metrics_base functions:
+
+item_metrics_list = mb.get_item_metrics(proj, start_time_unix, end_time_unix, query_planner=QueryPlanner())
+
+run_async does the same from an asyncio event loop with an AsyncApiClient, and is used by the
+async_metrics_base functions:
+
+result = await planner.run_async(proj, query_data, client)
+"""
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import metrics_base as mb
+import query_shards
+
+
+# Seconds in each timepoint for the Metrics API granularity values
+GRANULARITY_SECONDS = {'hour': 60 * 60, 'day': 24 * 60 * 60}
+
+# HTTP status codes of queries that are split and tried again. None is a request without a response
+SPLIT_STATUS_CODES = [None, 408, 413, 422, 500, 502, 503, 504]
+
+# Group by fields whose values a query can be partitioned by, in the order they are tried
+DEFAULT_PARTITION_FIELDS = ['item_level', 'environment']
+
+# The maximum number of times a query is split along one path, so at most 2 ** max_depth queries
+DEFAULT_MAX_DEPTH = 6
+
+# Time windows shorter than this are not cut in half again
+DEFAULT_MIN_WINDOW_SECONDS = 60 * 60
+
+# The maximum number of partition queries in flight at the same time
+DEFAULT_PLANNER_WORKERS = 8
+
+
+class QueryPlan:
+    """
+    A class that stores one query of a plan and how it was split
+
+    query_data - The Metrics API query
+    depth - The number of splits from the original query
+    split_field - The field the query was split by, 'time' for the time window, or None if it was not split
+    children - The QueryPlan objects of the parts of the query
+    result - The Metrics API result of the query or the merged result of its children
+    status_code - The HTTP status of the last call for the query
+    """
+
+    def __init__(self, query_data, depth=0):
+
+        self.query_data = query_data
+        self.depth = depth
+        self.split_field = None
+        self.children = []
+        self.result = None
+        self.status_code = None
+
+
+class QueryPlanner:
+    """
+    A class that runs a Metrics API query and splits it into smaller queries if it fails or is truncated
+
+    Arguments:
+    max_depth - The maximum number of times a query is split along one path
+    min_window_seconds - Time windows shorter than this are not cut in half
+    partition_fields - The group_by fields the values of a query can be partitioned by, in the order they are tried
+    row_limit - If set, a result with at least this many rows is treated as truncated and split.
+                Set this to the row limit of the Metrics API responses, if they have one
+    max_workers - The maximum number of partition queries in flight at the same time
+    """
+
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH, min_window_seconds=DEFAULT_MIN_WINDOW_SECONDS,
+                 partition_fields=DEFAULT_PARTITION_FIELDS, row_limit=None, max_workers=DEFAULT_PLANNER_WORKERS):
+
+        self.max_depth = max_depth
+        self.min_window_seconds = min_window_seconds
+        self.partition_fields = list(partition_fields)
+        self.row_limit = row_limit
+        self.max_workers = max_workers
+
+    def run(self, proj, query_data, client=None, query_cache=None):
+        """
+        Use this method to get the result of a query, splitting it as needed
+
+        Arguments:
+        proj - A Project object (Requires name and token properties to be set)
+        query_data - A JSON object which defines the Metrics API query
+        client - An optional ApiClient. The shared client is used if this is not set
+        query_cache - An optional QueryCache that is checked before calling the Metrics API for each query
+
+        Returns:
+        A dict with the Metrics API data, or None if a part of the query could not be collected
+        """
+
+        plan = QueryPlan(query_data)
+        if not self.execute(proj, plan, client, query_cache):
+            return None
+
+        return plan.result
+
+    async def run_async(self, proj, query_data, client, query_cache=None):
+        """
+        The same as run from an asyncio event loop
+
+        Arguments:
+        proj - A Project object (Requires name and token properties to be set)
+        query_data - A JSON object which defines the Metrics API query
+        client - An async_metrics_base.AsyncApiClient. Its max_in_flight limits the queries in flight
+        query_cache - An optional QueryCache that is checked before calling the Metrics API for each query
+
+        Returns:
+        A dict with the Metrics API data, or None if a part of the query could not be collected
+        """
+
+        plan = QueryPlan(query_data)
+        if not await self.execute_async(proj, plan, client, query_cache):
+            return None
+
+        return plan.result
+
+    def execute(self, proj, plan: QueryPlan, client=None, query_cache=None):
+        """
+        Use this method to run a QueryPlan. The queries of each level of splits are in flight at the same time
+
+        Returns:
+        True if plan.result is set, False if a part of the query failed and could not be split
+        """
+
+        pending = [plan]
+        failed = []
+        query_count = 0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(pending) > 0:
+                query_count += len(pending)
+                responses = list(executor.map(lambda node: self.fetch(proj, node.query_data, client, query_cache),
+                                              pending))
+
+                to_split = self.get_nodes_to_split(proj, pending, responses, failed)
+                splits = list(executor.map(lambda node: self.get_split(proj, node, client), to_split))
+                pending = self.add_splits(proj, to_split, splits, failed)
+
+        return self.finish_plan(proj, plan, failed, query_count)
+
+    async def execute_async(self, proj, plan: QueryPlan, client, query_cache=None):
+        """
+        The same as execute from an asyncio event loop
+        """
+
+        import asyncio
+
+        pending = [plan]
+        failed = []
+        query_count = 0
+
+        while len(pending) > 0:
+            query_count += len(pending)
+            responses = await asyncio.gather(*[self.fetch_async(proj, node.query_data, client, query_cache)
+                                               for node in pending])
+
+            to_split = self.get_nodes_to_split(proj, pending, responses, failed)
+            splits = await asyncio.gather(*[self.get_split_async(proj, node, client) for node in to_split])
+            pending = self.add_splits(proj, to_split, splits, failed)
+
+        return self.finish_plan(proj, plan, failed, query_count)
+
+    def get_nodes_to_split(self, proj, pending, responses, failed):
+        #
+        # Set the result of each query of a round and return the nodes that failed or were truncated
+        # and can be split. Nodes that can not be split are added to failed (see add_unsplit_node)
+        #
+
+        to_split = []
+        for node, (status_code, result) in zip(pending, responses):
+            node.status_code = status_code
+            node.result = result
+            if result is not None and not self.is_truncated(result):
+                continue
+
+            if self.is_splittable(node):
+                to_split.append(node)
+            else:
+                self.add_unsplit_node(proj, node, failed)
+
+        return to_split
+
+    def add_splits(self, proj, to_split, splits, failed):
+        #
+        # Add the parts of each split node to the plan and return them, to be run in the next round
+        #
+
+        pending = []
+        for node, (split_field, queries) in zip(to_split, splits):
+            if split_field is None:
+                self.add_unsplit_node(proj, node, failed)
+                continue
+
+            node.split_field = split_field
+            node.children = [QueryPlan(query, node.depth + 1) for query in queries]
+            pending.extend(node.children)
+
+            msg = 'Split the Metrics API query of project={} by {} into {} queries (depth {}, status={})'
+            logging.info(msg.format(proj.name, split_field, len(queries), node.depth + 1, node.status_code))
+
+        return pending
+
+    def finish_plan(self, proj, plan: QueryPlan, failed, query_count):
+
+        if len(failed) > 0:
+            msg = 'Error getting {} of the Metrics API queries for project={} after {} queries'
+            logging.error(msg.format(len(failed), proj.name, query_count))
+            return False
+
+        merge_plan_results(plan)
+        return True
+
+    def add_unsplit_node(self, proj, node: QueryPlan, failed):
+        #
+        # A truncated result that can not be split again is kept, as it would be without a planner.
+        # A failed query that can not be split fails the plan
+        #
+
+        if node.result is None:
+            failed.append(node)
+            return
+
+        msg = 'The Metrics API result of project={} may be truncated and can not be split again'
+        logging.warning(msg.format(proj.name))
+
+    def fetch(self, proj, query_data, client=None, query_cache=None):
+        #
+        # Returns a tuple of (status_code, result). Cached results have the status 200
+        #
+
+        if query_cache is None:
+            return mb.call_occ_metrics_api(proj, query_data, client)
+
+        status_codes = []
+
+        def fetch_and_keep_status():
+            status_code, result = mb.call_occ_metrics_api(proj, query_data, client)
+            status_codes.append(status_code)
+            return result
+
+        result = query_cache.get_or_fetch(proj, query_data, fetch_and_keep_status)
+        if result is not None:
+            return 200, result
+
+        return (status_codes[0] if len(status_codes) > 0 else None), None
+
+    async def fetch_async(self, proj, query_data, client, query_cache=None):
+        #
+        # The same as fetch with an AsyncApiClient
+        #
+
+        import async_metrics_base as amb
+
+        if query_cache is None:
+            return await amb.call_occ_metrics_api(proj, query_data, client)
+
+        status_codes = []
+
+        async def fetch_and_keep_status():
+            status_code, result = await amb.call_occ_metrics_api(proj, query_data, client)
+            status_codes.append(status_code)
+            return result
+
+        result = await query_cache.get_or_fetch_async(proj, query_data, fetch_and_keep_status)
+        if result is not None:
+            return 200, result
+
+        return (status_codes[0] if len(status_codes) > 0 else None), None
+
+    def is_truncated(self, result):
+
+        if self.row_limit is None:
+            return False
+
+        return sum(len(timepoint['metrics_rows']) for timepoint in result['timepoints']) >= self.row_limit
+
+    def is_splittable(self, node: QueryPlan):
+
+        if node.depth >= self.max_depth:
+            return False
+
+        # A result was returned, so it was truncated
+        if node.status_code == 200:
+            return True
+
+        return node.status_code in SPLIT_STATUS_CODES
+
+    def get_split(self, proj, node: QueryPlan, client=None):
+        """
+        Returns a tuple of (split_field, queries) for the parts of a query, or (None, []) if it can not be split
+        """
+
+        query_data = node.query_data
+
+        for field in self.get_partition_fields(query_data):
+            values = get_filter_values(query_data, field)
+            if values is None:
+                values = get_field_values(proj, query_data, field, client)
+
+            if values is not None and len(values) > 1:
+                return field, get_partition_queries(query_data, field, values)
+
+        return self.get_time_split(query_data)
+
+    async def get_split_async(self, proj, node: QueryPlan, client):
+        """
+        The same as get_split with an AsyncApiClient
+        """
+
+        query_data = node.query_data
+
+        for field in self.get_partition_fields(query_data):
+            values = get_filter_values(query_data, field)
+            if values is None:
+                values = await get_field_values_async(proj, query_data, field, client)
+
+            if values is not None and len(values) > 1:
+                return field, get_partition_queries(query_data, field, values)
+
+        return self.get_time_split(query_data)
+
+    def get_partition_fields(self, query_data):
+        group_by = query_data.get('group_by', [])
+        return [field for field in self.partition_fields if field in group_by]
+
+    def get_time_split(self, query_data):
+
+        middle_time = get_middle_time(query_data, self.min_window_seconds)
+        if middle_time is not None:
+            return 'time', [query_shards.get_shard_query(query_data, query_data['start_time'], middle_time),
+                            query_shards.get_shard_query(query_data, middle_time, query_data['end_time'])]
+
+        return None, []
+
+
+def merge_plan_results(plan: QueryPlan):
+    #
+    # Set the result of each split query from the results of its parts, from the bottom of the plan up
+    #
+
+    if len(plan.children) == 0:
+        return
+
+    for child in plan.children:
+        merge_plan_results(child)
+
+    results = [child.result for child in plan.children]
+    if plan.split_field == 'time':
+        plan.result = query_shards.merge_metrics_results(results, plan.query_data)
+        # Aggregates that were already inexact in a part stay inexact
+        for result in results:
+            for alias in result.get('inexact_aggregates', []):
+                if alias not in plan.result['inexact_aggregates']:
+                    plan.result['inexact_aggregates'].append(alias)
+    else:
+        plan.result = query_shards.merge_partition_results(results, plan.query_data)
+
+
+def get_filter_values(query_data, field):
+    """
+    Returns the values of the 'eq' filter of field in a query, or None if the query has no such filter
+    """
+
+    for query_filter in query_data.get('filters', []):
+        if query_filter['field'] == field and query_filter.get('operator', 'eq') == 'eq':
+            return list(query_filter['values'])
+
+    return None
+
+
+def get_field_values(proj, query_data, field, client=None):
+    """
+    Use this method to find the values of a field in the time window and filters of a query,
+    with a small query grouped by that field alone
+
+    Returns:
+    A sorted list of values, or None if the query failed or a value is None (rows without a value
+    can not be selected by a filter, so the query can not be partitioned by the field)
+    """
+
+    status_code, result = mb.call_occ_metrics_api(proj, get_values_query(query_data, field), client)
+
+    return get_values_from_result(result, field)
+
+
+async def get_field_values_async(proj, query_data, field, client):
+    """
+    The same as get_field_values with an AsyncApiClient
+    """
+
+    import async_metrics_base as amb
+
+    status_code, result = await amb.call_occ_metrics_api(proj, get_values_query(query_data, field), client)
+
+    return get_values_from_result(result, field)
+
+
+def get_values_query(query_data, field):
+
+    values_query = copy.deepcopy(query_data)
+    values_query['group_by'] = [field]
+    values_query.pop('aggregates', None)
+    values_query.pop('granularity', None)
+
+    return values_query
+
+
+def get_values_from_result(result, field):
+
+    if result is None:
+        return None
+
+    values = set()
+    for timepoint in result['timepoints']:
+        for row in timepoint['metrics_rows']:
+            for cell in row:
+                if cell['field'] == field:
+                    values.add(cell['value'])
+
+    if None in values:
+        return None
+
+    return sorted(values)
+
+
+def get_partition_queries(query_data, field, values):
+    """
+    Returns two queries that each select half of values for field
+    """
+
+    middle = len(values) // 2
+    return [get_partition_query(query_data, field, values[:middle]),
+            get_partition_query(query_data, field, values[middle:])]
+
+
+def get_partition_query(query_data, field, values):
+    """
+    Returns a copy of query_data that only selects rows with one of values for field
+    """
+
+    partition_query = copy.deepcopy(query_data)
+    filters = [query_filter for query_filter in partition_query.get('filters', [])
+               if not (query_filter['field'] == field and query_filter.get('operator', 'eq') == 'eq')]
+    filters.append({'field': field, 'values': list(values), 'operator': 'eq'})
+    partition_query['filters'] = filters
+
+    return partition_query
+
+
+def get_middle_time(query_data, min_window_seconds):
+    #
+    # The time to cut the window of a query at, or None if the window is too short to cut.
+    # Granular queries are cut on a timepoint boundary so no timepoint is split between the halves
+    #
+
+    start_time = query_data['start_time']
+    end_time = query_data['end_time']
+    if end_time - start_time < 2 * min_window_seconds:
+        return None
+
+    middle_time = start_time + (end_time - start_time) // 2
+
+    step = GRANULARITY_SECONDS.get(query_data.get('granularity'))
+    if step is not None:
+        middle_time -= middle_time % step
+        if middle_time <= start_time:
+            return None
+
+    return middle_time
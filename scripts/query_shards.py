@@ -0,0 +1,202 @@
+"""
+Helper methods to split a Metrics API query into time window shards and merge the results
+
+Large time windows can be slow or fail. The window can be split into shards
+(e.g. one per day) that are queried concurrently, and the metrics rows of the shards
+are merged by their group_by values.
+
+occurrence_count and other additive aggregates are summed, so the merged result is the
+same as the result of a single query. count_distinct aggregates (e.g. ip_address_count)
+can not be summed exactly. The merged value is an upper bound and the aggregate alias is
+listed in the 'inexact_aggregates' key of the merged result.
+
+Queries with a granularity (e.g. 'hour') are merged by timepoint timestamp as well, so the merged
+result has one timepoint for each hour or day of the whole window.
+
+A query can also be split into partitions by the values of a group_by field (e.g. one query per
+item_level). The partitions have no rows in common, so merge_partition_results only concatenates
+their rows and every aggregate stays exact.
+"""
+
+import copy
+import logging
+
+
+# Aggregate functions where the value for a window is the sum of the values for its shards
+ADDITIVE_FUNCTIONS = ['count', 'sum']
+
+
+def split_time_window(start_time_unix, end_time_unix, shard_seconds, align=False):
+    """
+    Use this method to split a time window into consecutive shards
+
+    Arguments:
+    start_time_unix - Start time window in unix epoch time (seconds)
+    end_time_unix - End time window in unix epoch time (seconds)
+    shard_seconds - The length of each shard. The last shard may be shorter
+    align - If True the shard boundaries are multiples of shard_seconds, so the first shard may also be shorter.
+            Aligned shards of windows that overlap have the same start and end times e.g. for a query cache
+
+    Returns:
+    A list of (start_time_unix, end_time_unix) tuples
+    """
+
+    if shard_seconds is None or shard_seconds <= 0:
+        raise ValueError('shard_seconds must be a positive number of seconds')
+
+    if start_time_unix >= end_time_unix:
+        raise ValueError('Start time needs to be less than the end time')
+
+    shards = []
+    shard_start = start_time_unix
+    while shard_start < end_time_unix:
+        shard_end = shard_start + shard_seconds
+        if align:
+            shard_end -= shard_start % shard_seconds
+
+        shard_end = min(shard_end, end_time_unix)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+
+    return shards
+
+
+def get_shard_query(query_data, start_time_unix, end_time_unix):
+    """
+    Returns a copy of query_data for a different time window
+    """
+
+    shard_query = copy.deepcopy(query_data)
+    shard_query['start_time'] = start_time_unix
+    shard_query['end_time'] = end_time_unix
+
+    return shard_query
+
+
+def get_inexact_aggregates(query_data):
+    """
+    Returns the aliases of the query aggregates that can not be summed exactly across shards
+    """
+
+    return [aggregate['alias'] for aggregate in query_data.get('aggregates', [])
+            if aggregate['function'] not in ADDITIVE_FUNCTIONS + ['min', 'max']]
+
+
+def merge_metrics_results(results, query_data):
+    """
+    Use this method to merge the Metrics API results of the shards of a query
+
+    Arguments:
+    results - A list of Metrics API result dicts, one for each shard
+    query_data - The query that was split into shards
+
+    Returns:
+    A Metrics API result dict with one timepoint that has the merged metrics rows,
+    or one timepoint per timestamp if the query has a granularity
+    """
+
+    group_by = query_data.get('group_by', [])
+    functions = {aggregate['alias']: aggregate['function'] for aggregate in query_data.get('aggregates', [])}
+    is_granular = query_data.get('granularity') is not None
+
+    # Rows are keyed by the timepoint timestamp (None if the query has no granularity) and group_by values
+    merged_rows = {}
+    for result in results:
+        for timepoint in result['timepoints']:
+            timestamp = timepoint.get('timestamp') if is_granular else None
+            for row in timepoint['metrics_rows']:
+                key = (timestamp,) + tuple(cell['value'] for cell in row if cell['field'] in group_by)
+
+                merged_row = merged_rows.get(key)
+                if merged_row is None:
+                    merged_rows[key] = [dict(cell) for cell in row]
+                    continue
+
+                merge_metrics_row(merged_row, row, group_by, functions)
+
+    inexact_aggregates = get_inexact_aggregates(query_data)
+    if len(results) > 1 and len(inexact_aggregates) > 0:
+        msg = 'Aggregates {} can not be summed exactly across {} shards. The merged values are upper bounds'
+        logging.warning(msg.format(inexact_aggregates, len(results)))
+
+    return {
+        'timepoints': get_merged_timepoints(merged_rows, query_data['start_time'], is_granular),
+        'inexact_aggregates': inexact_aggregates if len(results) > 1 else []
+    }
+
+
+def merge_partition_results(results, query_data):
+    """
+    Use this method to merge the Metrics API results of queries that were split by the values of a
+    group_by field. The rows are concatenated, since no two partitions have a row with the same group_by values
+
+    Arguments:
+    results - A list of Metrics API result dicts, one for each partition
+    query_data - The query that was split into partitions
+
+    Returns:
+    A Metrics API result dict with the same timepoints as merge_metrics_results
+    """
+
+    is_granular = query_data.get('granularity') is not None
+
+    rows_by_timestamp = {}
+    inexact_aggregates = []
+    for result in results:
+        for timepoint in result['timepoints']:
+            timestamp = timepoint.get('timestamp') if is_granular else query_data['start_time']
+            rows_by_timestamp.setdefault(timestamp, []).extend(timepoint['metrics_rows'])
+
+        for alias in result.get('inexact_aggregates', []):
+            if alias not in inexact_aggregates:
+                inexact_aggregates.append(alias)
+
+    if not is_granular and len(rows_by_timestamp) == 0:
+        rows_by_timestamp[query_data['start_time']] = []
+
+    return {
+        'timepoints': [{'timestamp': timestamp, 'metrics_rows': rows_by_timestamp[timestamp]}
+                       for timestamp in sorted(rows_by_timestamp)],
+        'inexact_aggregates': inexact_aggregates
+    }
+
+
+def get_merged_timepoints(merged_rows, start_time_unix, is_granular):
+    #
+    # Group the merged rows back into timepoints in time order
+    #
+
+    if not is_granular:
+        return [{'timestamp': start_time_unix, 'metrics_rows': list(merged_rows.values())}]
+
+    rows_by_timestamp = {}
+    for key, row in merged_rows.items():
+        rows_by_timestamp.setdefault(key[0], []).append(row)
+
+    return [{'timestamp': timestamp, 'metrics_rows': rows_by_timestamp[timestamp]}
+            for timestamp in sorted(rows_by_timestamp)]
+
+
+def merge_metrics_row(merged_row, row, group_by, functions):
+    #
+    # Add the aggregate values of row to merged_row. Both rows have the same group_by values
+    #
+
+    values = {cell['field']: cell['value'] for cell in row}
+
+    for cell in merged_row:
+        field = cell['field']
+        if field in group_by or field not in values:
+            continue
+
+        value = values[field]
+        if cell['value'] is None:
+            cell['value'] = value
+        elif value is None:
+            continue
+        elif functions.get(field) == 'min':
+            cell['value'] = min(cell['value'], value)
+        elif functions.get(field) == 'max':
+            cell['value'] = max(cell['value'], value)
+        else:
+            cell['value'] += value
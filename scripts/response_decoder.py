@@ -0,0 +1,203 @@
+"""
+Helper methods to decode Metrics API responses quickly
+
+loads decodes a response body from bytes, using orjson when it is installed
+(pip3 install orjson) and the json module otherwise.
+
+decode_metrics_rows finds the position of each requested field once per response
+instead of comparing every field name of every row.
+
+iter_metrics_rows parses the metrics rows from a file-like response body one row at a time,
+using ijson when it is installed (pip3 install ijson), so a large response is never held in memory.
+
+orjson and ijson are imported the first time they are needed, so scripts that do not decode
+a response start quickly.
+"""
+
+import itertools
+import json
+import logging
+from operator import itemgetter
+
+
+# The ijson prefix of each metrics row in a Metrics API response body
+METRICS_ROWS_PREFIX = 'result.timepoints.item.metrics_rows.item'
+
+
+get_field = itemgetter('field')
+get_value = itemgetter('value')
+
+# The function used by loads, set on the first call
+_loads = None
+
+
+def get_orjson():
+    """
+    Returns the orjson module, or None if it is not installed
+    """
+
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    return orjson
+
+
+def get_ijson():
+    """
+    Returns the ijson module, or None if it is not installed
+    """
+
+    try:
+        import ijson
+    except ImportError:
+        return None
+
+    return ijson
+
+
+def loads(content):
+    """
+    Use this method to decode a JSON response body
+
+    Arguments:
+    content - The response body as bytes (or str)
+
+    Returns:
+    The decoded object
+    """
+
+    global _loads
+
+    if _loads is None:
+        orjson = get_orjson()
+        _loads = orjson.loads if orjson is not None else json.loads
+
+    return _loads(content)
+
+
+def get_metrics_rows(result, timepoint_index=0):
+    """
+    Returns the metrics rows of one timepoint of a Metrics API result
+    """
+
+    return result['timepoints'][timepoint_index]['metrics_rows']
+
+
+def get_timepoint_windows(result, start_time_unix, end_time_unix):
+    """
+    Use this method to get the time window and metrics rows of every timepoint of a Metrics API result.
+    Queries with a granularity (e.g. 'hour') return one timepoint for each hour of the query window
+
+    Each timepoint covers the time from its timestamp to the timestamp of the next timepoint, and the
+    last one to end_time_unix. A result with one timepoint covers the whole query window
+
+    Arguments:
+    result - A Metrics API result dict
+    start_time_unix - The start time of the query in unix epoch time (seconds)
+    end_time_unix - The end time of the query in unix epoch time (seconds)
+
+    Returns:
+    A list of (start_time_unix, end_time_unix, metrics_rows) tuples in time order
+    """
+
+    timepoints = result['timepoints']
+    if len(timepoints) == 1:
+        return [(start_time_unix, end_time_unix, timepoints[0]['metrics_rows'])]
+
+    timepoints = sorted(timepoints, key=lambda timepoint: timepoint['timestamp'])
+
+    windows = []
+    for index, timepoint in enumerate(timepoints):
+        window_start = max(start_time_unix, timepoint['timestamp'])
+        window_end = end_time_unix
+        if index + 1 < len(timepoints):
+            window_end = min(end_time_unix, timepoints[index + 1]['timestamp'])
+
+        windows.append((window_start, window_end, timepoint['metrics_rows']))
+
+    return windows
+
+
+def iter_metrics_rows(file_obj):
+    """
+    Use this method to parse the metrics rows of a Metrics API response body one row at a time
+
+    Arguments:
+    file_obj - A file-like object with the response body e.g. resp.raw of a streamed requests response
+
+    Returns:
+    A generator of metrics rows (lists of field/value dicts) from every timepoint
+    """
+
+    ijson = get_ijson()
+    if ijson is None:
+        logging.warning('ijson is not installed. The whole response is read before the rows are parsed')
+        result = loads(file_obj.read())['result']
+        for timepoint in result['timepoints']:
+            yield from timepoint['metrics_rows']
+        return
+
+    # use_float returns numbers as int and float instead of Decimal, the same as json.loads
+    yield from ijson.items(file_obj, METRICS_ROWS_PREFIX, use_float=True)
+
+
+def decode_metrics_rows(metric_rows, fields, default=None):
+    """
+    Use this method to get the values of some fields from each metrics row
+
+    The layout of the first row is used to find the position of each field once.
+    Rows with the same layout are read by position, other rows are decoded field by field
+
+    Arguments:
+    metric_rows - The metrics rows of a timepoint (a list, or any iterable, of lists of field/value dicts)
+    fields - The list of field names to return
+    default - The value used for a field that is not in a row
+
+    Returns:
+    A generator of tuples with the values of fields, in the same order as fields
+    """
+
+    metric_rows = iter(metric_rows)
+    first_row = next(metric_rows, None)
+    if first_row is None:
+        return
+
+    metric_rows = itertools.chain([first_row], metric_rows)
+    layout = tuple(map(get_field, first_row))
+    missing_fields = [field for field in fields if field not in layout]
+
+    if len(missing_fields) == len(fields):
+        for row in metric_rows:
+            yield decode_row(row, fields, default)
+        return
+
+    present_fields = [field for field in fields if field in layout]
+    pick_cells = itemgetter(*[layout.index(field) for field in present_fields])
+
+    # itemgetter with a single index returns the item instead of a tuple
+    if len(present_fields) == 1:
+        single_pick = pick_cells
+        pick_cells = lambda row: (single_pick(row),)
+
+    for row in metric_rows:
+        if tuple(map(get_field, row)) != layout:
+            yield decode_row(row, fields, default)
+            continue
+
+        values = tuple(map(get_value, pick_cells(row)))
+        if len(missing_fields) > 0:
+            present_values = dict(zip(present_fields, values))
+            values = tuple(present_values.get(field, default) for field in fields)
+
+        yield values
+
+
+def decode_row(row, fields, default=None):
+    #
+    # Decode a row field by field
+    #
+
+    row_values = {cell['field']: cell['value'] for cell in row}
+    return tuple(row_values.get(field, default) for field in fields)
@@ -0,0 +1,196 @@
+"""
+Derive environment / level / status reports from one Item level Metrics API result
+
+The Item metrics query (metrics_base.get_item_metrics_query) is grouped by environment, item_id,
+item_level and item_status. Queries grouped by fewer of these fields, like the environment and level
+query of get_occurrences_by_env.py or the muted items query of get_muted_items.py, are rollups of it:
+their occurrence counts are the sums of the Item level counts. So one Item level query per project
+gives all of these reports without calling the API again for each one.
+
+Only occurrence_count is rolled up. count_distinct aggregates (e.g. ip_address_count) can not be
+summed across items, so they are left out of the rolled up rows.
+
+A RollupView is a group_by list and optional filters. rollup_result returns a result with the same
+layout as a Metrics API result for that query, so it can be passed to metrics_base.process_result,
+MetricsStore.append_result etc.
+
+Usage:
+
+result = mb.make_occ_metrics_api_call(proj, mb.get_item_metrics_query(start_time_unix, end_time_unix))
+view_results = rollup_result(result, [ENV_LEVEL_VIEW, MUTED_VIEW])
+mb.process_result(proj, view_results['env_level'], sink, start_time_str, end_time_str)
+"""
+
+import logging
+
+import instrumentation
+import response_decoder
+
+
+# The fields that Item level results can be rolled up by
+ROLLUP_FIELDS = ['environment', 'item_level', 'item_status']
+
+# The CSV column of each rollup field
+ROLLUP_CSV_COLUMNS = {
+    'environment': 'Environment',
+    'item_level': 'Level',
+    'item_status': 'Status'
+}
+
+ALL_LEVELS = ['critical', 'error', 'warning', 'info', 'debug']
+
+
+class RollupView:
+    """
+    A class that describes a report derived from an Item level result
+
+    Arguments:
+    name - A name for the view e.g. 'env_level'
+    group_by - The ROLLUP_FIELDS the occurrence counts are summed by, in the order of the result rows
+    filters - An optional dict of field name to the list of values that are kept
+    """
+
+    def __init__(self, name, group_by, filters=None):
+
+        for field in group_by:
+            if field not in ROLLUP_FIELDS:
+                raise ValueError('Can not roll up by {}'.format(field))
+
+        self.name = name
+        self.group_by = list(group_by)
+        self.filters = filters if filters is not None else {}
+
+    def get_csv_columns(self):
+        """
+        Returns the CSV columns of the rows from get_rollup_rows
+        """
+
+        return ['Name', 'Id'] + [ROLLUP_CSV_COLUMNS[field] for field in self.group_by] + \
+               ['OccurrenceCount', 'StartTime', 'EndTime']
+
+    def is_match(self, values):
+        #
+        # values is a dict of field name to value for one row
+        #
+
+        for field, allowed_values in self.filters.items():
+            if values[field] not in allowed_values:
+                return False
+
+        return True
+
+
+# The same rows as the query of get_occurrences_by_env.py
+ENV_LEVEL_VIEW = RollupView('env_level', ['environment', 'item_level'], {'item_level': ALL_LEVELS})
+
+# Occurrence counts by environment, level and status
+ENV_LEVEL_STATUS_VIEW = RollupView('env_level_status', ['environment', 'item_level', 'item_status'],
+                                   {'item_level': ALL_LEVELS})
+
+# The same rows as the query of get_muted_items.py
+MUTED_VIEW = RollupView('muted', ['environment', 'item_level', 'item_status'],
+                        {'item_level': ALL_LEVELS, 'item_status': ['mute']})
+
+DEFAULT_VIEWS = [ENV_LEVEL_VIEW, ENV_LEVEL_STATUS_VIEW, MUTED_VIEW]
+
+
+def rollup_result(result, views=DEFAULT_VIEWS, project_name=None):
+    """
+    Use this method to derive the results of several views from one Item level result.
+    The rows of the result are decoded once for all the views
+
+    Arguments:
+    result - A Metrics API result grouped by at least the group_by fields of each view
+    views - A list of RollupView objects
+    project_name - The project name, for instrumentation
+
+    Returns:
+    A dict of view name to a Metrics API result dict with one timepoint per timepoint of result.
+    Each row has the group_by fields of the view followed by occurrence_count
+    """
+
+    view_results = {view.name: {'timepoints': []} for view in views}
+    if result is None:
+        return view_results
+
+    with instrumentation.stage('rollup', project_name) as event:
+        row_count = 0
+        for timepoint in result['timepoints']:
+            counts_by_view = rollup_metrics_rows(timepoint['metrics_rows'], views)
+            row_count += len(timepoint['metrics_rows'])
+
+            for view in views:
+                metrics_rows = [get_metrics_row(view.group_by, key, occurrence_count)
+                                for key, occurrence_count in counts_by_view[view.name].items()]
+                view_results[view.name]['timepoints'].append({'timestamp': timepoint.get('timestamp'),
+                                                              'metrics_rows': metrics_rows})
+
+        event.row_count = row_count
+
+    return view_results
+
+
+def rollup_metrics_rows(metric_rows, views):
+    #
+    # Returns a dict of view name to a dict of group_by values to the summed occurrence_count.
+    # Groups are kept in the order they are first seen, so the rows are in a stable order
+    #
+
+    fields = ROLLUP_FIELDS + ['occurrence_count']
+    counts_by_view = {view.name: {} for view in views}
+
+    for values in response_decoder.decode_metrics_rows(metric_rows, fields):
+        row = dict(zip(fields, values))
+        occurrence_count = row['occurrence_count'] or 0
+
+        for view in views:
+            if not view.is_match(row):
+                continue
+
+            counts = counts_by_view[view.name]
+            key = tuple(row[field] for field in view.group_by)
+            counts[key] = counts.get(key, 0) + occurrence_count
+
+    return counts_by_view
+
+
+def get_metrics_row(group_by, key, occurrence_count):
+
+    row = [{'field': field, 'value': value} for field, value in zip(group_by, key)]
+    row.append({'field': 'occurrence_count', 'value': occurrence_count})
+
+    return row
+
+
+def get_rollup_rows(proj, view_result, view: RollupView, start_time_str, end_time_str):
+    """
+    Use this method to get the CSV rows of a view result
+
+    Arguments:
+    proj - A Project object (with name property set)
+    view_result - A result from rollup_result for view
+    view - The RollupView of the result
+    start_time_str - A string that represents the start of the time window for the metrics
+    end_time_str - A string that represents the end of the time window for the metrics
+
+    Returns:
+    A list of dicts with the view.get_csv_columns() keys
+    """
+
+    fields = view.group_by + ['occurrence_count']
+    group_by_columns = [ROLLUP_CSV_COLUMNS[field] for field in view.group_by]
+
+    rows = []
+    for timepoint in view_result['timepoints']:
+        for values in response_decoder.decode_metrics_rows(timepoint['metrics_rows'], fields):
+            row = {'Name': proj.name, 'Id': proj.id}
+            row.update(zip(group_by_columns, values))
+            row['OccurrenceCount'] = values[-1]
+            row['StartTime'] = start_time_str
+            row['EndTime'] = end_time_str
+            rows.append(row)
+
+    if len(rows) == 0:
+        logging.info('No {} rows for {} from {} to {}'.format(view.name, proj.name, start_time_str, end_time_str))
+
+    return rows
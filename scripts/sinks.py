@@ -0,0 +1,209 @@
+"""
+Output sinks that the scripts write metrics rows to
+
+A sink keeps one open, buffered file for a whole run. Rows are dicts and can be pushed
+to the sink as each project finishes.
+
+CsvSink - CSV written with the csv module, so titles with commas or quotes are quoted correctly
+JsonLinesSink - One JSON object per line
+ParquetSink - A Parquet file (requires the pyarrow package: pip3 install pyarrow)
+
+Usage:
+
+with open_sink('results.csv', ['Name', 'Id']) as sink:
+    sink.write_rows([{'Name': 'my-project', 'Id': 1}])
+"""
+
+import csv
+import json
+import os
+
+
+# Bytes buffered in memory before rows are written to disk
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Rows buffered in memory before a Parquet row group is written
+DEFAULT_PARQUET_BATCH_SIZE = 50000
+
+SINK_FORMATS = ['csv', 'jsonl', 'parquet']
+
+
+class CsvSink:
+    """
+    A class that writes rows to a CSV file
+    """
+
+    def __init__(self, path, fieldnames, append=False, buffer_size=DEFAULT_BUFFER_SIZE):
+
+        self.path = path
+        self.fieldnames = fieldnames
+
+        # Only write the header to a new or empty file
+        write_header = not (append and os.path.exists(path) and os.path.getsize(path) > 0)
+
+        self.file = open(path, 'a' if append else 'w', newline='', buffering=buffer_size)
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+        if write_header:
+            self.writer.writeheader()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class JsonLinesSink:
+    """
+    A class that writes rows to a JSON Lines file
+    """
+
+    def __init__(self, path, fieldnames, append=False, buffer_size=DEFAULT_BUFFER_SIZE):
+
+        self.path = path
+        self.fieldnames = fieldnames
+        self.file = open(path, 'a' if append else 'w', buffering=buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_row(self, row):
+        self.file.write(json.dumps({field: row.get(field) for field in self.fieldnames}))
+        self.file.write('\n')
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """
+    A class that writes rows to a Parquet file in row groups of batch_size rows
+    """
+
+    def __init__(self, path, fieldnames, append=False, batch_size=DEFAULT_PARQUET_BATCH_SIZE):
+
+        if append:
+            raise ValueError('Rows can not be appended to an existing Parquet file')
+
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.fieldnames = fieldnames
+        self.batch_size = batch_size
+
+        self.rows = []
+        self.writer = None
+        self.parquet = pyarrow.parquet
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.write_row(row)
+
+    def flush(self):
+
+        if len(self.rows) == 0:
+            return
+
+        columns = {field: [row.get(field) for row in self.rows] for field in self.fieldnames}
+        table = self.pyarrow.table(columns)
+
+        if self.writer is None:
+            self.writer = self.parquet.ParquetWriter(self.path, table.schema)
+
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def get_sink_format(path):
+    """
+    Returns the sink format for a file name from its extension
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.jsonl':
+        return 'jsonl'
+
+    if extension == '.parquet':
+        return 'parquet'
+
+    return 'csv'
+
+
+def open_sink(path, fieldnames, sink_format=None, append=False):
+    """
+    Use this method to open a sink for a run
+
+    Arguments:
+    path - The output file
+    fieldnames - The list of column names, in the order they are written
+    sink_format - 'csv', 'jsonl' or 'parquet'. The format is chosen from the file extension if not set
+    append - If True rows are appended to an existing file
+
+    Returns:
+    A CsvSink, JsonLinesSink or ParquetSink object
+    """
+
+    if sink_format is None:
+        sink_format = get_sink_format(path)
+
+    if sink_format == 'csv':
+        return CsvSink(path, fieldnames, append)
+
+    if sink_format == 'jsonl':
+        return JsonLinesSink(path, fieldnames, append)
+
+    if sink_format == 'parquet':
+        return ParquetSink(path, fieldnames, append)
+
+    raise ValueError('Unknown sink format {}. Allowed formats are {}'.format(sink_format, SINK_FORMATS))
+
+
+def get_output_file_name(path, sink_format):
+    """
+    Returns path with the file extension for sink_format
+    """
+
+    extensions = {'csv': '.csv', 'jsonl': '.jsonl', 'parquet': '.parquet'}
+
+    return os.path.splitext(path)[0] + extensions[sink_format]
@@ -0,0 +1,286 @@
+"""
+Retry and adaptive concurrency for Rollbar API calls
+
+Rollbar limits the number of API calls per access token in each rate limit window and
+returns HTTP 429 when the limit is reached. Every response has these headers:
+
+X-Rate-Limit-Limit - The number of calls allowed in the window
+X-Rate-Limit-Remaining - The number of calls left in the window
+X-Rate-Limit-Reset - The unix epoch time (seconds) when the window resets
+X-Rate-Limit-Remaining-Seconds - The seconds until the window resets
+
+RetryPolicy decides which responses are retried and how long to wait. Waits use
+jittered exponential backoff, or the time until the rate limit window resets for a 429.
+
+Throttle (and AsyncThrottle for asyncio) bounds the number of requests in flight with an
+AIMD limit: the limit grows by about one for each limit's worth of successful responses and
+is halved when a 429 is returned. Rate limits are per access token, so when the limit of a
+token is used up the requests for that token wait for the window to reset instead of each
+one getting a 429, while requests for other tokens carry on.
+
+ApiClient and AsyncApiClient use both, so every call in metrics_base is retried and throttled.
+"""
+
+import logging
+import random
+import threading
+import time
+
+
+# Responses with these status codes are retried
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+DEFAULT_MAX_RETRIES = 5
+
+# Seconds for the first backoff. The maximum backoff doubles on each retry up to DEFAULT_MAX_DELAY
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30.0
+
+# The limit is multiplied by this factor when a 429 is returned
+DEFAULT_DECREASE_FACTOR = 0.5
+
+
+class RetryPolicy:
+    """
+    A class that decides if a request is retried and how long to wait before the retry
+    """
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY):
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, attempt, status_code=None):
+        """
+        Returns True if the request should be retried
+
+        Arguments:
+        attempt - The number of the attempt that just finished, starting at 0
+        status_code - The response status code, or None if the request raised a connection error
+        """
+
+        if attempt >= self.max_retries:
+            return False
+
+        return status_code is None or status_code in RETRY_STATUS_CODES
+
+    def get_delay(self, attempt, status_code=None, headers=None):
+        """
+        Returns the seconds to wait before the next attempt
+        """
+
+        reset_seconds = get_rate_limit_reset_seconds(headers)
+        if status_code == 429 and reset_seconds is not None:
+            return min(self.max_delay, reset_seconds) + random.uniform(0, self.base_delay)
+
+        # Full jitter spreads the retries of many threads over the whole backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class AimdLimit:
+    """
+    A class that keeps the additive increase / multiplicative decrease limit of requests in flight.
+    It is not thread safe, Throttle and AsyncThrottle hold a lock while using it
+    """
+
+    def __init__(self, max_limit, initial_limit=None, min_limit=1, decrease_factor=DEFAULT_DECREASE_FACTOR):
+
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease_factor = decrease_factor
+        self.limit = float(max_limit if initial_limit is None else initial_limit)
+
+        # Requests for an access token are not sent before this time (time.monotonic)
+        # when the rate limit of the token is used up
+        self.pause_until = {}
+        self.last_decrease_time = 0.0
+
+        self.response_count = 0
+        self.rate_limited_count = 0
+        self.min_seen_limit = self.limit
+
+    def get_slots(self):
+        return max(self.min_limit, int(self.limit))
+
+    def on_response(self, start_time, status_code=None, headers=None, key=None, now=None):
+        """
+        Use this method to update the limit when a request finishes
+
+        Arguments:
+        start_time - The time.monotonic() when the request was sent
+        status_code - The response status code, or None if the request raised a connection error
+        headers - The response headers
+        key - The access token of the request
+        now - The current time.monotonic(). Only set by callers that already have it
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        self.response_count += 1
+
+        reset_seconds = get_rate_limit_reset_seconds(headers)
+        remaining = get_header_int(headers, 'X-Rate-Limit-Remaining')
+        if reset_seconds is not None and (status_code == 429 or remaining == 0):
+            self.pause_until[key] = max(self.pause_until.get(key, 0.0), now + reset_seconds)
+
+        if status_code == 429:
+            self.rate_limited_count += 1
+
+            # Only the first 429 of the requests sent with the old limit decreases it
+            if start_time >= self.last_decrease_time:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.min_seen_limit = min(self.min_seen_limit, self.limit)
+                self.last_decrease_time = now
+
+        elif status_code is not None and status_code < 500:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def get_pause_seconds(self, key=None, now=None):
+
+        if now is None:
+            now = time.monotonic()
+
+        return max(0.0, self.pause_until.get(key, 0.0) - now)
+
+    def log_stats(self, name):
+
+        msg = '{} limit={:.1f} min_limit={:.1f} responses={} rate_limited={}'
+        logging.info(msg.format(name, self.limit, self.min_seen_limit, self.response_count,
+                                self.rate_limited_count))
+
+
+class Throttle:
+    """
+    A class that bounds the number of requests in flight from many threads
+
+    Usage:
+
+    start_time = throttle.acquire(access_token)
+    resp = session.request(...)
+    throttle.release(start_time, resp.status_code, resp.headers, access_token)
+    """
+
+    def __init__(self, max_limit, initial_limit=None, min_limit=1):
+
+        self.aimd = AimdLimit(max_limit, initial_limit, min_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, key=None):
+        """
+        Use this method to wait for a free slot before sending a request
+
+        Arguments:
+        key - The access token of the request
+
+        Returns:
+        The time.monotonic() when the slot was taken, to pass to release
+        """
+
+        with self.condition:
+            while True:
+                pause_seconds = self.aimd.get_pause_seconds(key)
+                if pause_seconds > 0:
+                    self.condition.wait(pause_seconds)
+                elif self.in_flight >= self.aimd.get_slots():
+                    self.condition.wait()
+                else:
+                    break
+
+            self.in_flight += 1
+
+        return time.monotonic()
+
+    def release(self, start_time, status_code=None, headers=None, key=None):
+        """
+        Use this method to free the slot when the response (or a connection error) is returned
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            self.aimd.on_response(start_time, status_code, headers, key)
+            self.condition.notify_all()
+
+    def log_stats(self):
+        self.aimd.log_stats('Throttle')
+
+
+class AsyncThrottle:
+    """
+    A class that bounds the number of requests in flight from an asyncio event loop.
+    The same as Throttle, but acquire must be awaited
+    """
+
+    def __init__(self, max_limit, initial_limit=None, min_limit=1):
+        import asyncio
+
+        self.aimd = AimdLimit(max_limit, initial_limit, min_limit)
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, key=None):
+        import asyncio
+
+        async with self.condition:
+            while True:
+                pause_seconds = self.aimd.get_pause_seconds(key)
+                if pause_seconds > 0:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), pause_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+                elif self.in_flight >= self.aimd.get_slots():
+                    await self.condition.wait()
+                else:
+                    break
+
+            self.in_flight += 1
+
+        return time.monotonic()
+
+    async def release(self, start_time, status_code=None, headers=None, key=None):
+
+        async with self.condition:
+            self.in_flight -= 1
+            self.aimd.on_response(start_time, status_code, headers, key)
+            self.condition.notify_all()
+
+    def log_stats(self):
+        self.aimd.log_stats('AsyncThrottle')
+
+
+def get_rate_limit_reset_seconds(headers):
+    """
+    Returns the seconds until the rate limit window resets, or None if the headers do not say
+    """
+
+    remaining_seconds = get_header_int(headers, 'X-Rate-Limit-Remaining-Seconds')
+    if remaining_seconds is not None:
+        return max(0, remaining_seconds)
+
+    reset_time = get_header_int(headers, 'X-Rate-Limit-Reset')
+    if reset_time is not None:
+        return max(0, reset_time - time.time())
+
+    return None
+
+
+def get_header_int(headers, name):
+    #
+    # Header lookups are case insensitive for both requests and aiohttp headers
+    #
+
+    if headers is None:
+        return None
+
+    value = headers.get(name)
+    if value is None:
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        return None
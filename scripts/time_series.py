@@ -0,0 +1,244 @@
+"""
+Dense time series of granular Metrics API results
+
+A Metrics API query with a granularity (e.g. 'hour' or 'day') returns a timepoint for each hour
+or day of the query window. decode_series reads every timepoint of the result into a MetricsSeries:
+a NumPy matrix for each metric with a row for each group (e.g. each item and environment) and a
+column for each timepoint. A group with no row in a timepoint has 0 for that timepoint.
+
+Trends, spikes and moving sums for thousands of items are then array operations on the matrices,
+instead of a Metrics API query for each window.
+
+Requires numpy (pip3 install numpy)
+
+Usage:
+
+series = mb.get_item_metrics_series(proj, start_time_unix, end_time_unix, 'hour')
+counts = series.get_values('occurrence_count')
+last_day = series.get_moving_sum(24)
+for key, timestamp, value, baseline in series.get_spikes(window=24):
+    print(series.labels[key]['item_title'], timestamp, value, baseline)
+"""
+
+from array import array
+
+import numpy as np
+
+import response_decoder
+
+
+# Seconds in each timepoint for the Metrics API granularity values
+GRANULARITY_SECONDS = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60
+}
+
+# The group key, metrics and labels of the series from metrics_base.get_item_metrics_series.
+# Rows of the same item and environment with a different level or status (e.g. an item that was
+# resolved and then reactivated in the window) are added up
+ITEM_SERIES_GROUP_BY = ['item_id', 'environment']
+ITEM_SERIES_METRICS = ['occurrence_count', 'ip_address_count']
+ITEM_SERIES_LABELS = ['item_title', 'item_counter', 'item_level', 'item_status']
+
+
+class MetricsSeries:
+    """
+    A class that stores a (group x time) matrix for each metric of a granular Metrics API result
+
+    keys - A list of group keys, tuples of the group_by values. keys[i] is the key of row i
+    key_index - A dict of group key to row number
+    timestamps - A NumPy array with the start time (unix epoch seconds) of each column
+    values - A dict of metric name to an int64 NumPy matrix with len(keys) rows and len(timestamps) columns
+    labels - A dict of group key to a dict of label field values e.g. the item title, from the last timepoint
+    """
+
+    def __init__(self, group_by, keys, timestamps, values, labels=None):
+
+        self.group_by = list(group_by)
+        self.keys = keys
+        self.key_index = {key: index for index, key in enumerate(keys)}
+        self.timestamps = timestamps
+        self.values = values
+        self.labels = labels if labels is not None else {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_values(self, metric='occurrence_count'):
+        return self.values[metric]
+
+    def get_series(self, key, metric='occurrence_count'):
+        """
+        Returns the values of one group for each timepoint
+        """
+
+        return self.values[metric][self.key_index[key]]
+
+    def get_totals(self, metric='occurrence_count'):
+        """
+        Returns the sum over all the timepoints for each group.
+        For count_distinct metrics (e.g. ip_address_count) the sum is an upper bound
+        """
+
+        return self.values[metric].sum(axis=1)
+
+    def get_moving_sum(self, window, metric='occurrence_count'):
+        """
+        Use this method to get the sum of the last window timepoints for each group and timepoint
+
+        Arguments:
+        window - The number of timepoints in each sum e.g. 24 for a daily sum of an hourly series
+        metric - The metric name
+
+        Returns:
+        A matrix with the same shape as the values. The first columns add up fewer than window timepoints
+        """
+
+        cumulative_sums = get_cumulative_sums(self.values[metric])
+        columns = np.arange(1, len(self.timestamps) + 1)
+
+        return cumulative_sums[:, columns] - cumulative_sums[:, np.maximum(0, columns - window)]
+
+    def get_trends(self, metric='occurrence_count'):
+        """
+        Returns the least squares slope of each group, in the change of the metric per timepoint
+        """
+
+        values = self.values[metric].astype(np.float64)
+        if values.shape[1] < 2:
+            return np.zeros(len(self.keys))
+
+        positions = np.arange(values.shape[1], dtype=np.float64)
+        positions -= positions.mean()
+
+        return (values - values.mean(axis=1, keepdims=True)) @ positions / (positions @ positions)
+
+    def get_spikes(self, window=24, factor=3.0, min_value=10, metric='occurrence_count'):
+        """
+        Use this method to find the timepoints where a group has many more occurrences than before
+
+        Arguments:
+        window - The number of earlier timepoints in the baseline
+        factor - A timepoint is a spike if its value is more than factor times the baseline
+        min_value - Timepoints with a lower value are never spikes
+        metric - The metric name
+
+        Returns:
+        A list of (key, timestamp, value, baseline) tuples, where baseline is the mean of the earlier
+        timepoints in the window, in the order of the groups and then the timepoints
+        """
+
+        values = self.values[metric]
+        cumulative_sums = get_cumulative_sums(values)
+
+        columns = np.arange(len(self.timestamps))
+        window_starts = np.maximum(0, columns - window)
+        window_lengths = columns - window_starts
+
+        baselines = (cumulative_sums[:, columns] - cumulative_sums[:, window_starts]) / np.maximum(window_lengths, 1)
+        is_spike = (window_lengths > 0) & (values >= min_value) & (values > factor * baselines)
+
+        spikes = []
+        for row, column in zip(*np.nonzero(is_spike)):
+            spikes.append((self.keys[row], int(self.timestamps[column]), int(values[row, column]),
+                           float(baselines[row, column])))
+
+        return spikes
+
+
+def get_cumulative_sums(values):
+    #
+    # Cumulative sums along time with a leading column of zeros, so the sum of columns a to b-1 is
+    # cumulative_sums[:, b] - cumulative_sums[:, a]
+    #
+
+    cumulative_sums = np.zeros((values.shape[0], values.shape[1] + 1), dtype=values.dtype)
+    np.cumsum(values, axis=1, out=cumulative_sums[:, 1:])
+
+    return cumulative_sums
+
+
+def decode_series(result, group_by, metrics, start_time_unix=None, end_time_unix=None, granularity=None,
+                  label_fields=None):
+    """
+    Use this method to decode every timepoint of a Metrics API result into a MetricsSeries
+
+    Arguments:
+    result - A Metrics API result dict
+    group_by - The fields of the group key of each row of the matrices
+    metrics - The metric fields e.g. ['occurrence_count']. Missing values are 0
+    start_time_unix - The start time of the query. If this, end_time_unix and granularity are set there is
+                      a column for each hour (or day) of the window, including the ones with no timepoint
+    end_time_unix - The end time of the query
+    granularity - The granularity of the query e.g. 'hour'
+    label_fields - Optional fields that are kept for each group in MetricsSeries.labels
+
+    Returns:
+    A MetricsSeries
+    """
+
+    label_fields = list(label_fields) if label_fields is not None else []
+    fields = list(group_by) + list(metrics) + label_fields
+    metric_positions = range(len(group_by), len(group_by) + len(metrics))
+
+    timepoints = sorted(result['timepoints'], key=lambda timepoint: timepoint['timestamp'])
+    timestamps = get_series_timestamps([timepoint['timestamp'] for timepoint in timepoints],
+                                       start_time_unix, end_time_unix, granularity)
+    column_index = {timestamp: column for column, timestamp in enumerate(timestamps.tolist())}
+
+    keys = []
+    key_index = {}
+    labels = {}
+
+    # The row, column and metric values of each cell, in typed arrays until the matrices are filled
+    rows = array('q')
+    columns = array('q')
+    metric_values = [array('q') for _ in metrics]
+
+    for timepoint in timepoints:
+        column = column_index[timepoint['timestamp']]
+        for values in response_decoder.decode_metrics_rows(timepoint['metrics_rows'], fields):
+            key = values[:len(group_by)]
+            row = key_index.get(key)
+            if row is None:
+                row = len(keys)
+                key_index[key] = row
+                keys.append(key)
+
+            rows.append(row)
+            columns.append(column)
+            for metric_number, position in enumerate(metric_positions):
+                metric_values[metric_number].append(int(values[position] or 0))
+
+            if len(label_fields) > 0:
+                labels[key] = dict(zip(label_fields, values[len(group_by) + len(metrics):]))
+
+    row_numbers = np.frombuffer(rows, dtype=np.int64) if len(rows) > 0 else np.zeros(0, dtype=np.int64)
+    column_numbers = np.frombuffer(columns, dtype=np.int64) if len(columns) > 0 else np.zeros(0, dtype=np.int64)
+
+    values = {}
+    for metric, cell_values in zip(metrics, metric_values):
+        matrix = np.zeros((len(keys), len(timestamps)), dtype=np.int64)
+        if len(cell_values) > 0:
+            # Rows with the same key in a timepoint are added up
+            np.add.at(matrix, (row_numbers, column_numbers), np.frombuffer(cell_values, dtype=np.int64))
+        values[metric] = matrix
+
+    return MetricsSeries(group_by, keys, timestamps, values, labels)
+
+
+def get_series_timestamps(result_timestamps, start_time_unix, end_time_unix, granularity):
+    #
+    # The result only has timepoints with rows. If the granularity is known the missing hours
+    # (or days) are added, in step with the timestamps of the result
+    #
+
+    step = GRANULARITY_SECONDS.get(granularity)
+    if step is None or start_time_unix is None or end_time_unix is None:
+        return np.array(sorted(set(result_timestamps)), dtype=np.int64)
+
+    offset = result_timestamps[0] % step if len(result_timestamps) > 0 else 0
+    first_timestamp = start_time_unix - (start_time_unix - offset) % step
+    grid = np.arange(first_timestamp, end_time_unix, step, dtype=np.int64)
+
+    return np.union1d(grid, np.array(result_timestamps, dtype=np.int64))
@@ -0,0 +1,136 @@
+"""
+A bounded heap that keeps the top K Item metrics by a sort field
+
+Only K rows are kept however many rows are added, so the top items of every project and of
+the whole account can be found while the metrics of each project are read and then dropped.
+
+Rows with the same sort value are ordered by project_id, item id and environment (lowest first),
+so the same rows always give the same top K whatever order they are added in.
+Rows with no value for the sort field are skipped, like pandas nlargest.
+
+Usage:
+
+top_items = TopK(10, 'occurrence_count')
+top_items.add_batch(item_metrics_batch)
+for im in top_items.get_items():
+    print(im)
+"""
+
+import heapq
+
+from metrics_base import ItemMetrics, ItemMetricsBatch
+
+
+class TopKEntry:
+    """
+    A heap entry for one row. The heap is a min heap, so an entry is less than another entry
+    when it ranks lower: a smaller sort value, or the same sort value and a larger tie key
+    """
+
+    __slots__ = ['value', 'tie_key', 'item_metrics']
+
+    def __init__(self, value, tie_key, item_metrics):
+
+        self.value = value
+        self.tie_key = tie_key
+        self.item_metrics = item_metrics
+
+    def __lt__(self, other):
+
+        if self.value != other.value:
+            return self.value < other.value
+
+        return self.tie_key > other.tie_key
+
+
+class TopK:
+    """
+    A class that keeps the K Item metrics with the highest value of sort_field
+    """
+
+    def __init__(self, k, sort_field='occurrence_count'):
+
+        if sort_field not in ItemMetricsBatch.COLUMNS:
+            raise ValueError('Unknown sort field {}'.format(sort_field))
+
+        self.k = k
+        self.sort_field = sort_field
+        self.heap = []
+        self.row_count = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, im: ItemMetrics):
+        """
+        Use this method to add one ItemMetrics object
+        """
+
+        self.row_count += 1
+        self.push(getattr(im, self.sort_field), get_tie_key(im.project_id, im.id, im.environment), lambda: im)
+
+    def add_all(self, item_metrics_list):
+        """
+        Use this method to add the ItemMetrics objects of a list or generator
+        """
+
+        for im in item_metrics_list:
+            self.add(im)
+
+    def add_batch(self, batch: ItemMetricsBatch):
+        """
+        Use this method to add the rows of an ItemMetricsBatch. An ItemMetrics object is only
+        created for the rows that are in the top K when they are added
+        """
+
+        values = batch.columns[self.sort_field]
+        missing_value = batch.MISSING_VALUE if self.sort_field in batch.INT_COLUMNS else None
+
+        for index in range(len(batch)):
+            self.row_count += 1
+
+            value = values[index]
+            if value == missing_value:
+                continue
+
+            tie_key = get_tie_key(batch.get_value('project_id', index), batch.get_value('id', index),
+                                  batch.get_value('environment', index))
+            self.push(value, tie_key, lambda: batch.get_item_metrics(index))
+
+    def push(self, value, tie_key, make_item_metrics):
+        #
+        # make_item_metrics is only called when the row goes into the heap
+        #
+
+        if value is None or self.k <= 0:
+            return
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, TopKEntry(value, tie_key, make_item_metrics()))
+            return
+
+        lowest = self.heap[0]
+        if value < lowest.value or (value == lowest.value and tie_key >= lowest.tie_key):
+            return
+
+        heapq.heapreplace(self.heap, TopKEntry(value, tie_key, make_item_metrics()))
+
+    def get_items(self):
+        """
+        Returns:
+        A list of the top ItemMetrics objects, highest sort value first
+        """
+
+        entries = sorted(self.heap, reverse=True)
+
+        return [entry.item_metrics for entry in entries]
+
+
+def get_tie_key(project_id, item_id, environment):
+    #
+    # Missing values sort first so the key can always be compared
+    #
+
+    return (-1 if project_id is None else project_id,
+            -1 if item_id is None else item_id,
+            '' if environment is None else environment)
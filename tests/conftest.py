@@ -0,0 +1,70 @@
+"""
+Shared fixtures for the tests of the scripts
+
+The scripts are flat modules in scripts/, so that folder is put on sys.path. The tests call the
+scripts against a FakeRollbarApi server running in a background thread instead of api.rollbar.com.
+"""
+
+import os
+import sys
+
+import pytest
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+import api_client  # noqa: E402
+import metrics_base as mb  # noqa: E402
+from fake_rollbar_api import FakeRollbarApi  # noqa: E402
+
+
+ACCOUNT_READ_TOKEN = 'fake-account-token'
+
+
+@pytest.fixture
+def fake_api():
+    server = FakeRollbarApi(project_count=3, seed=1).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(fake_api, monkeypatch):
+    #
+    # An ApiClient for the fake API that is also the shared client, so functions that do not take
+    # a client use the fake API too
+    #
+
+    test_client = api_client.ApiClient(fake_api.base_url)
+    monkeypatch.setenv(api_client.BASE_URL_ENV_VAR, fake_api.base_url)
+    monkeypatch.setenv('ACCOUNT_READ_ACCESS_TOKEN_FOR_METRICS', ACCOUNT_READ_TOKEN)
+    monkeypatch.setattr(api_client, '_default_client', test_client)
+    yield test_client
+    test_client.close()
+
+
+@pytest.fixture
+def proj():
+    p = mb.Project()
+    p.id = 1
+    p.name = 'project-1'
+    p.token = 'token-1'
+    return p
+
+
+@pytest.fixture
+def sorted_rows():
+    #
+    # A function that returns the rows of a Metrics API result as a sorted list of (timestamp, cells),
+    # so results can be compared whatever the order of their rows
+    #
+
+    def get_sorted_rows(result):
+        rows = []
+        for timepoint in result['timepoints']:
+            for row in timepoint['metrics_rows']:
+                rows.append((timepoint.get('timestamp'), sorted((cell['field'], cell['value']) for cell in row)))
+
+        return sorted(rows, key=repr)
+
+    return get_sorted_rows
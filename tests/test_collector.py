@@ -0,0 +1,40 @@
+import pytest
+
+from collector import ALLOWED_PROJECT_TOKEN_NAMES, Collector
+from project_registry import open_project_registry
+
+
+ACCOUNT_READ_TOKEN = 'fake-account-token'
+
+
+@pytest.fixture
+def registry_path(tmp_path):
+    return str(tmp_path / 'registry.json')
+
+
+@pytest.fixture
+def forbidden_project(fake_api, monkeypatch):
+    # The token lookup of project 2 gets HTTP 403
+    get_access_tokens = fake_api.get_access_tokens
+    monkeypatch.setattr(fake_api, 'get_access_tokens',
+                        lambda proj_id: None if proj_id == 2 else get_access_tokens(proj_id))
+
+
+@pytest.mark.parametrize('first', [True, False])
+def test_failed_token_lookup_is_not_stored_in_the_registry(client, forbidden_project, registry_path, first):
+    collector = Collector(ACCOUNT_READ_TOKEN, None, client=client, registry=open_project_registry(path=registry_path))
+
+    collector.refresh_projects(first=first)
+
+    assert sorted(collector.projects) == [1, 3]
+    registry = open_project_registry(path=registry_path)
+    assert registry.get_projects(ACCOUNT_READ_TOKEN, ALLOWED_PROJECT_TOKEN_NAMES) is None
+
+
+def test_refreshed_projects_are_stored_in_the_registry(client, registry_path):
+    collector = Collector(ACCOUNT_READ_TOKEN, None, client=client, registry=open_project_registry(path=registry_path))
+
+    collector.refresh_projects()
+
+    registry = open_project_registry(path=registry_path)
+    assert [proj.id for proj in registry.get_projects(ACCOUNT_READ_TOKEN, ALLOWED_PROJECT_TOKEN_NAMES)] == [1, 2, 3]
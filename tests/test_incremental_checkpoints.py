@@ -0,0 +1,86 @@
+import asyncio
+import csv
+import json
+
+import pytest
+
+import get_occurrences_by_env as occ
+from checkpoints import CheckpointStore
+from project_registry import open_project_registry
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch, client):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(occ, 'open_project_registry',
+                        lambda refresh=False: open_project_registry(refresh, str(tmp_path / 'registry.json')))
+    return tmp_path
+
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.mark.parametrize('use_async', [False, True])
+def test_checkpoint_only_moves_after_rows_are_on_disk(run_dir, monkeypatch, use_async):
+    set_end_time = CheckpointStore.set_end_time
+    checked_ids = []
+
+    def check_rows_on_disk(self, project_id, query_type, end_time_unix):
+        # A crash right after this checkpoint must not lose the rows of the project
+        assert str(project_id) in {row['Id'] for row in read_rows(occ.OUTPUT_CSV_FILE)}
+        checked_ids.append(project_id)
+        set_end_time(self, project_id, query_type, end_time_unix)
+
+    monkeypatch.setattr(CheckpointStore, 'set_end_time', check_rows_on_disk)
+    if use_async:
+        asyncio.run(occ.process_all_async(incremental=True, use_query_cache=False))
+    else:
+        occ.process_all(incremental=True, use_query_cache=False)
+
+    assert sorted(checked_ids) == [1, 2, 3]
+
+
+def test_run_resumes_after_a_failure(run_dir, monkeypatch):
+    get_items_by_env = occ.get_items_by_env
+
+    def fail_on_second_project(proj, *args, **kwargs):
+        if proj.id == 2:
+            raise RuntimeError('crash')
+        return get_items_by_env(proj, *args, **kwargs)
+
+    monkeypatch.setattr(occ, 'get_items_by_env', fail_on_second_project)
+    with pytest.raises(RuntimeError):
+        occ.process_all(incremental=True, use_query_cache=False)
+
+    with open(occ.CHECKPOINT_FILE) as f:
+        assert list(json.load(f)) == ['items_by_env:1']
+
+    rows = read_rows(occ.OUTPUT_CSV_FILE)
+    assert {row['Id'] for row in rows} == {'1'}
+    first_run_row_count = len(rows)
+
+    monkeypatch.setattr(occ, 'get_items_by_env', get_items_by_env)
+    occ.process_all(incremental=True, use_query_cache=False)
+
+    rows = read_rows(occ.OUTPUT_CSV_FILE)
+    row_counts = {proj_id: sum(row['Id'] == proj_id for row in rows) for proj_id in ['1', '2', '3']}
+
+    # The resumed run only collects the projects without a checkpoint, so no project is missing or repeated
+    assert row_counts == {'1': first_run_row_count, '2': first_run_row_count, '3': first_run_row_count}
+    with open(occ.CHECKPOINT_FILE) as f:
+        assert sorted(json.load(f)) == ['items_by_env:1', 'items_by_env:2', 'items_by_env:3']
+
+
+def test_failed_query_does_not_move_the_checkpoint(run_dir, monkeypatch):
+    get_items_by_env = occ.get_items_by_env
+
+    # make_occ_metrics_api_call returns None when the query fails
+    monkeypatch.setattr(occ, 'get_items_by_env',
+                        lambda proj, *args, **kwargs: None if proj.id == 2 else get_items_by_env(proj, *args, **kwargs))
+    occ.process_all(incremental=True, use_query_cache=False)
+
+    with open(occ.CHECKPOINT_FILE) as f:
+        assert sorted(json.load(f)) == ['items_by_env:1', 'items_by_env:3']
+    assert {row['Id'] for row in read_rows(occ.OUTPUT_CSV_FILE)} == {'1', '3'}
@@ -0,0 +1,109 @@
+import time
+
+import pytest
+import requests
+
+import metrics_exporter
+from metrics_exporter import ALLOWED_PROJECT_TOKEN_NAMES, MetricsExporter
+from project_registry import open_project_registry
+
+
+ACCOUNT_READ_TOKEN = 'fake-account-token'
+
+WINDOW_SECONDS = 60 * 60
+
+
+@pytest.fixture
+def registry_path(tmp_path):
+    return str(tmp_path / 'registry.json')
+
+
+@pytest.fixture
+def exporter_url(client, registry_path):
+    exporter = MetricsExporter(ACCOUNT_READ_TOKEN, window_seconds=WINDOW_SECONDS, client=client,
+                               registry=open_project_registry(path=registry_path))
+    server = metrics_exporter.start_http_server(exporter, '127.0.0.1', 0)
+    exporter.start()
+
+    deadline = time.time() + 10
+    while exporter.refresh_count == 0 and time.time() < deadline:
+        time.sleep(0.01)
+
+    yield 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+
+    exporter.stop()
+    server.shutdown()
+    server.server_close()
+
+
+def get_expected_counts(fake_api):
+    #
+    # The occurrence counts of a project by (environment, level, status). The counts of the fake
+    # API only depend on the length of the window
+    #
+
+    query_data = metrics_exporter.get_occurrence_counts_query(0, WINDOW_SECONDS)
+    counts = {}
+    for timepoint in fake_api.get_occurrence_timepoints(query_data)['timepoints']:
+        for row in timepoint['metrics_rows']:
+            values = {cell['field']: cell['value'] for cell in row}
+            key = (values['environment'], values['item_level'], values['item_status'])
+            counts[key] = counts.get(key, 0) + values['occurrence_count']
+
+    return counts
+
+
+def get_samples(page):
+    samples = {}
+    for line in page.splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = value
+
+    return samples
+
+
+def test_metrics_page_has_the_counts_of_every_project(fake_api, exporter_url):
+    resp = requests.get(exporter_url)
+
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == metrics_exporter.TEXT_CONTENT_TYPE
+
+    samples = get_samples(resp.text)
+    expected = get_expected_counts(fake_api)
+    assert len(expected) > 0
+    for proj_id in [1, 2, 3]:
+        project_labels = 'project="project-{0}",project_id="{0}"'.format(proj_id)
+        assert samples['rollbar_exporter_project_up{{{}}}'.format(project_labels)] == '1'
+        for (environment, level, status), count in expected.items():
+            name = 'rollbar_occurrences{{{},environment="{}",level="{}",status="{}"}}'.format(
+                project_labels, environment, level, status)
+            assert samples[name] == str(count)
+
+    assert int(samples['rollbar_exporter_refreshes']) >= 1
+    assert samples['rollbar_exporter_window_seconds'] == str(WINDOW_SECONDS)
+
+
+def test_metrics_page_in_the_openmetrics_format(exporter_url):
+    resp = requests.get(exporter_url, headers={'Accept': 'application/openmetrics-text'})
+
+    assert resp.headers['Content-Type'] == metrics_exporter.OPENMETRICS_CONTENT_TYPE
+    assert 'rollbar_exporter_refreshes_total' in get_samples(resp.text)
+    assert resp.text.endswith('# EOF\n')
+
+
+@pytest.mark.parametrize('refresh_count', [1, 2])
+def test_failed_token_lookup_is_not_stored_in_the_registry(client, fake_api, monkeypatch, registry_path,
+                                                           refresh_count):
+    get_access_tokens = fake_api.get_access_tokens
+    monkeypatch.setattr(fake_api, 'get_access_tokens',
+                        lambda proj_id: None if proj_id == 2 else get_access_tokens(proj_id))
+
+    exporter = MetricsExporter(ACCOUNT_READ_TOKEN, window_seconds=WINDOW_SECONDS, client=client,
+                               registry=open_project_registry(path=registry_path))
+    for i in range(refresh_count):
+        exporter.refresh_projects()
+
+    assert sorted(exporter.project_counts) == [1, 3]
+    registry = open_project_registry(path=registry_path)
+    assert registry.get_projects(ACCOUNT_READ_TOKEN, ALLOWED_PROJECT_TOKEN_NAMES) is None
@@ -0,0 +1,95 @@
+import pytest
+
+import metrics_base as mb
+from metrics_store import MetricsStore, SOURCE_ITEM
+
+
+DAY = 24 * 60 * 60
+
+
+def get_result(counts):
+    #
+    # A Metrics API result grouped by environment and level, from a dict of {(environment, level): count}
+    #
+
+    rows = [[{'field': 'environment', 'value': environment},
+             {'field': 'item_level', 'value': level},
+             {'field': 'occurrence_count', 'value': count}]
+            for (environment, level), count in counts.items()]
+    return {'timepoints': [{'metrics_rows': rows}]}
+
+
+def get_item_metrics(project_id, item_id, start_time_unix, end_time_unix, occurrence_count):
+    im = mb.ItemMetrics()
+    im.project_id = project_id
+    im.project_name = 'project-{}'.format(project_id)
+    im.start_time_unix = start_time_unix
+    im.end_time_unix = end_time_unix
+    im.id = item_id
+    im.environment = 'production'
+    im.level = 'error'
+    im.occurrence_count = occurrence_count
+    return im
+
+
+@pytest.fixture
+def store(tmp_path):
+    with MetricsStore(str(tmp_path / 'metrics.sqlite3')) as metrics_store:
+        yield metrics_store
+
+
+def get_totals(rows):
+    return {(row['environment'], row['level']): row['occurrence_count'] for row in rows}
+
+
+def test_overlapping_runs_are_not_counted_twice(store, proj):
+    # A 30 day run stored on two days in a row
+    store.append_result(proj, get_result({('production', 'error'): 30, ('staging', 'warning'): 3}), 0, 30 * DAY)
+    store.append_result(proj, get_result({('production', 'error'): 31}), DAY, 31 * DAY)
+
+    rows = store.query_rollup(group_by=['environment', 'level'], project_id=proj.id)
+
+    assert get_totals(rows) == {('production', 'error'): 31}
+
+
+def test_consecutive_windows_are_added_up(store, proj):
+    store.append_result(proj, get_result({('production', 'error'): 10}), 0, DAY)
+    store.append_result(proj, get_result({('production', 'error'): 5}), DAY, 2 * DAY)
+
+    rows = store.query_rollup(group_by=['environment', 'level'], project_id=proj.id)
+
+    assert get_totals(rows) == {('production', 'error'): 15}
+
+
+def test_overlap_only_replaces_the_same_project(store, proj):
+    other = mb.Project()
+    other.id = 2
+    other.name = 'project-2'
+
+    store.append_result(proj, get_result({('production', 'error'): 10}), 0, 2 * DAY)
+    store.append_result(other, get_result({('production', 'error'): 7}), DAY, 3 * DAY)
+
+    rows = store.query_rollup(group_by=['project_id'])
+
+    assert [(row['project_id'], row['occurrence_count']) for row in rows] == [(1, 10), (2, 7)]
+
+
+def test_item_metrics_overlapping_runs_are_not_counted_twice(store):
+    # Hourly windows of a granular run, then a second run that starts an hour later
+    store.append_item_metrics([get_item_metrics(1, 100, hour * 3600, (hour + 1) * 3600, 2) for hour in range(4)])
+    store.append_item_metrics([get_item_metrics(1, 100, hour * 3600, (hour + 1) * 3600, 3) for hour in range(1, 5)])
+
+    rows = store.query_rollup(group_by=['item_id'], source=SOURCE_ITEM)
+
+    assert rows == [{'item_id': 100, 'occurrence_count': 2 + 4 * 3}]
+
+
+def test_time_range_includes_windows_that_cover_it(store, proj):
+    # A window that started before the range, one inside it and one after it
+    store.append_result(proj, get_result({('production', 'error'): 10}), 0, 10 * DAY)
+    store.append_result(proj, get_result({('production', 'error'): 5}), 10 * DAY, 11 * DAY)
+    store.append_result(proj, get_result({('production', 'error'): 1}), 20 * DAY, 21 * DAY)
+
+    rows = store.query_rollup(group_by=['environment', 'level'], start_time_unix=7 * DAY, end_time_unix=20 * DAY)
+
+    assert get_totals(rows) == {('production', 'error'): 15}
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+import api_client
+import async_metrics_base as amb
+import metrics_base as mb
+import projects_dashboard
+from project_registry import open_project_registry
+
+
+ACCOUNT_READ_TOKEN = 'fake-account-token'
+
+ALLOWED_TOKEN_NAMES = ['metrics_api_token', 'read']
+
+
+@pytest.fixture
+def two_tokens(fake_api, monkeypatch):
+    #
+    # Every project has both allowed token names
+    #
+
+    def get_access_tokens(proj_id):
+        return [{'name': 'metrics_api_token', 'scopes': ['read'], 'access_token': 'metrics-{}'.format(proj_id)},
+                {'name': 'read', 'scopes': ['read'], 'access_token': 'read-{}'.format(proj_id)}]
+
+    monkeypatch.setattr(fake_api, 'get_access_tokens', get_access_tokens)
+
+
+def get_ids_and_tokens(proj_list):
+    return [(proj.id, proj.token) for proj in proj_list]
+
+
+def test_project_with_two_allowed_tokens_is_listed_once(client, two_tokens):
+    proj_list = mb.get_project_objects(ACCOUNT_READ_TOKEN, ALLOWED_TOKEN_NAMES, client=client)
+
+    assert get_ids_and_tokens(proj_list) == [(1, 'metrics-1'), (2, 'metrics-2'), (3, 'metrics-3')]
+
+
+def test_async_project_with_two_allowed_tokens_is_listed_once(client, two_tokens):
+
+    async def get_projects():
+        async with amb.AsyncApiClient() as async_client:
+            return await amb.get_project_objects(ACCOUNT_READ_TOKEN, ALLOWED_TOKEN_NAMES, async_client)
+
+    assert get_ids_and_tokens(asyncio.run(get_projects())) == [(1, 'metrics-1'), (2, 'metrics-2'), (3, 'metrics-3')]
+
+
+def test_dashboard_projects_from_the_registry_match_the_first_run(client, two_tokens, tmp_path, monkeypatch):
+    registry_path = str(tmp_path / 'registry.json')
+    monkeypatch.setattr(projects_dashboard, 'open_project_registry',
+                        lambda refresh=False: open_project_registry(refresh, registry_path))
+
+    first_run = projects_dashboard.get_projects(ACCOUNT_READ_TOKEN)
+    second_run = projects_dashboard.get_projects(ACCOUNT_READ_TOKEN)
+
+    assert get_ids_and_tokens(first_run) == get_ids_and_tokens(second_run)
+    assert [proj.id for proj in first_run] == [1, 2, 3]
+
+
+@pytest.fixture
+def failed_lookups(fake_api, monkeypatch):
+    #
+    # Project 2 gets HTTP 403 and the request for project 3 times out
+    #
+
+    get_access_tokens = fake_api.get_access_tokens
+
+    def get_access_tokens_or_forbidden(proj_id):
+        return None if proj_id == 2 else get_access_tokens(proj_id)
+
+    monkeypatch.setattr(fake_api, 'get_access_tokens', get_access_tokens_or_forbidden)
+
+    def time_out(get):
+        def get_or_time_out(self, path, access_token, timeout=None):
+            if path == '/api/1/project/3/access_tokens':
+                raise TimeoutError('timed out')
+            return get(self, path, access_token, timeout)
+        return get_or_time_out
+
+    def async_time_out(get):
+        async def get_or_time_out(self, path, access_token, timeout=None):
+            if path == '/api/1/project/3/access_tokens':
+                raise TimeoutError('timed out')
+            return await get(self, path, access_token, timeout)
+        return get_or_time_out
+
+    monkeypatch.setattr(api_client.ApiClient, 'get', time_out(api_client.ApiClient.get))
+    monkeypatch.setattr(amb.AsyncApiClient, 'get', async_time_out(amb.AsyncApiClient.get))
+
+
+def test_failed_token_lookups_skip_only_those_projects(client, failed_lookups, tmp_path):
+    registry_path = str(tmp_path / 'registry.json')
+    proj_list = mb.get_project_objects(ACCOUNT_READ_TOKEN, ALLOWED_TOKEN_NAMES, client=client,
+                                       registry=open_project_registry(path=registry_path))
+
+    assert get_ids_and_tokens(proj_list) == [(1, 'token-1')]
+
+    # The project list is not stored, so the next run looks the projects up again
+    registry = open_project_registry(path=registry_path)
+    assert registry.get_projects(ACCOUNT_READ_TOKEN, ALLOWED_TOKEN_NAMES) is None
+
+
+def test_async_failed_token_lookups_skip_only_those_projects(client, failed_lookups):
+
+    async def get_projects():
+        async with amb.AsyncApiClient() as async_client:
+            return await amb.get_project_objects(ACCOUNT_READ_TOKEN, ALLOWED_TOKEN_NAMES, async_client)
+
+    assert get_ids_and_tokens(asyncio.run(get_projects())) == [(1, 'token-1')]
+
+
+@pytest.mark.parametrize('two_allowed_tokens, token', [(False, 'token-1'), (True, 'metrics-1')])
+def test_failed_token_lookups_leave_the_project_token_unset(client, request, two_allowed_tokens, token):
+    # With two allowed tokens the first one is chosen, the same as get_project_objects
+    if two_allowed_tokens:
+        request.getfixturevalue('two_tokens')
+    request.getfixturevalue('failed_lookups')
+
+    proj_list = mb.get_all_enabled_projects(ACCOUNT_READ_TOKEN, client)
+
+    mb.add_read_token_to_projects(proj_list, ACCOUNT_READ_TOKEN, ALLOWED_TOKEN_NAMES, client=client)
+
+    assert [(proj.id, proj.token) for proj in proj_list] == [(1, token), (2, None), (3, None)]
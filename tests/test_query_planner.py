@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+import async_metrics_base as amb
+import metrics_base as mb
+from fake_rollbar_api import FakeRollbarApi
+from query_planner import QueryPlanner
+
+
+START_TIME = 1700000000
+END_TIME = START_TIME + 7 * 24 * 60 * 60
+
+MAX_QUERY_ROWS = 8
+
+
+@pytest.fixture
+def fake_api():
+    # Queries with more than MAX_QUERY_ROWS rows get HTTP 422, like a query that is too large
+    server = FakeRollbarApi(project_count=3, seed=1, max_query_rows=MAX_QUERY_ROWS).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def full_result(fake_api):
+    # The result the API would return without a row limit
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+    return fake_api.get_occurrence_timepoints(query_data)
+
+
+def test_too_large_query_fails_without_a_planner(client, proj):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    assert mb.call_occ_metrics_api(proj, query_data, client) == (422, None)
+
+
+def test_split_query_has_the_rows_of_the_full_query(client, proj, full_result, sorted_rows):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    result = QueryPlanner().run(proj, query_data, client)
+
+    assert sorted_rows(result) == sorted_rows(full_result)
+
+
+def test_async_split_query_has_the_rows_of_the_full_query(client, proj, full_result, sorted_rows):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    async def run():
+        async with amb.AsyncApiClient() as async_client:
+            return await QueryPlanner().run_async(proj, query_data, async_client)
+
+    assert sorted_rows(asyncio.run(run())) == sorted_rows(full_result)
+
+
+def test_async_item_metrics_batch_uses_the_planner(client, proj, full_result):
+
+    async def get_batch(query_planner):
+        async with amb.AsyncApiClient() as async_client:
+            return await amb.get_item_metrics_batch(proj, START_TIME, END_TIME, async_client,
+                                                    query_planner=query_planner)
+
+    assert len(asyncio.run(get_batch(None))) == 0
+    assert len(asyncio.run(get_batch(QueryPlanner()))) == sum(len(timepoint['metrics_rows'])
+                                                               for timepoint in full_result['timepoints'])
+
+
+@pytest.fixture
+def truncating(fake_api, monkeypatch):
+    # Rows over MAX_QUERY_ROWS are cut off with HTTP 200 instead of getting HTTP 422
+    monkeypatch.setattr(fake_api, 'truncate_rows', True)
+
+
+def test_truncated_query_is_split_until_no_result_is_truncated(client, proj, truncating, full_result, sorted_rows):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    truncated = mb.make_occ_metrics_api_call(proj, query_data, client)
+    result = QueryPlanner(row_limit=MAX_QUERY_ROWS).run(proj, query_data, client)
+
+    assert len(sorted_rows(truncated)) == MAX_QUERY_ROWS
+    assert sorted_rows(result) == sorted_rows(full_result)
+
+
+def test_async_truncated_query_is_split_until_no_result_is_truncated(client, proj, truncating, full_result,
+                                                                      sorted_rows):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    async def run():
+        async with amb.AsyncApiClient() as async_client:
+            return await QueryPlanner(row_limit=MAX_QUERY_ROWS).run_async(proj, query_data, async_client)
+
+    assert sorted_rows(asyncio.run(run())) == sorted_rows(full_result)
+
+
+def test_query_that_can_not_be_split_fails(client, proj):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    assert QueryPlanner(max_depth=0).run(proj, query_data, client) is None
+
+
+def test_truncated_result_that_can_not_be_split_is_kept(client, proj, truncating, sorted_rows):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    result = QueryPlanner(max_depth=0, row_limit=MAX_QUERY_ROWS).run(proj, query_data, client)
+
+    assert len(sorted_rows(result)) == MAX_QUERY_ROWS
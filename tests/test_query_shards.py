@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import async_metrics_base as amb
+import metrics_base as mb
+import query_shards
+
+
+# A week that starts on an hour but not on a day boundary, so the shards of granular queries
+# do not split an hour
+START_TIME = 1699999200
+END_TIME = START_TIME + 7 * 24 * 60 * 60
+
+SHARD_SECONDS = 24 * 60 * 60
+
+
+def get_rows_without(result, aliases):
+    #
+    # The rows of a result as a sorted list of (timestamp, cells), without the cells of aliases
+    #
+
+    rows = []
+    for timepoint in result['timepoints']:
+        for row in timepoint['metrics_rows']:
+            cells = sorted((cell['field'], cell['value']) for cell in row if cell['field'] not in aliases)
+            rows.append((timepoint.get('timestamp'), cells))
+
+    return sorted(rows, key=repr)
+
+
+def get_values(result, alias):
+    values = {}
+    for timepoint in result['timepoints']:
+        for row in timepoint['metrics_rows']:
+            cells = dict((cell['field'], cell['value']) for cell in row)
+            values[(timepoint.get('timestamp'), cells['item_id'], cells['environment'])] = cells[alias]
+
+    return values
+
+
+@pytest.mark.parametrize('granularity', [None, 'hour'])
+def test_sharded_result_equals_unsharded(client, proj, granularity):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME, granularity)
+
+    unsharded = mb.make_occ_metrics_api_call(proj, query_data, client)
+    sharded = mb.make_sharded_occ_metrics_api_call(proj, query_data, SHARD_SECONDS, client=client)
+
+    # The count_distinct aggregates are upper bounds (see test_sharded_distinct_counts_are_upper_bounds)
+    inexact = query_shards.get_inexact_aggregates(query_data)
+    assert 'ip_address_count' in inexact
+    assert sharded['inexact_aggregates'] == inexact
+    assert get_rows_without(sharded, inexact) == get_rows_without(unsharded, inexact)
+
+
+def test_sharded_distinct_counts_are_upper_bounds(client, proj):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    unsharded = mb.make_occ_metrics_api_call(proj, query_data, client)
+    sharded = mb.make_sharded_occ_metrics_api_call(proj, query_data, SHARD_SECONDS, client=client)
+
+    for alias in query_shards.get_inexact_aggregates(query_data):
+        unsharded_values = get_values(unsharded, alias)
+        sharded_values = get_values(sharded, alias)
+        assert sharded_values.keys() == unsharded_values.keys()
+        assert all(sharded_values[key] >= unsharded_values[key] for key in unsharded_values)
+
+
+def test_async_sharded_result_equals_unsharded(client, proj):
+    query_data = mb.get_item_metrics_query(START_TIME, END_TIME)
+
+    async def get_sharded():
+        async with amb.AsyncApiClient() as async_client:
+            return await amb.make_sharded_occ_metrics_api_call(proj, query_data, SHARD_SECONDS, async_client)
+
+    unsharded = mb.make_occ_metrics_api_call(proj, query_data, client)
+    inexact = query_shards.get_inexact_aggregates(query_data)
+
+    assert get_rows_without(asyncio.run(get_sharded()), inexact) == get_rows_without(unsharded, inexact)
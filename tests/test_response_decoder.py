@@ -0,0 +1,43 @@
+import response_decoder
+
+
+def get_row(**values):
+    return [{'field': field, 'value': value} for field, value in values.items()]
+
+
+ROWS = [get_row(item_id=1, environment='production', occurrence_count=10),
+        get_row(item_id=2, environment='staging', occurrence_count=20)]
+
+
+def test_rows_are_read_by_position_in_the_order_of_fields():
+    values = list(response_decoder.decode_metrics_rows(ROWS, ['occurrence_count', 'item_id']))
+
+    assert values == [(10, 1), (20, 2)]
+
+
+def test_missing_fields_get_the_default():
+    values = list(response_decoder.decode_metrics_rows(iter(ROWS), ['item_id', 'ip_address_count', 'environment'],
+                                                       default=0))
+
+    assert values == [(1, 0, 'production'), (2, 0, 'staging')]
+
+
+def test_rows_with_another_layout_are_decoded_field_by_field():
+    rows = ROWS + [get_row(environment='qa', occurrence_count=30, item_id=3)]
+
+    values = list(response_decoder.decode_metrics_rows(rows, ['item_id', 'occurrence_count']))
+
+    assert values == [(1, 10), (2, 20), (3, 30)]
+
+
+def test_middle_rows_with_another_layout_are_decoded_field_by_field():
+    rows = [ROWS[0],
+            get_row(environment='qa', occurrence_count=30, item_id=3),
+            get_row(item_id=4, occurrence_count=40),
+            ROWS[1]]
+
+    for metric_rows in [rows, iter(rows)]:
+        values = list(response_decoder.decode_metrics_rows(metric_rows, ['item_id', 'environment',
+                                                                         'occurrence_count']))
+
+        assert values == [(1, 'production', 10), (3, 'qa', 30), (4, None, 40), (2, 'staging', 20)]
@@ -0,0 +1,71 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import api_client
+import async_metrics_base as amb
+from throttle import RetryPolicy
+
+
+PROJECT_TOKEN = 'token-1'
+
+MAX_IN_FLIGHT = 8
+
+
+@pytest.fixture
+def rate_limited_api(fake_api, monkeypatch):
+    # Each access token is allowed 5 calls a second, fewer than the requests sent at the same time
+    monkeypatch.setattr(fake_api, 'rate_limit', 5)
+    monkeypatch.setattr(fake_api, 'rate_limit_window', 1)
+    return fake_api
+
+
+def get_retry_policy():
+    # Enough retries to get through the rate limit windows of the test
+    return RetryPolicy(max_retries=20, base_delay=0.05, max_delay=2)
+
+
+def get_items(client, item_ids):
+    with ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT) as executor:
+        return list(executor.map(lambda item_id: client.get('/api/1/item/{}'.format(item_id), PROJECT_TOKEN),
+                                 item_ids))
+
+
+def test_rate_limited_requests_are_retried_and_the_limit_recovers(rate_limited_api, monkeypatch):
+    with api_client.ApiClient(rate_limited_api.base_url, pool_size=MAX_IN_FLIGHT,
+                              retry_policy=get_retry_policy()) as client:
+        responses = get_items(client, range(10))
+
+        assert [resp.status_code for resp in responses] == [200] * 10
+        assert rate_limited_api.rate_limited_count > 0
+        assert client.throttle.aimd.min_seen_limit < MAX_IN_FLIGHT
+
+        # Without the rate limit the successful responses grow the limit back to the pool size
+        monkeypatch.setattr(rate_limited_api, 'rate_limit', None)
+        get_items(client, range(100))
+
+        assert client.throttle.aimd.limit == MAX_IN_FLIGHT
+
+
+def test_async_rate_limited_requests_are_retried_and_the_limit_recovers(rate_limited_api, monkeypatch):
+
+    async def get_async_items(client, item_ids):
+        return await asyncio.gather(*[client.get('/api/1/item/{}'.format(item_id), PROJECT_TOKEN)
+                                      for item_id in item_ids])
+
+    async def run():
+        async with amb.AsyncApiClient(rate_limited_api.base_url, max_in_flight=MAX_IN_FLIGHT,
+                                      retry_policy=get_retry_policy()) as client:
+            responses = await get_async_items(client, range(10))
+
+            assert [resp.status_code for resp in responses] == [200] * 10
+            assert rate_limited_api.rate_limited_count > 0
+            assert client.throttle.aimd.min_seen_limit < MAX_IN_FLIGHT
+
+            monkeypatch.setattr(rate_limited_api, 'rate_limit', None)
+            await get_async_items(client, range(100))
+
+            assert client.throttle.aimd.limit == MAX_IN_FLIGHT
+
+    asyncio.run(run())